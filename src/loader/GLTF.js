@@ -21,6 +21,8 @@ import Joint from '../Joint';
 import PerspectiveCamera from '../camera/Perspective';
 import OrthographicCamera from '../camera/Orthographic';
 import glenum from '../core/glenum';
+import dds from '../util/dds';
+import ktx from '../util/ktx';
 
 import BoundingBox from '../math/BoundingBox';
 
@@ -35,6 +37,7 @@ import Shader from '../Shader';
 
 var semanticAttributeMap = {
     'NORMAL': 'normal',
+    'TANGENT': 'tangent',
     'POSITION': 'position',
     'TEXCOORD_0': 'texcoord0',
     'TEXCOORD_1': 'texcoord1',
@@ -97,6 +100,41 @@ function getAccessorData(json, lib, accessorIdx, isIndices) {
     return arr;
 }
 
+// Normalized integer data of animation sampler output, like quantized rotation.
+function denormalizeAccessorData(arr) {
+    var divider;
+    if (arr instanceof vendor.Int8Array) {
+        divider = 127;
+    }
+    else if (arr instanceof vendor.Uint8Array) {
+        divider = 255;
+    }
+    else if (arr instanceof vendor.Int16Array) {
+        divider = 32767;
+    }
+    else if (arr instanceof vendor.Uint16Array) {
+        divider = 65535;
+    }
+    else {
+        return arr;
+    }
+    var out = new vendor.Float32Array(arr.length);
+    for (var i = 0; i < arr.length; i++) {
+        out[i] = Math.max(arr[i] / divider, -1);
+    }
+    return out;
+}
+
+// Material only has one uv transform, use the KHR_texture_transform of the first texture which has it.
+function getTextureTransform(textureInfos) {
+    for (var i = 0; i < textureInfos.length; i++) {
+        var extensions = textureInfos[i] && textureInfos[i].extensions;
+        if (extensions && extensions['KHR_texture_transform']) {
+            return extensions['KHR_texture_transform'];
+        }
+    }
+}
+
 function base64ToBinary(input, charStart) {
     var chars = 'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/';
     var lookup = new Uint8Array(130);
@@ -218,6 +256,13 @@ var GLTFLoader = Base.extend(/** @lends clay.loader.GLTF# */ {
      */
     textureConvertToPOT: false,
 
+    /**
+     * Use the block compressed textures listed in the extras of images. Can be 'dds' or 'ktx'.
+     * Renderer needs to support WEBGL_compressed_texture_s3tc extension.
+     * @type {string}
+     */
+    compressedTextureFormat: '',
+
     shaderLibrary: null
 },
 function () {
@@ -487,6 +532,25 @@ function () {
         });
     },
 
+    _loadCompressedTexture: function (path, texture) {
+        var format = this.compressedTextureFormat;
+        this.loadBuffer(path, function (buffer) {
+            if (format === 'dds') {
+                dds.parse(buffer, texture);
+            }
+            else {
+                var res = ktx.parse(buffer, true);
+                if (res) {
+                    texture.width = res.width;
+                    texture.height = res.height;
+                    texture.format = res.format;
+                    texture.mipmaps = res.mipmaps;
+                }
+            }
+            texture.dirty();
+        });
+    },
+
     _getShader: function () {
         if (typeof this.shader === 'string') {
             return this.shaderLibrary.get(this.shader);
@@ -613,8 +677,15 @@ function () {
             if (target === glenum.TEXTURE_2D) {
                 var texture = new Texture2D(parameters);
                 var imageInfo = json.images[textureInfo.source];
+                var compressed = imageInfo.extras && imageInfo.extras.compressed;
                 var uri;
-                if (imageInfo.uri) {
+                if (compressed && compressed[this.compressedTextureFormat]) {
+                    this._loadCompressedTexture(
+                        this.resolveTexturePath(compressed[this.compressedTextureFormat]), texture
+                    );
+                    lib.textures[idx] = texture;
+                }
+                else if (imageInfo.uri) {
                     uri = this.resolveTexturePath(imageInfo.uri);
                 }
                 else if (imageInfo.bufferView != null) {
@@ -798,6 +869,17 @@ function () {
             alphaCutoff: materialInfo.alphaCutoff || 0.5,
             normalScale: normalScale
         };
+        var textureTransform = getTextureTransform([
+            metallicRoughnessMatInfo.baseColorTexture,
+            metallicRoughnessMatInfo.metallicRoughnessTexture,
+            materialInfo.normalTexture,
+            materialInfo.emissiveTexture,
+            materialInfo.occlusionTexture
+        ]);
+        if (textureTransform) {
+            commonProperties.uvRepeat = textureTransform.scale || [1, 1];
+            commonProperties.uvOffset = textureTransform.offset || [0, 0];
+        }
         if (commonProperties.roughnessMap) {
             // In glTF metallicFactor will do multiply, which is different from StandardMaterial.
             // So simply ignore it
@@ -896,6 +978,17 @@ function () {
             emissionIntensity: 1,
             alphaCutoff: materialInfo.alphaCutoff == null ? 0.5 : materialInfo.alphaCutoff
         };
+        var textureTransform = getTextureTransform([
+            specularGlossinessMatInfo.diffuseTexture,
+            specularGlossinessMatInfo.specularGlossinessTexture,
+            materialInfo.normalTexture,
+            materialInfo.emissiveTexture,
+            materialInfo.occlusionTexture
+        ]);
+        if (textureTransform) {
+            commonProperties.uvRepeat = textureTransform.scale || [1, 1];
+            commonProperties.uvOffset = textureTransform.offset || [0, 0];
+        }
         if (commonProperties.glossinessMap) {
             // Ignore specularFactor
             commonProperties.glossiness = 0.5;
@@ -1241,6 +1334,9 @@ function () {
                 }
 
                 track.channels[path] = getAccessorData(json, lib, samplerInfo.output);
+                if (json.accessors[samplerInfo.output].normalized) {
+                    track.channels[path] = denormalizeAccessorData(track.channels[path]);
+                }
             }
             var tracksList = [];
             for (var hash in tracks) {
@@ -80,11 +80,11 @@ var ret = {
         if (header[off_magic] !== DDS_MAGIC) {
             return null;
         }
-        if (!header(off_pfFlags) & DDPF_FOURCC) {
+        if (!(header[off_pfFlags] & DDPF_FOURCC)) {
             return null;
         }
 
-        var fourCC = header(off_pfFourCC);
+        var fourCC = header[off_pfFourCC];
         var width = header[off_width];
         var height = header[off_height];
         var isCubeMap = header[off_caps2] & DDSCAPS2_CUBEMAP;
@@ -125,15 +125,19 @@ var ret = {
             });
             var mipmaps = [];
             for (var i = 0; i < mipmapCount; i++) {
-                var dataLength = Math.max(4, _width) / 4 * Math.max(4, _height) / 4 * blockBytes;
+                var dataLength = Math.ceil(Math.max(4, _width) / 4) * Math.ceil(Math.max(4, _height) / 4) * blockBytes;
                 var byteArray = new Uint8Array(arrayBuffer, dataOffset, dataLength);
 
                 dataOffset += dataLength;
-                _width *= 0.5;
-                _height *= 0.5;
-                mipmaps[i] = byteArray;
+                mipmaps[i] = {
+                    pixels: byteArray,
+                    width: _width,
+                    height: _height
+                };
+                _width = Math.max(1, Math.floor(_width / 2));
+                _height = Math.max(1, Math.floor(_height / 2));
             }
-            textures[f].pixels = mipmaps[0];
+            textures[f].pixels = mipmaps[0].pixels;
             if (hasMipmap) {
                 textures[f].mipmaps = mipmaps;
             }
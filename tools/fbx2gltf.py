@@ -5,7 +5,8 @@
 # fbx version 2018.1.1
 # http://github.com/pissang/
 # ############################################
-import sys, struct, json, os.path, math, argparse, shutil
+import sys, struct, json, os.path, math, argparse, shutil, re, hashlib, mimetypes, threading
+import concurrent.futures
 
 try:
     from FbxCommon import *
@@ -22,6 +23,21 @@ except ImportError:
     print(msg)
     sys.exit(1)
 
+# Optional, for texture processing
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+try:
+    import numpy as np
+except ImportError:
+    np = None
+# Optional, for faster json output
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 lib_materials = []
 
 lib_images = []
@@ -48,6 +64,11 @@ lib_skins = []
 
 lib_animations = []
 
+lib_extensions_used = []
+
+# Triangle BVHs of primitives, written in bufferViews of their own
+lib_triangle_bvhs = []
+
 # Only python 3 support bytearray ?
 # http://dabeaz.blogspot.jp/2010/01/few-useful-bytearray-tricks.html
 attributeBuffer = bytearray()
@@ -55,7 +76,10 @@ indicesBuffer = bytearray()
 invBindMatricesBuffer = bytearray()
 animationBuffer = bytearray()
 
+GL_RGB = 0x1907
 GL_RGBA = 0x1908
+GL_COMPRESSED_RGB_S3TC_DXT1_EXT = 0x83F0
+GL_COMPRESSED_RGBA_S3TC_DXT5_EXT = 0x83F3
 
 GL_BYTE = 5120
 GL_UNSIGNED_BYTE = 5121
@@ -80,6 +104,43 @@ GL_ELEMENT_ARRAY_BUFFER = 0x8893
 
 ENV_QUANTIZE = False
 ENV_FLIP_V = True
+ENV_TEXTURE_TRANSFORM = False
+ENV_TANGENTS = False
+ENV_GENERATE_NORMALS = False
+ENV_CLEANUP = False
+# Triangulate the exported meshes with NumPy instead of FbxGeometryConverter.Triangulate on the whole scene.
+ENV_FAST_TRIANGULATE = False
+# Triangle ratio of each LOD level, max simplification error relative to the bounding box diagonal,
+# and the screen coverage of each level including the base mesh.
+ENV_LOD_RATIOS = []
+ENV_LOD_ERROR = 0.01
+ENV_LOD_COVERAGE = []
+# Split primitives with more triangles into clusters, 0 is disabled.
+ENV_CLUSTER_TRIANGLES = 0
+ENV_BOUNDS = False
+# Split primitives to avoid 32 bit indices, and use 8 bit indices for tiny primitives.
+ENV_SHORT_INDICES = False
+# Build triangle BVH of primitives with more triangles, 0 is disabled.
+ENV_TRIANGLE_BVH = 0
+
+ENV_JSON_PRECISION = -1
+ENV_BUFFER_LAYOUT = 'kind'
+ENV_SPLIT_BUFFERS = 'none'
+ENV_BUFFER_MAX_SIZE = 16 * 1024 * 1024
+# Constant animation channels are dropped or collapsed to one keyframe within this tolerance.
+# Negative value will keep all channels.
+ENV_ANIMATION_TOLERANCE = 1e-5
+ENV_QUANTIZE_ANIMATION = False
+# Texture processing
+ENV_TEXTURE_MAX_SIZE = {}
+ENV_TEXTURE_POT = False
+ENV_TEXTURE_FORMAT = 'keep'
+ENV_TEXTURE_QUALITY = 90
+ENV_TEXTURE_MIPMAPS = False
+ENV_TEXTURE_CACHE_DIR = ''
+ENV_TEXTURE_COMPRESS = []
+ENV_ATLAS_SIZE = 2048
+ENV_ATLAS_TILE_SIZE = 512
 
 
 _id = 0
@@ -91,6 +152,10 @@ def GetId():
 def ListFromM4(m):
     return [m[0][0], m[0][1], m[0][2], m[0][3], m[1][0], m[1][1], m[1][2], m[1][3], m[2][0], m[2][1], m[2][2], m[2][3], m[3][0], m[3][1], m[3][2], m[3][3]]
 
+def UseExtension(pName):
+    if not pName in lib_extensions_used:
+        lib_extensions_used.append(pName)
+
 def MatGetOpacity(pMaterial):
     lFactor = pMaterial.TransparencyFactor.Get()
     lColor = pMaterial.TransparentColor.Get()
@@ -190,6 +255,7 @@ def CreateAccessorBuffer(pList, pType, pStride, pMinMax=False, pQuantize=False,
     if pQuantize and pType == 'f' and pStride <= 4:
         pList, lDecodeMatrix, lDecodedMin, lDecodedMax = quantize(pList, pStride, lMin[0:], lMax[0:])
         pType = 'H'
+        UseExtension('WEB3D_quantized_attributes')
         # https://github.com/KhronosGroup/glTF/blob/master/extensions/Vendor/WEB3D_quantized_attributes
         lGLTFAccessor['extensions'] = {
             'WEB3D_quantized_attributes': {
@@ -223,9 +289,15 @@ def CreateAccessorBuffer(pList, pType, pStride, pMinMax=False, pQuantize=False,
     # Unsigned Short
     elif pType == 'H':
         lGLTFAccessor['componentType'] = GL_UNSIGNED_SHORT
+    # Short
+    elif pType == 'h':
+        lGLTFAccessor['componentType'] = GL_SHORT
     # Unsigned Byte
     elif pType == 'B':
         lGLTFAccessor['componentType'] = GL_UNSIGNED_BYTE
+    # Byte
+    elif pType == 'b':
+        lGLTFAccessor['componentType'] = GL_BYTE
 
     if pStride == 1:
         lGLTFAccessor['type'] = 'SCALAR'
@@ -256,9 +328,14 @@ def appendToBuffer(pType, pBuffer, pData, pObj):
     lByteOffset = len(pBuffer)
     if pType == 'f' or pType == 'I':
         # should be a multiple of 4 for alignment
-        if lByteOffset % 4 == 2:
-            pBuffer.extend(b'\x00\x00')
-            lByteOffset += 2
+        if lByteOffset % 4 != 0:
+            lPadding = 4 - lByteOffset % 4
+            pBuffer.extend(b'\x00' * lPadding)
+            lByteOffset += lPadding
+    elif pType == 'H' or pType == 'h':
+        if lByteOffset % 2 == 1:
+            pBuffer.extend(b'\x00')
+            lByteOffset += 1
 
     pObj['byteOffset'] = lByteOffset
     pBuffer.extend(pData)
@@ -272,6 +349,14 @@ def CreateAttributeBuffer(pList, pType, pStride, pNormalize=False):
     return idx
 
 
+def GetIndicesType(pVertexCount):
+    if pVertexCount >= 0xffff:
+        #Use unsigned int in element indices
+        return 'I'
+    if ENV_SHORT_INDICES and pVertexCount < 0xff:
+        return 'B'
+    return 'H'
+
 def CreateIndicesBuffer(pList, pType):
     # Sketchfab needs all accessor have min, max?
     lData, lGLTFIndices = CreateAccessorBuffer(pList, pType, 1, True)
@@ -281,17 +366,8 @@ def CreateIndicesBuffer(pList, pType):
     lib_accessors.append(lGLTFIndices)
     return idx
 
-def CreateAnimationBuffer(pList, pType, pStride):
-    lData, lGLTFAnimSampler = CreateAccessorBuffer(pList, pType, pStride, True)
-
-    # PENDING
-    # lAllSame = True
-    # for i in range(pStride):
-    #     if lGLTFAnimSampler['min'][i] != lGLTFAnimSampler['max'][i]:
-    #         lAllSame = False
-    # # Just ignore it.
-    # if lAllSame:
-    #     return -1
+def CreateAnimationBuffer(pList, pType, pStride, pQuantize=False, pNormalize=False):
+    lData, lGLTFAnimSampler = CreateAccessorBuffer(pList, pType, pStride, True, pQuantize, pNormalize)
 
     appendToBuffer(pType, animationBuffer, lData, lGLTFAnimSampler)
 
@@ -308,16 +384,62 @@ def CreateIBMBuffer(pList):
     lib_accessors.append(lGLTFIBM)
     return idx
 
+_componentTypeFormat = {
+    GL_BYTE: 'b',
+    GL_UNSIGNED_BYTE: 'B',
+    GL_SHORT: 'h',
+    GL_UNSIGNED_SHORT: 'H',
+    GL_UNSIGNED_INT: 'I',
+    GL_FLOAT: 'f'
+}
+_accessorTypeStride = {
+    'SCALAR': 1,
+    'VEC2': 2,
+    'VEC3': 3,
+    'VEC4': 4,
+    'MAT3': 9,
+    'MAT4': 16
+}
+
+def ReadAccessorData(pBuffer, pAccessorIdx):
+    lAccessor = lib_accessors[pAccessorIdx]
+    lType = _componentTypeFormat[lAccessor['componentType']]
+    lStride = _accessorTypeStride[lAccessor['type']]
+    lItemSize = struct.calcsize('<' + lType) * lStride
+    lPackType = '<' + lType * lStride
+    lList = []
+    for i in range(lAccessor['count']):
+        lItem = struct.unpack_from(lPackType, pBuffer, lAccessor['byteOffset'] + i * lItemSize)
+        if lStride == 1:
+            lList.append(lItem[0])
+        else:
+            lList.append(list(lItem))
+    return lList
+
+# Rewrite accessor data in place, size of data must not change.
+def WriteAccessorData(pBuffer, pAccessorIdx, pList):
+    lAccessor = lib_accessors[pAccessorIdx]
+    lData, lTmpAccessor = CreateAccessorBuffer(
+        pList, _componentTypeFormat[lAccessor['componentType']], _accessorTypeStride[lAccessor['type']], 'min' in lAccessor
+    )
+    lByteOffset = lAccessor['byteOffset']
+    pBuffer[lByteOffset:lByteOffset + len(lData)] = lData
+    if 'min' in lAccessor:
+        lAccessor['min'] = lTmpAccessor['min']
+        lAccessor['max'] = lTmpAccessor['max']
+
 
+_imageHashMap = {}
 def CreateImage(pPath):
-    lImageIndices = [idx for idx in range(len(lib_images)) if lib_images[idx]['uri'] == pPath]
-    if len(lImageIndices):
-        return lImageIndices[0]
+    if pPath in _imageHashMap:
+        return _imageHashMap[pPath]
 
     lImageIdx = len(lib_images)
     lib_images.append({
         'uri' : pPath
     })
+    _imageHashMap[pPath] = lImageIdx
+    SubmitImageTask(lImageIdx)
     return lImageIdx
 
 def HashSampler(pTexture):
@@ -411,6 +533,26 @@ def CreateTexture(pProperty):
     else:
         return None, lScaleU, lScaleV, lTranslationU, lTranslationV
 
+def CreateTextureInfo(pTextureIdx, pScaleU, pScaleV, pTranslationU, pTranslationV):
+    lTextureInfo = {
+        "index": pTextureIdx,
+        "texCoord": 0
+    }
+    if ENV_TEXTURE_TRANSFORM and (pScaleU != 1 or pScaleV != 1 or pTranslationU != 0 or pTranslationV != 0):
+        # Same with the transform in ProcessUV, v is flipped after transformed.
+        if ENV_FLIP_V:
+            lOffsetV = 1 - pScaleV - pTranslationV
+        else:
+            lOffsetV = pTranslationV
+        lTextureInfo['extensions'] = {
+            'KHR_texture_transform': {
+                'offset': [pTranslationU, lOffsetV],
+                'scale': [pScaleU, pScaleV]
+            }
+        }
+        UseExtension('KHR_texture_transform')
+    return lTextureInfo
+
 def GetRoughnessFromExponentShininess(pShininess):
     # PENDING Is max 1024?
     lGlossiness = math.log(pShininess) / math.log(1024.0)
@@ -438,7 +580,16 @@ def ScaleV3(v3, scale):
     v3[1] *= scale
     v3[2] *= scale
 
+# Converted materials keyed by unique id of FbxSurfaceMaterial
+_materialIdMap = {}
+# Material index keyed by the content of glTF material
+_materialContentMap = {}
+
 def ConvertToPBRMaterial(pMaterial):
+    lMaterialId = pMaterial.GetUniqueID()
+    if lMaterialId in _materialIdMap:
+        return _materialIdMap[lMaterialId]
+
     lMaterialName = pMaterial.GetName()
     lShading = str(pMaterial.ShadingModel.Get()).lower()
 
@@ -457,8 +608,6 @@ def ConvertToPBRMaterial(pMaterial):
     }
     lValues = lGLTFMaterial["pbrMetallicRoughness"]
 
-    lMaterialIdx = len(lib_materials)
-
     lSpecularColor = [0, 0, 0]
     # print(dir(pMaterial))
 
@@ -477,10 +626,7 @@ def ConvertToPBRMaterial(pMaterial):
             # TODO other textures ?
             lTextureIdx, lScaleU, lScaleV, lTranslationU, lTranslationV = CreateTexture(pMaterial.Diffuse)
             if not lTextureIdx == None:
-                lValues['baseColorTexture'] = {
-                    "index": lTextureIdx,
-                    "texCoord": 0
-                }
+                lValues['baseColorTexture'] = CreateTextureInfo(lTextureIdx, lScaleU, lScaleV, lTranslationU, lTranslationV)
         else:
             lValues['baseColorFactor'][0:3] = list(pMaterial.Diffuse.Get())
 
@@ -492,25 +638,17 @@ def ConvertToPBRMaterial(pMaterial):
         if pMaterial.Bump.GetSrcObjectCount() > 0:
             lTextureIdx, lScaleU, lScaleV, lTranslationU, lTranslationV = CreateTexture(pMaterial.Bump)
             if not lTextureIdx == None:
-                lGLTFMaterial['normalTexture'] = {
-                    "index": lTextureIdx,
-                    "texCoord": 0
-                }
+                lGLTFMaterial['normalTexture'] = CreateTextureInfo(lTextureIdx, lScaleU, lScaleV, lTranslationU, lTranslationV)
 
     if hasattr(pMaterial, 'NormalMap'):
         if pMaterial.NormalMap.GetSrcObjectCount() > 0:
             lTextureIdx, lScaleU, lScaleV, lTranslationU, lTranslationV = CreateTexture(pMaterial.NormalMap)
             if not lTextureIdx == None:
-                lGLTFMaterial['normalTexture'] = {
-                    "index": lTextureIdx,
-                    "texCoord": 0
-                }
+                lGLTFMaterial['normalTexture'] = CreateTextureInfo(lTextureIdx, lScaleU, lScaleV, lTranslationU, lTranslationV)
 
     if hasattr(pMaterial, 'NormalMShininessap'):
         lValues['roughnessFactor'] = GetRoughnessFromExponentShininess(pMaterial.Shininess.Get())
 
-    lib_materials.append(lGLTFMaterial)
-
     if lShading == 'unknown':
         # Maybe shading of VRay
         lProp = pMaterial.GetFirstProperty()
@@ -538,7 +676,20 @@ def ConvertToPBRMaterial(pMaterial):
 
     lValues['metallicFactor'] = GetMetalnessFromSpecular(lSpecularColor, lValues['baseColorFactor'][0:3])
 
-    return lMaterialIdx, lScaleU, lScaleV, lTranslationU, lTranslationV
+    # Different materials with the same content are merged, name is ignored.
+    lContentKey = json.dumps(dict((k, v) for k, v in lGLTFMaterial.items() if k != 'name'), sort_keys = True)
+    if lContentKey in _materialContentMap:
+        lMaterialIdx = _materialContentMap[lContentKey]
+    else:
+        lMaterialIdx = len(lib_materials)
+        lib_materials.append(lGLTFMaterial)
+        _materialContentMap[lContentKey] = lMaterialIdx
+
+    if ENV_TEXTURE_TRANSFORM:
+        # Texcoords are kept untouched.
+        lScaleU, lScaleV, lTranslationU, lTranslationV = 1, 1, 0, 0
+    _materialIdMap[lMaterialId] = (lMaterialIdx, lScaleU, lScaleV, lTranslationU, lTranslationV)
+    return _materialIdMap[lMaterialId]
 
 
 def CreateSkin():
@@ -550,11 +701,91 @@ def CreateSkin():
 
     return lSkinIdx
 
-_defaultMaterialName = 'DEFAULT_MAT_'
+def GetSkinClusters(pNode, pClusters):
+    lJoints = []
+    for i in range(pNode.GetNodeAttributeCount()):
+        lNodeAttribute = pNode.GetNodeAttributeByIndex(i)
+        if not lNodeAttribute.GetAttributeType() == FbxNodeAttribute.eMesh:
+            continue
+        for i2 in range(lNodeAttribute.GetDeformerCount(FbxDeformer.eSkin)):
+            lDeformer = lNodeAttribute.GetDeformer(i2, FbxDeformer.eSkin)
+            for i3 in range(lDeformer.GetClusterCount()):
+                lCluster = lDeformer.GetCluster(i3)
+                lNodeIdx = GetNodeIdx(lCluster.GetLink())
+                if not lNodeIdx in pClusters:
+                    lJoints.append(lNodeIdx)
+                    pClusters[lNodeIdx] = lCluster
+    return lJoints
+
+def GetInverseBindMatrices(pJoints, pClusters):
+    lClusterGlobalInitMatrix = FbxAMatrix()
+    lReferenceGlobalInitMatrix = FbxAMatrix()
+
+    lIBM = []
+    for lJointIdx in pJoints:
+        lCluster = pClusters[lJointIdx]
+
+        # Inverse Bind Pose Matrix
+        # Matrix of Mesh
+        lCluster.GetTransformMatrix(lReferenceGlobalInitMatrix)
+        # Matrix of Joint
+        lCluster.GetTransformLinkMatrix(lClusterGlobalInitMatrix)
+        # http://blog.csdn.net/bugrunner/article/details/7232291
+        # http://help.autodesk.com/view/FBX/2017/ENU/?guid=__cpp_ref__view_scene_2_draw_scene_8cxx_example_html
+        m = lClusterGlobalInitMatrix.Inverse() * lReferenceGlobalInitMatrix
+        lIBM.append(m)
+    return lIBM
+
+SKIN_IBM_EPSILON = 1e-4
+# Skins keyed by their joint set, value is list of (skin index, {joint: IBM list})
+_skinHashMap = {}
+
+def M4Same(a, b, pEpsilon):
+    for i in range(16):
+        if abs(a[i] - b[i]) > pEpsilon * max(1.0, abs(a[i]), abs(b[i])):
+            return False
+    return True
+
+def FindSharedSkin(pJoints, pIBM):
+    lHashKey = frozenset(pJoints)
+    if not lHashKey in _skinHashMap:
+        return -1
+    for lSkinIdx, lSkinIBMMap in _skinHashMap[lHashKey]:
+        lAllSame = True
+        for i in range(len(pJoints)):
+            if not M4Same(lSkinIBMMap[pJoints[i]], pIBM[i], SKIN_IBM_EPSILON):
+                lAllSame = False
+                break
+        if lAllSame:
+            return lSkinIdx
+    return -1
+
+def CreateSharedSkin(pJoints, pIBM):
+    lIBMList = [ListFromM4(m) for m in pIBM]
+    lSkinIdx = FindSharedSkin(pJoints, lIBMList)
+    if lSkinIdx >= 0:
+        return lSkinIdx
+
+    lSkinIdx = CreateSkin()
+    lGLTFSkin = lib_skins[lSkinIdx]
+    lGLTFSkin['joints'] = list(pJoints)
+    lGLTFSkin['inverseBindMatrices'] = CreateIBMBuffer(pIBM)
+
+    lHashKey = frozenset(pJoints)
+    if not lHashKey in _skinHashMap:
+        _skinHashMap[lHashKey] = []
+    _skinHashMap[lHashKey].append((lSkinIdx, dict(zip(pJoints, lIBMList))))
+    return lSkinIdx
 
+_defaultMaterialName = 'DEFAULT_MAT'
+_defaultMaterial = None
+
+# All meshes without material share the same default material.
 def CreateDefaultMaterial(pScene):
-    lMat = FbxSurfacePhong.Create(pScene, _defaultMaterialName + str(len(lib_materials)))
-    return lMat
+    global _defaultMaterial
+    if _defaultMaterial == None:
+        _defaultMaterial = FbxSurfacePhong.Create(pScene, _defaultMaterialName)
+    return _defaultMaterial
 
 def ProcessUV(uv, scaleU, scaleV, translationU, translationV):
     for i in range(len(uv)):
@@ -566,6 +797,92 @@ def ProcessUV(uv, scaleU, scaleV, translationU, translationV):
             # glTF2.0 don't flipY. So flip the uv.
             uv[i][1] = 1.0 - uv[i][1]
 
+# Texcoords are not transformed by flatten or batch, so primitives with the same texcoords can share the accessor.
+_texcoordHashMap = {}
+# Texcoords are shared only when they are kept untouched, the atlas remaps texcoords in place.
+def CreateTexcoordBuffer(pList):
+    if not ENV_TEXTURE_TRANSFORM:
+        return CreateAttributeBuffer(pList, 'f', 2)
+    lHashKey = hashlib.sha1(struct.pack('<%dd' % (len(pList) * 2), *[c for lUv in pList for c in lUv])).hexdigest()
+    if not lHashKey in _texcoordHashMap:
+        _texcoordHashMap[lHashKey] = CreateAttributeBuffer(pList, 'f', 2)
+    return _texcoordHashMap[lHashKey]
+
+# Tangents of normal mapped primitives. Like MikkTSpace, tangents of triangles are weighted by the corner angle
+# and orthogonalized to the vertex normal. Vertices are split where the handedness differs. Needs NumPy.
+def NeedTangents(pPrimitive):
+    return 'normalTexture' in lib_materials[pPrimitive['material']] \
+        and len(pPrimitive['normals']) == len(pPrimitive['positions']) \
+        and len(pPrimitive['texcoords0']) == len(pPrimitive['positions'])
+
+def GetPerpendicular(pVectors):
+    lAxis = np.zeros_like(pVectors)
+    lUseY = np.abs(pVectors[:, 0]) > 0.9
+    lAxis[lUseY, 1] = 1
+    lAxis[~lUseY, 0] = 1
+    lPerpendicular = np.cross(pVectors, lAxis)
+    return lPerpendicular / np.maximum(np.linalg.norm(lPerpendicular, axis = 1, keepdims = True), 1e-12)
+
+def ComputePrimitiveTangents(pPrimitive):
+    lVertexCount = len(pPrimitive['positions'])
+    lPositions = np.array([[p[0], p[1], p[2]] for p in pPrimitive['positions']], dtype = np.float64)
+    lNormals = np.array([[n[0], n[1], n[2]] for n in pPrimitive['normals']], dtype = np.float64)
+    lNormals /= np.maximum(np.linalg.norm(lNormals, axis = 1, keepdims = True), 1e-12)
+    lUVs = np.array(pPrimitive['texcoords0'], dtype = np.float64)
+    lTriangles = np.array(pPrimitive['indices'], dtype = np.int64).reshape(-1, 3)
+
+    lP = lPositions[lTriangles]
+    lUV = lUVs[lTriangles]
+    lEdge1 = lP[:, 1] - lP[:, 0]
+    lEdge2 = lP[:, 2] - lP[:, 0]
+    lDeltaUV1 = lUV[:, 1] - lUV[:, 0]
+    lDeltaUV2 = lUV[:, 2] - lUV[:, 0]
+    lDet = lDeltaUV1[:, 0] * lDeltaUV2[:, 1] - lDeltaUV2[:, 0] * lDeltaUV1[:, 1]
+    lValid = np.abs(lDet) > 1e-20
+    lInvDet = np.where(lValid, 1.0 / np.where(lValid, lDet, 1.0), 0.0)[:, None]
+    lSdir = (lEdge1 * lDeltaUV2[:, 1:2] - lEdge2 * lDeltaUV1[:, 1:2]) * lInvDet
+    lTdir = (lEdge2 * lDeltaUV1[:, 0:1] - lEdge1 * lDeltaUV2[:, 0:1]) * lInvDet
+    lSdir /= np.maximum(np.linalg.norm(lSdir, axis = 1, keepdims = True), 1e-12)
+    # Bitangent is cross(normal, tangent) * w in glTF.
+    lFaceNormals = np.cross(lEdge1, lEdge2)
+    lNegative = np.einsum('ij,ij->i', np.cross(lFaceNormals, lSdir), lTdir) < 0
+
+    lAngles = np.empty(lTriangles.shape)
+    for k in range(3):
+        a = lP[:, (k + 1) % 3] - lP[:, k]
+        b = lP[:, (k + 2) % 3] - lP[:, k]
+        lAngles[:, k] = np.arctan2(np.linalg.norm(np.cross(a, b), axis = 1), np.einsum('ij,ij->i', a, b))
+
+    # Accumulate in two slots of each vertex, one for each handedness.
+    lSlots = lTriangles * 2 + lNegative[:, None]
+    lSlotTangents = np.zeros((lVertexCount * 2, 3))
+    np.add.at(lSlotTangents, lSlots.ravel(), (lSdir[:, None, :] * lAngles[:, :, None]).reshape(-1, 3))
+    lSlotUsed = np.zeros(lVertexCount * 2, dtype = bool)
+    lSlotUsed[lSlots.ravel()] = True
+
+    # Split the vertices used by both handedness.
+    lSplit = np.nonzero(lSlotUsed[0::2] & lSlotUsed[1::2])[0]
+    lSlotVertex = np.repeat(np.arange(lVertexCount), 2)
+    lSlotVertex[lSplit * 2 + 1] = lVertexCount + np.arange(len(lSplit))
+
+    # Slot of each output vertex.
+    lVertexSlots = np.arange(lVertexCount) * 2 + (lSlotUsed[1::2] & ~lSlotUsed[0::2])
+    lVertexSlots = np.concatenate([lVertexSlots, lSplit * 2 + 1])
+    lVertexNormals = lNormals[lVertexSlots // 2]
+    lTangents = lSlotTangents[lVertexSlots]
+    # Gram-Schmidt orthogonalize
+    lTangents -= lVertexNormals * np.einsum('ij,ij->i', lVertexNormals, lTangents)[:, None]
+    lLength = np.linalg.norm(lTangents, axis = 1, keepdims = True)
+    lTangents = np.where(lLength > 1e-12, lTangents / np.maximum(lLength, 1e-12), GetPerpendicular(lVertexNormals))
+    lW = np.where(lVertexSlots % 2 == 1, -1.0, 1.0)
+
+    for lKey in ['positions', 'normals', 'vertexColors', 'texcoords0', 'texcoords1', 'joints', 'weights']:
+        lList = pPrimitive[lKey]
+        if len(lList) == lVertexCount:
+            lList.extend([lList[v] for v in lSplit])
+    pPrimitive['indices'] = lSlotVertex[lSlots].ravel().tolist()
+    pPrimitive['tangents'] = np.concatenate([lTangents, lW[:, None]], axis = 1).tolist()
+
 def GetSkinningData(pMesh, pSkin, pClusters, pNode):
     moreThanFourJoints = False
     lMaxJointCount = 0
@@ -659,7 +976,372 @@ def GetVertexAttribute(pLayer, pControlPointIdx, pPolygonVertexIndex):
         pass
         # Unknown
 
-def ConvertMesh(pScene, pMesh, pNode, pSkin, pClusters):
+# Smoothing group of each polygon, 0 is not smoothed.
+def GetPolygonSmoothingGroups(pMesh):
+    lSmoothingLayer = pMesh.GetElementSmoothing(0)
+    if not lSmoothingLayer:
+        return None
+    if lSmoothingLayer.GetMappingMode() == FbxLayerElement.eByEdge:
+        # It replaces the smoothing layer of the mesh. Fine because the scene is only loaded for the conversion
+        # and never saved, other instances of the mesh read the same polygon smoothing.
+        FbxGeometryConverter(pMesh.GetFbxManager()).ComputePolygonSmoothingFromEdgeSmoothing(pMesh, 0)
+        lSmoothingLayer = pMesh.GetElementSmoothing(0)
+    if not lSmoothingLayer.GetMappingMode() == FbxLayerElement.eByPolygon:
+        return None
+    lDirectArray = lSmoothingLayer.GetDirectArray()
+    if lSmoothingLayer.GetReferenceMode() == FbxLayerElement.eDirect:
+        return [lDirectArray.GetAt(i) for i in range(pMesh.GetPolygonCount())]
+    lIndexArray = lSmoothingLayer.GetIndexArray()
+    return [lDirectArray.GetAt(lIndexArray.GetAt(i)) for i in range(pMesh.GetPolygonCount())]
+
+# Triangles of polygon projected on its plane with ear clipping, in local indices of the polygon.
+def EarClipPolygon(pPoints):
+    lIndices = list(range(len(pPoints)))
+    lTriangles = []
+    def Cross(a, b, c):
+        return (pPoints[b][0] - pPoints[a][0]) * (pPoints[c][1] - pPoints[a][1]) \
+            - (pPoints[b][1] - pPoints[a][1]) * (pPoints[c][0] - pPoints[a][0])
+    while len(lIndices) > 3:
+        lCount = len(lIndices)
+        lEar = -1
+        for k in range(lCount):
+            a, b, c = lIndices[k - 1], lIndices[k], lIndices[(k + 1) % lCount]
+            # Reflex corner
+            if Cross(a, b, c) <= 0:
+                continue
+            if any(
+                Cross(a, b, p) >= 0 and Cross(b, c, p) >= 0 and Cross(c, a, p) >= 0
+                for p in lIndices if not p in (a, b, c)
+            ):
+                continue
+            lEar = k
+            break
+        # Self intersecting polygon has no ear, fan the rest.
+        if lEar < 0:
+            break
+        lTriangles.append((lIndices[lEar - 1], lIndices[lEar], lIndices[(lEar + 1) % lCount]))
+        del lIndices[lEar]
+    for k in range(1, len(lIndices) - 1):
+        lTriangles.append((lIndices[0], lIndices[k], lIndices[k + 1]))
+    return lTriangles
+
+# Triangles of the mesh, returns the control point of each polygon vertex, the polygon of each triangle
+# and the polygon vertex indices of the triangle corners.
+# With fast triangulation, polygons are triangulated here with fan for the convex ones and ear clipping
+# for the concave ones. Needs NumPy. Otherwise the mesh is already triangulated by FbxGeometryConverter.
+def GetMeshTriangles(pMesh, pPositions):
+    lPolygonCount = pMesh.GetPolygonCount()
+    if not ENV_FAST_TRIANGULATE or np == None:
+        # Mesh is triangulated by FbxGeometryConverter
+        lPolygonVertices = [pMesh.GetPolygonVertex(i, j) for i in range(lPolygonCount) for j in range(3)]
+        return lPolygonVertices, list(range(lPolygonCount)), list(range(lPolygonCount * 3))
+
+    lPolygonVertices = list(pMesh.GetPolygonVertices())
+    # FBX SDK python bindings have no bulk access to the polygon sizes or start indices,
+    # so it's still one call per polygon.
+    lSizes = [pMesh.GetPolygonSize(i) for i in range(lPolygonCount)]
+    if all(lSize == 3 for lSize in lSizes):
+        return lPolygonVertices, list(range(lPolygonCount)), list(range(lPolygonCount * 3))
+
+    lSizes = np.array(lSizes, dtype = np.int64)
+    lStarts = np.cumsum(lSizes) - lSizes
+    lPositions = np.array([[p[0], p[1], p[2]] for p in pPositions], dtype = np.float64)
+    lP = lPositions[np.array(lPolygonVertices, dtype = np.int64)]
+    lCornerPolygons = np.repeat(np.arange(lPolygonCount), lSizes)
+    lIndexInPolygon = np.arange(len(lP)) - lStarts[lCornerPolygons]
+    lCornerSizes = lSizes[lCornerPolygons]
+    lNext = lStarts[lCornerPolygons] + (lIndexInPolygon + 1) % lCornerSizes
+    lPrev = lStarts[lCornerPolygons] + (lIndexInPolygon - 1) % lCornerSizes
+
+    # Newell normal
+    lCross = np.cross(lP, lP[lNext])
+    lNormals = np.stack([np.bincount(lCornerPolygons, lCross[:, k], lPolygonCount) for k in range(3)], axis = 1)
+    lTurns = np.einsum('ij,ij->i', np.cross(lP - lP[lPrev], lP[lNext] - lP), lNormals[lCornerPolygons])
+    lConcave = (np.bincount(lCornerPolygons, lTurns < 0, lPolygonCount) > 0) & (lSizes > 3)
+
+    lFan = np.flatnonzero(~lConcave & (lSizes >= 3))
+    lFanCounts = lSizes[lFan] - 2
+    lTrianglePolygons = np.repeat(lFan, lFanCounts)
+    lFanStarts = lStarts[lTrianglePolygons]
+    k = np.arange(len(lTrianglePolygons)) - np.repeat(np.cumsum(lFanCounts) - lFanCounts, lFanCounts) + 1
+    lTriangleCorners = np.stack([lFanStarts, lFanStarts + k, lFanStarts + k + 1], axis = 1)
+
+    lConcavePolygons = []
+    lConcaveCorners = []
+    for lPolygonIdx in np.flatnonzero(lConcave).tolist():
+        lStart = lStarts[lPolygonIdx]
+        lPoints = lP[lStart:lStart + lSizes[lPolygonIdx]]
+        # Project to the plane so the polygon is counter clockwise.
+        lNormal = lNormals[lPolygonIdx:lPolygonIdx + 1]
+        lU = GetPerpendicular(lNormal)[0]
+        lV = np.cross(lNormal[0], lU)
+        for lTriangle in EarClipPolygon(np.stack([lPoints.dot(lU), lPoints.dot(lV)], axis = 1).tolist()):
+            lConcavePolygons.append(lPolygonIdx)
+            lConcaveCorners.append([lStart + c for c in lTriangle])
+    if len(lConcavePolygons) > 0:
+        lTrianglePolygons = np.concatenate([lTrianglePolygons, lConcavePolygons])
+        lTriangleCorners = np.concatenate([lTriangleCorners, np.array(lConcaveCorners, dtype = np.int64)])
+        # Keep the order of polygons.
+        lOrder = np.argsort(lTrianglePolygons, kind = 'stable')
+        lTrianglePolygons = lTrianglePolygons[lOrder]
+        lTriangleCorners = lTriangleCorners[lOrder]
+    return lPolygonVertices, lTrianglePolygons.tolist(), lTriangleCorners.ravel().tolist()
+
+# Smooth normals of each triangle corner for meshes without normals. Needs NumPy.
+# Face normals are weighted by the area and the corner angle, and only averaged in the same smoothing group.
+def GenerateMeshNormals(pMesh, pPositions, pPolygonVertices, pTrianglePolygons, pTriangleCorners):
+    lPolygonCount = pMesh.GetPolygonCount()
+    lPositions = np.array([[p[0], p[1], p[2]] for p in pPositions], dtype = np.float64)
+    lTriangles = np.array(pPolygonVertices, dtype = np.int64)[np.array(pTriangleCorners, dtype = np.int64)].reshape(-1, 3)
+
+    lP = lPositions[lTriangles]
+    # Length of cross product is two times of the area.
+    lFaceNormals = np.cross(lP[:, 1] - lP[:, 0], lP[:, 2] - lP[:, 0])
+    lAngles = np.empty(lTriangles.shape)
+    for k in range(3):
+        a = lP[:, (k + 1) % 3] - lP[:, k]
+        b = lP[:, (k + 2) % 3] - lP[:, k]
+        lAngles[:, k] = np.arctan2(np.linalg.norm(np.cross(a, b), axis = 1), np.einsum('ij,ij->i', a, b))
+
+    # Smoothing groups are bit masks, faces sharing any bit are smoothed together.
+    lSmoothingGroups = GetPolygonSmoothingGroups(pMesh)
+    if lSmoothingGroups == None:
+        lGroups = np.ones(lPolygonCount, dtype = np.int64)
+    else:
+        lGroups = np.array(lSmoothingGroups, dtype = np.int64)
+        # Polygons not smoothed have a group of their own.
+        lFlat = lGroups == 0
+        lGroups[lFlat] = -1 - np.nonzero(lFlat)[0]
+    lCornerKeys = np.stack([lTriangles.ravel(), np.repeat(lGroups[np.array(pTrianglePolygons, dtype = np.int64)], 3)], axis = 1)
+    lKeys, lCornerBins = np.unique(lCornerKeys, axis = 0, return_inverse = True)
+    lCornerBins = lCornerBins.ravel()
+
+    lBinNormals = np.zeros((len(lKeys), 3))
+    np.add.at(lBinNormals, lCornerBins, (lFaceNormals[:, None, :] * lAngles[:, :, None]).reshape(-1, 3))
+
+    # Bins are sorted by vertex. Normal of each bin sums the bins of the same vertex with overlapping masks.
+    lBinVertices = lKeys[:, 0]
+    lBinMasks = lKeys[:, 1]
+    lVertexStarts = np.searchsorted(lBinVertices, lBinVertices, 'left')
+    lVertexCounts = np.searchsorted(lBinVertices, lBinVertices, 'right') - lVertexStarts
+    lPairI = np.repeat(np.arange(len(lKeys)), lVertexCounts)
+    lPairJ = lVertexStarts[lPairI] + np.arange(len(lPairI)) - np.repeat(np.cumsum(lVertexCounts) - lVertexCounts, lVertexCounts)
+    lMaskI = lBinMasks[lPairI]
+    lMaskJ = lBinMasks[lPairJ]
+    lOverlap = (lPairI == lPairJ) | ((lMaskI > 0) & (lMaskJ > 0) & ((lMaskI & lMaskJ) != 0))
+    lPairI = lPairI[lOverlap]
+    lPairJ = lPairJ[lOverlap]
+    lNormals = np.stack([np.bincount(lPairI, lBinNormals[lPairJ, k], len(lKeys)) for k in range(3)], axis = 1)
+    lNormals /= np.maximum(np.linalg.norm(lNormals, axis = 1, keepdims = True), 1e-12)
+    return lNormals[lCornerBins].tolist()
+
+# Mesh simplification of the LOD levels. Needs NumPy.
+# Vertices are collapsed into one of their neighbours by the quadric error metrics. No new vertex is created,
+# so the kept vertices keep all their attributes including skin weights. Vertices on the borders and on the
+# seams of normals, texcoords and colors are locked.
+_lodMaxPasses = 1000
+_lodChunkSize = 1 << 18
+
+def EvaluateQuadrics(pQuadrics, pIndices, pPoints):
+    lErrors = np.empty(len(pIndices))
+    for i in range(0, len(pIndices), _lodChunkSize):
+        lPoints = pPoints[i:i + _lodChunkSize]
+        lErrors[i:i + _lodChunkSize] = np.einsum('ij,ijk,ik->i', lPoints, pQuadrics[pIndices[i:i + _lodChunkSize]], lPoints)
+    return lErrors
+
+def GetTriangleNormals(pPositions, pTriangles):
+    lP = pPositions[pTriangles]
+    return np.cross(lP[:, 1] - lP[:, 0], lP[:, 2] - lP[:, 0])
+
+def ComputeVertexQuadrics(pPositions, pTriangles, pWelded):
+    lWeldedCount = pWelded.max() + 1
+    lNormals = GetTriangleNormals(pPositions, pTriangles)
+    lAreas = np.linalg.norm(lNormals, axis = 1)
+    lNormals /= np.maximum(lAreas, 1e-20)[:, None]
+    lPlanes = np.concatenate([lNormals, -np.einsum('ij,ij->i', lNormals, pPositions[pTriangles[:, 0]])[:, None]], axis = 1)
+    # Weighted by the area, error divided by the weight is the mean squared distance to the planes.
+    lQuadrics = lPlanes[:, :, None] * lPlanes[:, None, :] * lAreas[:, None, None]
+    lWeldedQuadrics = np.zeros((lWeldedCount, 4, 4))
+    lWeldedWeights = np.zeros(lWeldedCount)
+    for k in range(3):
+        np.add.at(lWeldedQuadrics, pWelded[pTriangles[:, k]], lQuadrics)
+        np.add.at(lWeldedWeights, pWelded[pTriangles[:, k]], lAreas)
+    return lWeldedQuadrics[pWelded], lWeldedWeights[pWelded]
+
+def GetLockedVertices(pTriangles, pWelded):
+    lWeldedCounts = np.bincount(pWelded)
+    # Seams, where vertices with different attributes share the same position.
+    lLocked = lWeldedCounts[pWelded] > 1
+    # Borders and non-manifold edges.
+    lEdges = pWelded[np.concatenate([pTriangles[:, [0, 1]], pTriangles[:, [1, 2]], pTriangles[:, [2, 0]]])]
+    lEdges.sort(axis = 1)
+    lUniqueEdges, lEdgeCounts = np.unique(lEdges, axis = 0, return_counts = True)
+    lLockedPositions = np.zeros(len(lWeldedCounts), dtype = bool)
+    lLockedPositions[lUniqueEdges[lEdgeCounts != 2].ravel()] = True
+    return lLocked | lLockedPositions[pWelded]
+
+def SimplifyTriangles(pPositions, pTriangles, pLocked, pQuadrics, pWeights, pTargetCount, pMaxError):
+    lVertexCount = len(pPositions)
+    lHomogeneous = np.concatenate([pPositions, np.ones((lVertexCount, 1))], axis = 1)
+    lAllVertices = np.arange(lVertexCount)
+    lTriangles = pTriangles
+    for lPass in range(_lodMaxPasses):
+        if len(lTriangles) <= pTargetCount:
+            break
+        # Every half edge of the triangles, collapse u to v.
+        lEdges = np.concatenate([lTriangles[:, [0, 1]], lTriangles[:, [1, 2]], lTriangles[:, [2, 0]]])
+        lCandidates = lEdges[~pLocked[lEdges[:, 0]]]
+        if len(lCandidates) == 0:
+            break
+        u = lCandidates[:, 0]
+        v = lCandidates[:, 1]
+        lSelfErrors = EvaluateQuadrics(pQuadrics, lAllVertices, lHomogeneous)
+        lCosts = (EvaluateQuadrics(pQuadrics, u, lHomogeneous[v]) + lSelfErrors[v]) / np.maximum(pWeights[u] + pWeights[v], 1e-20)
+
+        # Cheapest collapse of each vertex.
+        lOrder = np.lexsort((lCosts, u))
+        u, v, lCosts = u[lOrder], v[lOrder], lCosts[lOrder]
+        lFirst = np.ones(len(u), dtype = bool)
+        lFirst[1:] = u[1:] != u[:-1]
+        lValid = lFirst & (lCosts <= pMaxError)
+        u, v, lCosts = u[lValid], v[lValid], lCosts[lValid]
+        if len(u) == 0:
+            break
+
+        # Collapse the vertices which are the cheapest in their one ring, so no triangle is changed twice in one pass.
+        lRanks = np.full(lVertexCount, len(u), dtype = np.int64)
+        lRankOrder = np.argsort(lCosts, kind = 'stable')
+        lRanks[u[lRankOrder]] = np.arange(len(u))
+        lRingMinRanks = np.full(lVertexCount, len(u), dtype = np.int64)
+        np.minimum.at(lRingMinRanks, lEdges[:, 0], lRanks[lEdges[:, 1]])
+        np.minimum.at(lRingMinRanks, lEdges[:, 1], lRanks[lEdges[:, 0]])
+        lAccepted = lRankOrder[lRanks[u[lRankOrder]] < lRingMinRanks[u[lRankOrder]]]
+        # Each collapse removes about two triangles.
+        lAccepted = lAccepted[:max((len(lTriangles) - pTargetCount + 1) // 2, 1)]
+        lTargets = np.full(lVertexCount, -1, dtype = np.int64)
+        lTargets[u[lAccepted]] = v[lAccepted]
+
+        # Reject the collapses which flip any triangle.
+        lMoved = lTargets[lTriangles]
+        lChanged = (lMoved >= 0).any(axis = 1)
+        lOldTriangles = lTriangles[lChanged]
+        lMoved = lMoved[lChanged]
+        lNewTriangles = np.where(lMoved >= 0, lMoved, lOldTriangles)
+        lRemained = (lNewTriangles[:, 0] != lNewTriangles[:, 1]) & (lNewTriangles[:, 1] != lNewTriangles[:, 2]) \
+            & (lNewTriangles[:, 2] != lNewTriangles[:, 0])
+        lFlipped = lRemained & (np.einsum('ij,ij->i',
+            GetTriangleNormals(pPositions, lOldTriangles), GetTriangleNormals(pPositions, lNewTriangles)
+        ) <= 0)
+        lTargets[lOldTriangles[lFlipped][lMoved[lFlipped] >= 0]] = -1
+
+        lCollapsed = np.nonzero(lTargets >= 0)[0]
+        if len(lCollapsed) == 0:
+            break
+        np.add.at(pQuadrics, lTargets[lCollapsed], pQuadrics[lCollapsed])
+        np.add.at(pWeights, lTargets[lCollapsed], pWeights[lCollapsed])
+        lRemap = np.arange(lVertexCount)
+        lRemap[lCollapsed] = lTargets[lCollapsed]
+        lTriangles = lRemap[lTriangles]
+        lTriangles = lTriangles[(lTriangles[:, 0] != lTriangles[:, 1]) & (lTriangles[:, 1] != lTriangles[:, 2]) \
+            & (lTriangles[:, 2] != lTriangles[:, 0])]
+    return lTriangles
+
+# Returns the simplified copy of primitive, or None if it can't be simplified enough.
+def SimplifyPrimitive(pPrimitive, pTargetCount, pMaxError):
+    lVertexCount = len(pPrimitive['positions'])
+    lPositions = np.array([[p[0], p[1], p[2]] for p in pPrimitive['positions']], dtype = np.float64)
+    lTriangles = np.array(pPrimitive['indices'], dtype = np.int64).reshape(-1, 3)
+    if len(lTriangles) == 0:
+        return None
+    lWelded = np.unique(lPositions, axis = 0, return_inverse = True)[1].ravel()
+    lQuadrics, lWeights = ComputeVertexQuadrics(lPositions, lTriangles, lWelded)
+    lLocked = GetLockedVertices(lTriangles, lWelded)
+    lDiagonal = np.linalg.norm(lPositions.max(axis = 0) - lPositions.min(axis = 0))
+    lSimplifiedTriangles = SimplifyTriangles(
+        lPositions, lTriangles, lLocked, lQuadrics, lWeights, pTargetCount, (pMaxError * lDiagonal) ** 2
+    )
+    # Not worth another level.
+    if len(lSimplifiedTriangles) == 0 or len(lSimplifiedTriangles) > len(lTriangles) * 0.9:
+        return None
+
+    return CompactPrimitiveVertices(pPrimitive, lSimplifiedTriangles)
+
+# Copy of primitive with the triangles, and only the vertices used by them.
+def CompactPrimitiveVertices(pPrimitive, pTriangles):
+    lVertexCount = len(pPrimitive['positions'])
+    lKept = np.unique(pTriangles)
+    lRemap = np.zeros(lVertexCount, dtype = np.int64)
+    lRemap[lKept] = np.arange(len(lKept))
+    lKept = lKept.tolist()
+    lCompacted = dict(pPrimitive)
+    for lKey in ['positions', 'normals', 'tangents', 'vertexColors', 'texcoords0', 'texcoords1', 'joints', 'weights']:
+        if lKey in pPrimitive and len(pPrimitive[lKey]) == lVertexCount:
+            lList = pPrimitive[lKey]
+            lCompacted[lKey] = [lList[v] for v in lKept]
+    lCompacted['indices'] = lRemap[pTriangles].ravel().tolist()
+    return lCompacted
+
+# Remove degenerate and duplicate triangles, and the vertices not used any more. Needs NumPy.
+# Duplicate triangles have the same positions in the same winding order, triangles in the opposite
+# winding are kept as they may be used as two sided faces.
+def CleanupPrimitive(pPrimitive, pStats):
+    lPositions = np.array([[p[0], p[1], p[2]] for p in pPrimitive['positions']], dtype = np.float64)
+    lTriangles = np.array(pPrimitive['indices'], dtype = np.int64).reshape(-1, 3)
+    if len(lTriangles) == 0:
+        return pPrimitive
+    lWelded = np.unique(lPositions, axis = 0, return_inverse = True)[1].ravel()
+    lWeldedTriangles = lWelded[lTriangles]
+
+    lDiagonal = np.linalg.norm(lPositions.max(axis = 0) - lPositions.min(axis = 0))
+    lDoubleAreas = np.linalg.norm(GetTriangleNormals(lPositions, lTriangles), axis = 1)
+    lDegenerate = (lWeldedTriangles[:, 0] == lWeldedTriangles[:, 1]) | (lWeldedTriangles[:, 1] == lWeldedTriangles[:, 2]) \
+        | (lWeldedTriangles[:, 2] == lWeldedTriangles[:, 0]) | (lDoubleAreas <= 1e-12 * lDiagonal * lDiagonal)
+
+    # Rotate the smallest index to the first to compare triangles keeping the winding.
+    lFirst = lWeldedTriangles.argmin(axis = 1)
+    lRows = np.arange(len(lTriangles))
+    lKeys = np.stack([lWeldedTriangles[lRows, lFirst], lWeldedTriangles[lRows, (lFirst + 1) % 3], lWeldedTriangles[lRows, (lFirst + 2) % 3]], axis = 1)
+    lDuplicate = np.ones(len(lTriangles), dtype = bool)
+    lDuplicate[np.unique(lKeys, axis = 0, return_index = True)[1]] = False
+    lDuplicate &= ~lDegenerate
+
+    lKept = ~(lDegenerate | lDuplicate)
+    if lKept.all():
+        return pPrimitive
+    lCompacted = CompactPrimitiveVertices(pPrimitive, lTriangles[lKept])
+    pStats['degenerate'] += int(lDegenerate.sum())
+    pStats['duplicate'] += int(lDuplicate.sum())
+    pStats['vertices'] += len(pPrimitive['positions']) - len(lCompacted['positions'])
+    return lCompacted
+
+def CreateGLTFPrimitive(pPrimitive):
+    lGLTFPrimitive = {
+        'attributes': {
+            'POSITION': CreateAttributeBuffer(pPrimitive['positions'], 'f', 3)
+        },
+        'material': pPrimitive['material']
+    }
+    if len(pPrimitive['normals']) > 0:
+        lGLTFPrimitive['attributes']['NORMAL'] = CreateAttributeBuffer(pPrimitive['normals'], 'f', 3)
+    if 'tangents' in pPrimitive:
+        lGLTFPrimitive['attributes']['TANGENT'] = CreateAttributeBuffer(pPrimitive['tangents'], 'f', 4)
+    if len(pPrimitive['vertexColors']) > 0:
+        lGLTFPrimitive['attributes']['COLOR_0'] = CreateAttributeBuffer(pPrimitive['vertexColors'], 'B', 4, True)
+    if len(pPrimitive['texcoords0']) > 0:
+        lGLTFPrimitive['attributes']['TEXCOORD_0'] = CreateTexcoordBuffer(pPrimitive['texcoords0'])
+    if len(pPrimitive['texcoords1']) > 0:
+        lGLTFPrimitive['attributes']['TEXCOORD_1'] = CreateTexcoordBuffer(pPrimitive['texcoords1'])
+    if len(pPrimitive['joints']) > 0:
+        # PENDING UNSIGNED_SHORT will have bug.
+        lGLTFPrimitive['attributes']['JOINTS_0'] = CreateAttributeBuffer(pPrimitive['joints'], 'H', 4)
+        # TODO Seems most engines needs VEC4 weights.
+        lGLTFPrimitive['attributes']['WEIGHTS_0'] = CreateAttributeBuffer(pPrimitive['weights'], 'f', 4)
+
+    lGLTFPrimitive['indices'] = CreateIndicesBuffer(pPrimitive['indices'], GetIndicesType(len(pPrimitive['positions'])))
+    return lGLTFPrimitive
+
+# pLODPrimitives is the primitives list of each LOD level. None is added if the primitive is not simplified.
+def ConvertMesh(pScene, pMesh, pNode, pSkin, pClusters, pLODPrimitives = None):
     lPrimitivesList = []
     lWeights = []
     lJoints = []
@@ -740,12 +1422,17 @@ def ConvertMesh(pScene, pMesh, pNode, pSkin, pClusters):
                 ))
 
     range3 = range(3)
-    lVertexCount = 0
+    lPolygonVertices, lTrianglePolygons, lTriangleCorners = GetMeshTriangles(pMesh, lPositions)
 
     lNeedHash = False
+    lGeneratedNormals = None
     if lNormalLayer:
         if lNormalLayer.GetMappingMode() == FbxLayerElement.eByPolygonVertex:
             lNeedHash = True
+    elif ENV_GENERATE_NORMALS and not np == None:
+        # Generated before vertices are welded by the hash.
+        lGeneratedNormals = GenerateMeshNormals(pMesh, lPositions, lPolygonVertices, lTrianglePolygons, lTriangleCorners)
+        lNeedHash = True
     if lVertexColorLayer:
         if lVertexColorLayer.GetMappingMode() == FbxLayerElement.eByPolygonVertex:
             lNeedHash = True
@@ -756,15 +1443,18 @@ def ConvertMesh(pScene, pMesh, pNode, pSkin, pClusters):
         if lUv2Layer.GetMappingMode() == FbxLayerElement.eByPolygonVertex:
             lNeedHash = True
 
-    for i in range(pMesh.GetPolygonCount()):
+    for lTriangleIdx in range(len(lTrianglePolygons)):
+        i = lTrianglePolygons[lTriangleIdx]
         if lAllSameMaterial:
             lPrimitive = lPrimitivesList[0]
         else:
             lMaterialIndex = lMaterialIndices[i]
             lPrimitive = lPrimitivesList[lMaterialsPrimitivesMap[lMaterialIndex]]
-        # Mesh should be triangulated
         for j in range3:
-            lControlPointIndex = pMesh.GetPolygonVertex(i, j)
+            lCornerIdx = lTriangleIdx * 3 + j
+            # Index of polygon vertex, used by the layers mapped by polygon vertex.
+            lVertexCount = lTriangleCorners[lCornerIdx]
+            lControlPointIndex = lPolygonVertices[lVertexCount]
             if lNeedHash:
                 vertexKeyList = []
                 vertexKeyList += lPositions[lControlPointIndex]
@@ -772,6 +1462,9 @@ def ConvertMesh(pScene, pMesh, pNode, pSkin, pClusters):
                 lNormal = GetVertexAttribute(lNormalLayer, lControlPointIndex, lVertexCount)
                 if lNeedHash:
                     vertexKeyList += lNormal
+            elif not lGeneratedNormals == None:
+                lNormal = lGeneratedNormals[lCornerIdx]
+                vertexKeyList += lNormal
             if lVertexColorLayer:
                 lVertexColor = GetVertexAttribute(lVertexColorLayer, lControlPointIndex, lVertexCount)
                 lVertexColor = [lVertexColor.mRed, lVertexColor.mGreen, lVertexColor.mBlue, lVertexColor.mAlpha]
@@ -788,8 +1481,6 @@ def ConvertMesh(pScene, pMesh, pNode, pSkin, pClusters):
                 if lNeedHash:
                     vertexKeyList += lUv2
 
-            lVertexCount += 1
-
             if lNeedHash:
                 vertexKey = tuple(vertexKeyList)
             else:
@@ -798,7 +1489,7 @@ def ConvertMesh(pScene, pMesh, pNode, pSkin, pClusters):
             if not vertexKey in lPrimitive['indicesMap']:
                 lIndex = len(lPrimitive['positions'])
                 lPrimitive['positions'].append(lPositions[lControlPointIndex])
-                if lNormalLayer and lNormal: # incase unsupported mapping mode returns none.
+                if (lNormalLayer or not lGeneratedNormals == None) and lNormal: # incase unsupported mapping mode returns none.
                     lPrimitive['normals'].append(lNormal)
                 if lVertexColorLayer and lVertexColor: # incase unsupported mapping mode returns none.
                     lPrimitive['vertexColors'].append(lVertexColor)
@@ -830,47 +1521,46 @@ def ConvertMesh(pScene, pMesh, pNode, pSkin, pClusters):
 
 
     lGLTFPrimitivesList = []
+    lCleanupStats = {'degenerate': 0, 'duplicate': 0, 'vertices': 0}
     for i in range(len(lPrimitivesList)):
         lPrimitive = lPrimitivesList[i]
-        lGLTFPrimitive = {
-            'attributes': {
-                'POSITION': CreateAttributeBuffer(lPrimitive['positions'], 'f', 3)
-            },
-            'material': lPrimitive['material']
-        }
-        if len(lPrimitive['normals']) > 0:
-            lGLTFPrimitive['attributes']['NORMAL'] = CreateAttributeBuffer(lPrimitive['normals'], 'f', 3)
-        if len(lPrimitive['vertexColors']) > 0:
-            lGLTFPrimitive['attributes']['COLOR_0'] = CreateAttributeBuffer(lPrimitive['vertexColors'], 'B', 4, True)
+        if ENV_CLEANUP and not np == None:
+            lPrimitive = CleanupPrimitive(lPrimitive, lCleanupStats)
+            if len(lPrimitive['indices']) == 0:
+                continue
         if len(lPrimitive['texcoords0']) > 0:
             ProcessUV(
                 lPrimitive['texcoords0'],
                 lPrimitive['scaleU'], lPrimitive['scaleV'],
                 lPrimitive['translationU'], lPrimitive['translationV']
             )
-            lGLTFPrimitive['attributes']['TEXCOORD_0'] = CreateAttributeBuffer(lPrimitive['texcoords0'], 'f', 2)
         if len(lPrimitive['texcoords1']) > 0:
             ProcessUV(
                 lPrimitive['texcoords1'],
                 lPrimitive['scaleU'], lPrimitive['scaleV'],
                 lPrimitive['translationU'], lPrimitive['translationV']
             )
-            lGLTFPrimitive['attributes']['TEXCOORD_1'] = CreateAttributeBuffer(lPrimitive['texcoords1'], 'f', 2)
-        if len(lPrimitive['joints']) > 0:
-            # PENDING UNSIGNED_SHORT will have bug.
-            lGLTFPrimitive['attributes']['JOINTS_0'] = CreateAttributeBuffer(lPrimitive['joints'], 'H', 4)
-            # TODO Seems most engines needs VEC4 weights.
-            lGLTFPrimitive['attributes']['WEIGHTS_0'] = CreateAttributeBuffer(lPrimitive['weights'], 'f', 4)
-
-        if len(lPrimitive['positions']) >= 0xffff:
-            #Use unsigned int in element indices
-            lIndicesType = 'I'
-        else:
-            lIndicesType = 'H'
-        lGLTFPrimitive['indices'] = CreateIndicesBuffer(lPrimitive['indices'], lIndicesType)
-
-        lGLTFPrimitivesList.append(lGLTFPrimitive)
+        # Tangents are computed in the final texcoords space.
+        if ENV_TANGENTS and not np == None and NeedTangents(lPrimitive):
+            ComputePrimitiveTangents(lPrimitive)
+
+        lGLTFPrimitivesList.append(CreateGLTFPrimitive(lPrimitive))
+
+        if not pLODPrimitives == None:
+            lTriangleCount = len(lPrimitive['indices']) // 3
+            lLODPrimitive = lPrimitive
+            for lLevel in range(len(pLODPrimitives)):
+                lSimplified = SimplifyPrimitive(lLODPrimitive, int(lTriangleCount * ENV_LOD_RATIOS[lLevel]), ENV_LOD_ERROR)
+                if lSimplified == None:
+                    pLODPrimitives[lLevel].append(None)
+                else:
+                    lLODPrimitive = lSimplified
+                    pLODPrimitives[lLevel].append(CreateGLTFPrimitive(lLODPrimitive))
 
+    if lCleanupStats['degenerate'] > 0 or lCleanupStats['duplicate'] > 0:
+        print('Cleanup mesh %s: removed %d degenerate triangles, %d duplicate triangles and %d unused vertices.' % (
+            pNode.GetName(), lCleanupStats['degenerate'], lCleanupStats['duplicate'], lCleanupStats['vertices']
+        ))
     return lGLTFPrimitivesList
 
 def ConvertCamera(pCamera):
@@ -897,6 +1587,131 @@ def ConvertCamera(pCamera):
     lib_cameras.append(lGLTFCamera)
     return lCameraIdx
 
+# TRS of nodes which keep matrix, in case they are animated.
+_nodeTRSMap = {}
+
+def ConvertNodeTransform(pGLTFNode, pNodeIdx, pTransform):
+    lTranslation = list(pTransform.GetT())[0:3]
+    lRotation = list(pTransform.GetQ())
+    lScale = list(pTransform.GetS())[0:3]
+
+    lMatrix = ListFromM4(pTransform)
+    lTRSMatrix = FbxAMatrix()
+    lTRSMatrix.SetTQS(pTransform.GetT(), pTransform.GetQ(), pTransform.GetS())
+    if not M4Same(ListFromM4(lTRSMatrix), lMatrix, EPSILON):
+        # Decomposition is not exact if transform has shear.
+        pGLTFNode['matrix'] = lMatrix
+        _nodeTRSMap[pNodeIdx] = (lTranslation, lRotation, lScale)
+        return
+
+    # Identity transform can be skipped
+    if not V3Same(lTranslation, [0, 0, 0]):
+        pGLTFNode['translation'] = lTranslation
+    if not ChannelValueSame(lRotation, [0, 0, 0, 1], 4, EPSILON):
+        pGLTFNode['rotation'] = lRotation
+    if not V3Same(lScale, [1, 1, 1]):
+        pGLTFNode['scale'] = lScale
+
+def ReplaceAnimatedNodesMatrix():
+    # Matrix is not allowed on the animated nodes.
+    for lGLTFAnimation in lib_animations:
+        for lChannel in lGLTFAnimation['channels']:
+            lNodeIdx = lChannel['target']['node']
+            if not lNodeIdx in _nodeTRSMap:
+                continue
+            lGLTFNode = lib_nodes[lNodeIdx]
+            if 'matrix' in lGLTFNode:
+                print('Shear in transform of animated node %s is ignored.' % lGLTFNode['name'])
+                del lGLTFNode['matrix']
+                lGLTFNode['translation'], lGLTFNode['rotation'], lGLTFNode['scale'] = _nodeTRSMap[lNodeIdx]
+
+# LOD meshes and screen coverages of each mesh.
+_meshLODs = {}
+
+# Minimum screen coverage of the base mesh and each LOD level.
+def GetLODCoverages():
+    if len(ENV_LOD_COVERAGE) == len(ENV_LOD_RATIOS) + 1:
+        return ENV_LOD_COVERAGE
+    # Switch to next level when it has enough triangles to cover the screen.
+    return [lRatio * 0.5 for lRatio in ENV_LOD_RATIOS] + [0]
+
+def CopyGLTFPrimitive(pGLTFPrimitive):
+    lGLTFPrimitive = dict(pGLTFPrimitive)
+    lGLTFPrimitive['attributes'] = dict(pGLTFPrimitive['attributes'])
+    return lGLTFPrimitive
+
+def CreateLODMeshes(pMeshIdx, pLODPrimitives):
+    lGLTFMesh = lib_meshes[pMeshIdx]
+    lCoverages = GetLODCoverages()
+    lPrimitives = lGLTFMesh['primitives']
+    lLODMeshes = []
+    lScreenCoverage = [lCoverages[0]]
+    for lLevel in range(len(pLODPrimitives)):
+        lLevelPrimitives = pLODPrimitives[lLevel]
+        if all(lGLTFPrimitive == None for lGLTFPrimitive in lLevelPrimitives):
+            # Previous level is used instead.
+            lScreenCoverage[-1] = lCoverages[lLevel + 1]
+            continue
+        # Primitives not simplified in this level are the same with previous level.
+        lPrimitives = [
+            CopyGLTFPrimitive(lPrimitives[i]) if lLevelPrimitives[i] == None else lLevelPrimitives[i]
+            for i in range(len(lLevelPrimitives))
+        ]
+        lLODMeshes.append(len(lib_meshes))
+        lib_meshes.append({
+            'name': lGLTFMesh['name'] + '_LOD' + str(lLevel + 1),
+            'primitives': lPrimitives
+        })
+        lScreenCoverage.append(lCoverages[lLevel + 1])
+    if len(lLODMeshes) > 0:
+        _meshLODs[pMeshIdx] = (lLODMeshes, lScreenCoverage)
+
+def GetLODNodes(pGLTFNode):
+    return pGLTFNode.get('extensions', {}).get('MSFT_lod', {}).get('ids', [])
+
+# LOD nodes are not in the scene hierarchy. They are referenced by the MSFT_lod extension of base node
+# and replace it in the runtime, so they copy the transform, skin and animation of the base node.
+def CreateLODNodes():
+    lNodeCount = len(lib_nodes)
+    for lNodeIdx in range(lNodeCount):
+        lGLTFNode = lib_nodes[lNodeIdx]
+        if not 'mesh' in lGLTFNode or not lGLTFNode['mesh'] in _meshLODs:
+            continue
+        lLODMeshes, lScreenCoverage = _meshLODs[lGLTFNode['mesh']]
+        lIds = []
+        for lLevel in range(len(lLODMeshes)):
+            lLODNode = {
+                'name': lGLTFNode['name'] + '_LOD' + str(lLevel + 1),
+                'mesh': lLODMeshes[lLevel]
+            }
+            for lKey in ['matrix', 'translation', 'rotation', 'scale']:
+                if lKey in lGLTFNode:
+                    lLODNode[lKey] = list(lGLTFNode[lKey])
+            if 'skin' in lGLTFNode:
+                lLODNode['skin'] = lGLTFNode['skin']
+            lIds.append(len(lib_nodes))
+            lib_nodes.append(lLODNode)
+        lGLTFNode['extensions'] = {
+            'MSFT_lod': {'ids': lIds}
+        }
+        lGLTFNode['extras'] = {
+            'MSFT_screencoverage': lScreenCoverage
+        }
+        for lGLTFAnimation in lib_animations:
+            for lChannel in list(lGLTFAnimation['channels']):
+                if lChannel['target']['node'] == lNodeIdx:
+                    for lId in lIds:
+                        lGLTFAnimation['channels'].append({
+                            'sampler': lChannel['sampler'],
+                            'target': {
+                                'node': lId,
+                                'path': lChannel['target']['path']
+                            }
+                        })
+    if len(lib_nodes) > lNodeCount:
+        UseExtension('MSFT_lod')
+    print('Created LOD levels of %d meshes.' % len(_meshLODs))
+
 def ConvertSceneNode(pScene, pNode, pPoseTime):
     lGLTFNode = {}
     lNodeName = pNode.GetName()
@@ -904,8 +1719,8 @@ def ConvertSceneNode(pScene, pNode, pPoseTime):
 
     lib_nodes.append(lGLTFNode)
 
-    # Transform matrix
-    lGLTFNode['matrix'] = ListFromM4(pNode.EvaluateLocalTransform(pPoseTime, FbxNode.eDestinationPivot))
+    # Transform
+    ConvertNodeTransform(lGLTFNode, GetNodeIdx(pNode), pNode.EvaluateLocalTransform(pPoseTime, FbxNode.eDestinationPivot))
 
     #PENDING : Triangulate and split all geometry not only the default one ?
     #PENDING : Multiple node use the same mesh ?
@@ -926,40 +1741,29 @@ def ConvertSceneNode(pScene, pNode, pPoseTime):
         lClusters = {}
 
         if lHasSkin:
-            lSkinIdx = CreateSkin()
+            # Meshes of one character split into multiple nodes are usually bound to
+            # the same joints with the same bind pose. Share the skin between them so
+            # joint matrices only need to be computed once.
+            lJoints = GetSkinClusters(pNode, lClusters)
+            lSkinIdx = CreateSharedSkin(lJoints, GetInverseBindMatrices(lJoints, lClusters))
             lGLTFSkin = lib_skins[lSkinIdx]
             lGLTFNode['skin'] = lSkinIdx
 
+        lLODPrimitives = None
+        if len(ENV_LOD_RATIOS) > 0 and not np == None:
+            lLODPrimitives = [[] for lRatio in ENV_LOD_RATIOS]
+
         if lMesh.GetLayer(0):
             for i in range(pNode.GetNodeAttributeCount()):
                 lNodeAttribute = pNode.GetNodeAttributeByIndex(i)
                 if lNodeAttribute.GetAttributeType() == FbxNodeAttribute.eMesh:
-                    lGLTFMesh['primitives'] += ConvertMesh(pScene, lNodeAttribute, pNode, lGLTFSkin, lClusters)
+                    lGLTFMesh['primitives'] += ConvertMesh(pScene, lNodeAttribute, pNode, lGLTFSkin, lClusters, lLODPrimitives)
 
             lMeshIdx = len(lib_meshes)
             lib_meshes.append(lGLTFMesh)
             lGLTFNode['mesh'] = lMeshIdx
-
-        if lHasSkin:
-            lClusterGlobalInitMatrix = FbxAMatrix()
-            lReferenceGlobalInitMatrix = FbxAMatrix()
-
-            lIBM = []
-            for i in range(len(lGLTFSkin['joints'])):
-                lJointIdx = lGLTFSkin['joints'][i]
-                lCluster = lClusters[lJointIdx]
-
-                # Inverse Bind Pose Matrix
-                # Matrix of Mesh
-                lCluster.GetTransformMatrix(lReferenceGlobalInitMatrix)
-                # Matrix of Joint
-                lCluster.GetTransformLinkMatrix(lClusterGlobalInitMatrix)
-                # http://blog.csdn.net/bugrunner/article/details/7232291
-                # http://help.autodesk.com/view/FBX/2017/ENU/?guid=__cpp_ref__view_scene_2_draw_scene_8cxx_example_html
-                m = lClusterGlobalInitMatrix.Inverse() * lReferenceGlobalInitMatrix
-                lIBM.append(m)
-
-            lGLTFSkin['inverseBindMatrices'] = CreateIBMBuffer(lIBM)
+            if not lLODPrimitives == None:
+                CreateLODMeshes(lMeshIdx, lLODPrimitives)
 
     elif pNode.GetCamera():
         # Camera attribute
@@ -1096,8 +1900,87 @@ def FitLinearInterpolation(pTime, pTranslationChannel, pRotationChannel, pScaleC
 
     return lTime, lTranslationChannel, lRotationChannel, lScaleChannel
 
+def ChannelValueSame(a, b, pSize, pEpsilon):
+    lSame = True
+    for i in range(pSize):
+        if abs(a[i] - b[i]) > pEpsilon:
+            lSame = False
+            break
+    if not lSame and pSize == 4:
+        # q and -q are the same rotation
+        lSame = True
+        for i in range(pSize):
+            if abs(a[i] + b[i]) > pEpsilon:
+                lSame = False
+                break
+    return lSame
+
+def IsChannelConstant(pChannel, pSize, pEpsilon):
+    for item in pChannel:
+        if not ChannelValueSame(item, pChannel[0], pSize, pEpsilon):
+            return False
+    return True
+
+_animationChannelStats = {
+    'removed': 0,
+    'collapsed': 0
+}
+
+def AddAnimationChannel(pGLTFAnimation, pNodeIdx, pPath, pTimeAccessorIdx, pOutputAccessorIdx):
+    lSamplerIdx = len(pGLTFAnimation['samplers'])
+    pGLTFAnimation['samplers'].append({
+        "input": pTimeAccessorIdx,
+        "interpolation": "LINEAR",
+        "output": pOutputAccessorIdx
+    })
+    pGLTFAnimation['channels'].append({
+        "sampler" : lSamplerIdx,
+        "target" : {
+            "node": pNodeIdx,
+            "path" : pPath
+        }
+    })
+
+# Max quantization error of rotation
+_animationQuantizeErrors = {
+    'rotation': 0
+}
+
+# Key of time channel sampled on the uniform grid, so channels on the same grid share one accessor
+# even if the times differ by the float error.
+def GetTimeChannelKey(pTimeChannel, pSampleRate):
+    lStartFrame = int(round(pTimeChannel[0] / pSampleRate))
+    for i in range(len(pTimeChannel)):
+        if abs((lStartFrame + i) * pSampleRate - pTimeChannel[i]) > EPSILON:
+            return tuple(pTimeChannel)
+    return (lStartFrame, len(pTimeChannel))
+
+def CreateTimeAnimationBuffer(pTimeChannel, pSampleRate):
+    # Time input must be float in glTF 2.0
+    lTimeAccessorKey = GetTimeChannelKey(pTimeChannel, pSampleRate)
+    if not lTimeAccessorKey in _timeSamplerHashMap:
+        _timeSamplerHashMap[lTimeAccessorKey] = CreateAnimationBuffer(pTimeChannel, 'f', 1)
+    return _timeSamplerHashMap[lTimeAccessorKey]
+
+def CreateAnimationOutputBuffer(pChannel, pPath):
+    if pPath == 'rotation':
+        if not ENV_QUANTIZE_ANIMATION:
+            return CreateAnimationBuffer(pChannel, 'f', 4)
+        # Rotation can be normalized short in glTF2.0 animation sampler output.
+        lShortChannel = []
+        for q in pChannel:
+            lShortQuat = [int(round(min(max(q[i], -1.0), 1.0) * 32767.0)) for i in range(4)]
+            for i in range(4):
+                _animationQuantizeErrors['rotation'] = max(
+                    _animationQuantizeErrors['rotation'], abs(lShortQuat[i] / 32767.0 - q[i])
+                )
+            lShortChannel.append(lShortQuat)
+        return CreateAnimationBuffer(lShortChannel, 'h', 4, False, True)
+    else:
+        # Translation and scale can only be float without a required extension.
+        return CreateAnimationBuffer(pChannel, 'f', 3)
 
-def ConvertNodeAnimation(pGLTFAnimation, pAnimLayer, pNode, pSampleRate, pStartTime, pDuration):
+def ConvertNodeAnimation(pGLTFAnimation, pAnimLayer, pNode, pSampleRate, pStartTime, pDuration, pPoseTime):
     lNodeIdx = GetNodeIdx(pNode)
 
     curves = [
@@ -1165,54 +2048,67 @@ def ConvertNodeAnimation(pGLTFAnimation, pAnimLayer, pNode, pSampleRate, pStartT
             if lHaveScaling:
                 lScaleChannel.append(list(lScale))
 
+        # Rigs usually have keys on every attribute of every joint. Channels that never
+        # move are removed if they equal to the static transform of node,
+        # or collapsed to one keyframe if not.
+        lConstantChannels = {}
+        if ENV_ANIMATION_TOLERANCE >= 0 and len(lTimeChannel) > 0:
+            lRestTransform = pNode.EvaluateLocalTransform(pPoseTime, FbxNode.eDestinationPivot)
+            if lHaveTranslation and IsChannelConstant(lTranslationChannel, 3, ENV_ANIMATION_TOLERANCE):
+                if ChannelValueSame(lTranslationChannel[0], list(lRestTransform.GetT()), 3, ENV_ANIMATION_TOLERANCE):
+                    _animationChannelStats['removed'] += 1
+                else:
+                    lConstantChannels['translation'] = lTranslationChannel[0]
+                lHaveTranslation = False
+                lTranslationChannel = []
+            if lHaveRotation and IsChannelConstant(lRotationChannel, 4, ENV_ANIMATION_TOLERANCE):
+                if ChannelValueSame(lRotationChannel[0], list(lRestTransform.GetQ()), 4, ENV_ANIMATION_TOLERANCE):
+                    _animationChannelStats['removed'] += 1
+                else:
+                    lConstantChannels['rotation'] = lRotationChannel[0]
+                lHaveRotation = False
+                lRotationChannel = []
+            if lHaveScaling and IsChannelConstant(lScaleChannel, 3, ENV_ANIMATION_TOLERANCE):
+                if ChannelValueSame(lScaleChannel[0], list(lRestTransform.GetS()), 3, ENV_ANIMATION_TOLERANCE):
+                    _animationChannelStats['removed'] += 1
+                else:
+                    lConstantChannels['scale'] = lScaleChannel[0]
+                lHaveScaling = False
+                lScaleChannel = []
+
+        for path in _samplerChannels:
+            if path in lConstantChannels:
+                _animationChannelStats['collapsed'] += 1
+                AddAnimationChannel(
+                    pGLTFAnimation, lNodeIdx, path,
+                    CreateTimeAnimationBuffer([lTimeChannel[0]], pSampleRate),
+                    CreateAnimationOutputBuffer([lConstantChannels[path]], path)
+                )
+
+    if lDuration > 0 and (lHaveTranslation or lHaveRotation or lHaveScaling):
         lTimeChannel, lTranslationChannel, lRotationChannel, lScaleChannel = FitLinearInterpolation(
             lTimeChannel, lTranslationChannel, lRotationChannel, lScaleChannel
         )
 
-        # TODO Performance?
-        lTimeAccessorKey = tuple(lTimeChannel)
-        if not lTimeAccessorKey in _timeSamplerHashMap:
-            # TODO use ubyte.
-            _timeSamplerHashMap[lTimeAccessorKey] = CreateAnimationBuffer(lTimeChannel, 'f', 1)
-
         lSamplerAccessors = {
-            "time": _timeSamplerHashMap[lTimeAccessorKey]
-            # "time": CreateAnimationBuffer(lTimeChannel, 'f', 1)
+            "time": CreateTimeAnimationBuffer(lTimeChannel, pSampleRate)
         }
         if lHaveTranslation:
-            lAccessorIdx = CreateAnimationBuffer(lTranslationChannel, 'f', 3)
-            if lAccessorIdx >= 0:
-                lSamplerAccessors['translation'] = lAccessorIdx
+            lSamplerAccessors['translation'] = CreateAnimationOutputBuffer(lTranslationChannel, 'translation')
         if lHaveRotation:
-            lAccessorIdx = CreateAnimationBuffer(lRotationChannel, 'f', 4)
-            if lAccessorIdx >= 0:
-                lSamplerAccessors['rotation'] = lAccessorIdx
+            lSamplerAccessors['rotation'] = CreateAnimationOutputBuffer(lRotationChannel, 'rotation')
         if lHaveScaling:
-            lAccessorIdx = CreateAnimationBuffer(lScaleChannel, 'f', 3)
-            if lAccessorIdx >= 0:
-                lSamplerAccessors['scale'] = lAccessorIdx
+            lSamplerAccessors['scale'] = CreateAnimationOutputBuffer(lScaleChannel, 'scale')
 
         #TODO Other interpolation methods
         for path in _samplerChannels:
             if path in lSamplerAccessors:
-                lSamplerIdx = len(pGLTFAnimation['samplers'])
-                pGLTFAnimation['samplers'].append({
-                    "input": lSamplerAccessors['time'],
-                    "interpolation": "LINEAR",
-                    "output": lSamplerAccessors[path]
-                })
-                pGLTFAnimation['channels'].append({
-                    "sampler" : lSamplerIdx,
-                    "target" : {
-                        "node": lNodeIdx,
-                        "path" : path
-                    }
-                })
+                AddAnimationChannel(pGLTFAnimation, lNodeIdx, path, lSamplerAccessors['time'], lSamplerAccessors[path])
 
     for i in range(pNode.GetChildCount()):
-        ConvertNodeAnimation(pGLTFAnimation, pAnimLayer, pNode.GetChild(i), pSampleRate, pStartTime, pDuration)
+        ConvertNodeAnimation(pGLTFAnimation, pAnimLayer, pNode.GetChild(i), pSampleRate, pStartTime, pDuration, pPoseTime)
 
-def ConvertAnimation(pScene, pSampleRate, pStartTime, pDuration):
+def ConvertAnimation(pScene, pSampleRate, pStartTime, pDuration, pPoseTime):
     lRoot = pScene.GetRootNode()
     for i in range(pScene.GetSrcObjectCount(FbxCriteria.ObjectType(FbxAnimStack.ClassId))):
         lAnimStack = pScene.GetSrcObject(FbxCriteria.ObjectType(FbxAnimStack.ClassId), i)
@@ -1220,26 +2116,1074 @@ def ConvertAnimation(pScene, pSampleRate, pStartTime, pDuration):
         for j in range(lAnimStack.GetSrcObjectCount(FbxCriteria.ObjectType(FbxAnimLayer.ClassId))):
             lAnimLayer = lAnimStack.GetSrcObject(FbxCriteria.ObjectType(FbxAnimLayer.ClassId), j)
             # for k in range(lRoot.GetChildCount()):
-            ConvertNodeAnimation(lGLTFAnimation, lAnimLayer, lRoot, pSampleRate, pStartTime, pDuration)
+            ConvertNodeAnimation(lGLTFAnimation, lAnimLayer, lRoot, pSampleRate, pStartTime, pDuration, pPoseTime)
         if len(lGLTFAnimation['samplers']) > 0:
             lib_animations.append(lGLTFAnimation)
 
+    ReplaceAnimatedNodesMatrix()
+
+    if _animationChannelStats['removed'] > 0 or _animationChannelStats['collapsed'] > 0:
+        print('Removed %d constant animation channels, collapsed %d to single keyframe.' % (
+            _animationChannelStats['removed'], _animationChannelStats['collapsed']
+        ))
+    if ENV_QUANTIZE_ANIMATION:
+        print('Animation rotation quantization max error: %g' % _animationQuantizeErrors['rotation'])
+
+
+# Matrix is in column major like glTF
+def M4Identity():
+    return [1, 0, 0, 0, 0, 1, 0, 0, 0, 0, 1, 0, 0, 0, 0, 1]
+
+def M4Mul(a, b):
+    out = [0] * 16
+    for c in range(4):
+        for r in range(4):
+            out[c * 4 + r] = a[r] * b[c * 4] + a[4 + r] * b[c * 4 + 1] + a[8 + r] * b[c * 4 + 2] + a[12 + r] * b[c * 4 + 3]
+    return out
+
+def M4FromTRS(t, q, s):
+    [x, y, z, w] = q
+    return [
+        (1 - 2 * (y * y + z * z)) * s[0], 2 * (x * y + z * w) * s[0], 2 * (x * z - y * w) * s[0], 0,
+        2 * (x * y - z * w) * s[1], (1 - 2 * (x * x + z * z)) * s[1], 2 * (y * z + x * w) * s[1], 0,
+        2 * (x * z + y * w) * s[2], 2 * (y * z - x * w) * s[2], (1 - 2 * (x * x + y * y)) * s[2], 0,
+        t[0], t[1], t[2], 1
+    ]
+
+def M4Determinant3(m):
+    return m[0] * (m[5] * m[10] - m[6] * m[9]) - m[4] * (m[1] * m[10] - m[2] * m[9]) + m[8] * (m[1] * m[6] - m[2] * m[5])
+
+# Returns translation, rotation, scale. Or None if the matrix has shear.
+def M4Decompose(m):
+    lScale = [
+        math.sqrt(m[0] * m[0] + m[1] * m[1] + m[2] * m[2]),
+        math.sqrt(m[4] * m[4] + m[5] * m[5] + m[6] * m[6]),
+        math.sqrt(m[8] * m[8] + m[9] * m[9] + m[10] * m[10])
+    ]
+    if M4Determinant3(m) < 0:
+        lScale[0] = -lScale[0]
+    if lScale[0] == 0 or lScale[1] == 0 or lScale[2] == 0:
+        return None
+    r = [m[0] / lScale[0], m[1] / lScale[0], m[2] / lScale[0],
+        m[4] / lScale[1], m[5] / lScale[1], m[6] / lScale[1],
+        m[8] / lScale[2], m[9] / lScale[2], m[10] / lScale[2]]
+    # r[c * 3 + row]
+    lTrace = r[0] + r[4] + r[8]
+    if lTrace > 0:
+        k = 0.5 / math.sqrt(lTrace + 1.0)
+        q = [(r[5] - r[7]) * k, (r[6] - r[2]) * k, (r[1] - r[3]) * k, 0.25 / k]
+    elif r[0] > r[4] and r[0] > r[8]:
+        k = 2.0 * math.sqrt(1.0 + r[0] - r[4] - r[8])
+        q = [0.25 * k, (r[3] + r[1]) / k, (r[6] + r[2]) / k, (r[5] - r[7]) / k]
+    elif r[4] > r[8]:
+        k = 2.0 * math.sqrt(1.0 + r[4] - r[0] - r[8])
+        q = [(r[3] + r[1]) / k, 0.25 * k, (r[7] + r[5]) / k, (r[6] - r[2]) / k]
+    else:
+        k = 2.0 * math.sqrt(1.0 + r[8] - r[0] - r[4])
+        q = [(r[6] + r[2]) / k, (r[7] + r[5]) / k, 0.25 * k, (r[1] - r[3]) / k]
+    lLen = math.sqrt(q[0] * q[0] + q[1] * q[1] + q[2] * q[2] + q[3] * q[3])
+    q = [q[0] / lLen, q[1] / lLen, q[2] / lLen, q[3] / lLen]
+    lTranslation = [m[12], m[13], m[14]]
+    if not M4Same(M4FromTRS(lTranslation, q, lScale), m, EPSILON):
+        return None
+    return lTranslation, q, lScale
+
+# Inverse transpose of the upper 3x3, for transforming normals.
+def M4NormalMatrix(m):
+    lDet = M4Determinant3(m)
+    if lDet == 0:
+        return None
+    # Cofactor matrix of the upper 3x3 equals to inverse transpose multiplied by determinant.
+    return [
+        (m[5] * m[10] - m[6] * m[9]) / lDet, (m[6] * m[8] - m[4] * m[10]) / lDet, (m[4] * m[9] - m[5] * m[8]) / lDet,
+        (m[2] * m[9] - m[1] * m[10]) / lDet, (m[0] * m[10] - m[2] * m[8]) / lDet, (m[1] * m[8] - m[0] * m[9]) / lDet,
+        (m[1] * m[6] - m[2] * m[5]) / lDet, (m[2] * m[4] - m[0] * m[6]) / lDet, (m[0] * m[5] - m[1] * m[4]) / lDet
+    ]
+
+def M4TransformPoint(m, v):
+    return [
+        m[0] * v[0] + m[4] * v[1] + m[8] * v[2] + m[12],
+        m[1] * v[0] + m[5] * v[1] + m[9] * v[2] + m[13],
+        m[2] * v[0] + m[6] * v[1] + m[10] * v[2] + m[14]
+    ]
+
+def M3TransformDirection(m, v):
+    x = m[0] * v[0] + m[3] * v[1] + m[6] * v[2]
+    y = m[1] * v[0] + m[4] * v[1] + m[7] * v[2]
+    z = m[2] * v[0] + m[5] * v[1] + m[8] * v[2]
+    lLen = math.sqrt(x * x + y * y + z * z)
+    if lLen > 0:
+        return [x / lLen, y / lLen, z / lLen]
+    return [x, y, z]
+
+def GetNodeMatrix(pGLTFNode):
+    if 'matrix' in pGLTFNode:
+        return pGLTFNode['matrix']
+    return M4FromTRS(
+        pGLTFNode.get('translation', [0, 0, 0]),
+        pGLTFNode.get('rotation', [0, 0, 0, 1]),
+        pGLTFNode.get('scale', [1, 1, 1])
+    )
+
+def SetNodeMatrix(pGLTFNode, pMatrix):
+    for lKey in ['matrix', 'translation', 'rotation', 'scale']:
+        if lKey in pGLTFNode:
+            del pGLTFNode[lKey]
+    lTRS = M4Decompose(pMatrix)
+    if lTRS is None:
+        pGLTFNode['matrix'] = pMatrix
+        return
+    lTranslation, lRotation, lScale = lTRS
+    if not V3Same(lTranslation, [0, 0, 0]):
+        pGLTFNode['translation'] = lTranslation
+    if not ChannelValueSame(lRotation, [0, 0, 0, 1], 4, EPSILON):
+        pGLTFNode['rotation'] = lRotation
+    if not V3Same(lScale, [1, 1, 1]):
+        pGLTFNode['scale'] = lScale
+
+def IsFloatAccessor(pAccessorIdx):
+    lAccessor = lib_accessors[pAccessorIdx]
+    return lAccessor['componentType'] == GL_FLOAT and not 'extensions' in lAccessor
+
+_transformedSemantics = ['POSITION', 'NORMAL', 'TANGENT']
+
+def TransformAttributeData(pSemantic, pList, pMatrix):
+    if pSemantic == 'POSITION':
+        return [M4TransformPoint(pMatrix, v) for v in pList]
+    elif pSemantic == 'NORMAL':
+        lNormalMatrix = M4NormalMatrix(pMatrix)
+        return [M3TransformDirection(lNormalMatrix, v) for v in pList]
+    elif pSemantic == 'TANGENT':
+        # Tangent is transformed by the matrix itself, w is the handedness
+        lMatrix3 = pMatrix[0:3] + pMatrix[4:7] + pMatrix[8:11]
+        lHandedness = 1 if M4Determinant3(pMatrix) > 0 else -1
+        return [M3TransformDirection(lMatrix3, v) + [v[3] * lHandedness] for v in pList]
+    return pList
+
+def FlipTrianglesWinding(pIndices):
+    for i in range(0, len(pIndices) - 2, 3):
+        pIndices[i + 1], pIndices[i + 2] = pIndices[i + 2], pIndices[i + 1]
+
+# Transform vertices of primitive in place. Accessors are only transformed once even if shared.
+def TransformPrimitive(pGLTFPrimitive, pMatrix, pTransformedAccessors):
+    lAttributes = pGLTFPrimitive['attributes']
+    for lSemantic in _transformedSemantics:
+        lAccessorIdx = lAttributes.get(lSemantic)
+        if lAccessorIdx is None or lAccessorIdx in pTransformedAccessors:
+            continue
+        pTransformedAccessors.add(lAccessorIdx)
+        lList = ReadAccessorData(attributeBuffer, lAccessorIdx)
+        WriteAccessorData(attributeBuffer, lAccessorIdx, TransformAttributeData(lSemantic, lList, pMatrix))
+
+    # Mirror transform will flip the winding order.
+    if M4Determinant3(pMatrix) < 0 and 'indices' in pGLTFPrimitive:
+        lIndicesIdx = pGLTFPrimitive['indices']
+        if not lIndicesIdx in pTransformedAccessors:
+            pTransformedAccessors.add(lIndicesIdx)
+            lIndices = ReadAccessorData(indicesBuffer, lIndicesIdx)
+            FlipTrianglesWinding(lIndices)
+            WriteAccessorData(indicesBuffer, lIndicesIdx, lIndices)
+
+def CanTransformPrimitiveVertices(pGLTFPrimitive):
+    for lSemantic in _transformedSemantics:
+        if lSemantic in pGLTFPrimitive['attributes'] and not IsFloatAccessor(pGLTFPrimitive['attributes'][lSemantic]):
+            return False
+    return True
+
+def CanTransformMeshVertices(pGLTFMesh):
+    return all(CanTransformPrimitiveVertices(lGLTFPrimitive) for lGLTFPrimitive in pGLTFMesh['primitives'])
+
+def GetAnimatedNodes():
+    lAnimatedNodes = set()
+    for lGLTFAnimation in lib_animations:
+        for lChannel in lGLTFAnimation['channels']:
+            lAnimatedNodes.add(lChannel['target']['node'])
+    return lAnimatedNodes
+
+def GetJointNodes():
+    lJointNodes = set()
+    for lGLTFSkin in lib_skins:
+        lJointNodes.update(lGLTFSkin['joints'])
+    return lJointNodes
+
+_flattenStats = {
+    'baked': 0,
+    'merged': 0
+}
+
+def IsStaticNode(pContext, pNodeIdx):
+    return not pNodeIdx in pContext['animatedNodes'] and not 'skin' in lib_nodes[pNodeIdx]
+
+def IsRemovableNode(pContext, pNodeIdx):
+    lGLTFNode = lib_nodes[pNodeIdx]
+    return IsStaticNode(pContext, pNodeIdx) and not pNodeIdx in pContext['jointNodes'] \
+        and not 'mesh' in lGLTFNode and not 'camera' in lGLTFNode
+
+# Static leaf mesh, which transform can be baked into the vertices.
+def IsStaticGeometryNode(pContext, pNodeIdx):
+    lGLTFNode = lib_nodes[pNodeIdx]
+    return IsStaticNode(pContext, pNodeIdx) and not pNodeIdx in pContext['jointNodes'] \
+        and 'mesh' in lGLTFNode and not 'camera' in lGLTFNode and len(lGLTFNode.get('children', [])) == 0 \
+        and len(GetLODNodes(lGLTFNode)) == 0 and CanTransformMeshVertices(lib_meshes[lGLTFNode['mesh']])
+
+def BakeNodeTransformToVertices(pContext, pNodeIdx):
+    lGLTFNode = lib_nodes[pNodeIdx]
+    lMatrix = GetNodeMatrix(lGLTFNode)
+    if M4Same(lMatrix, M4Identity(), EPSILON) or M4NormalMatrix(lMatrix) is None:
+        return
+    for lGLTFPrimitive in lib_meshes[lGLTFNode['mesh']]['primitives']:
+        TransformPrimitive(lGLTFPrimitive, lMatrix, pContext['transformedAccessors'])
+    SetNodeMatrix(lGLTFNode, M4Identity())
+    _flattenStats['baked'] += 1
+
+def MergeSiblingMeshes(pContext, pNodes):
+    if not pContext['mergeMeshes']:
+        return pNodes
+    lNewNodes = []
+    lMergeTarget = None
+    for lNodeIdx in pNodes:
+        if IsStaticGeometryNode(pContext, lNodeIdx):
+            BakeNodeTransformToVertices(pContext, lNodeIdx)
+            lGLTFNode = lib_nodes[lNodeIdx]
+            # Transform can't be baked if it's degenerated.
+            if M4Same(GetNodeMatrix(lGLTFNode), M4Identity(), EPSILON):
+                if lMergeTarget is None:
+                    lMergeTarget = lGLTFNode
+                else:
+                    lib_meshes[lMergeTarget['mesh']]['primitives'] += lib_meshes[lGLTFNode['mesh']]['primitives']
+                    lib_meshes[lGLTFNode['mesh']]['primitives'] = []
+                    _flattenStats['merged'] += 1
+                    continue
+        lNewNodes.append(lNodeIdx)
+    return lNewNodes
+
+# Returns the nodes which will replace pNodeIdx in the children of its parent.
+def FlattenSceneNode(pContext, pNodeIdx, pParentMatrix):
+    lGLTFNode = lib_nodes[pNodeIdx]
+    if pParentMatrix is not None:
+        SetNodeMatrix(lGLTFNode, M4Mul(pParentMatrix, GetNodeMatrix(lGLTFNode)))
+        for lLODNodeIdx in GetLODNodes(lGLTFNode):
+            lLODNode = lib_nodes[lLODNodeIdx]
+            SetNodeMatrix(lLODNode, M4Mul(pParentMatrix, GetNodeMatrix(lLODNode)))
+        if IsStaticGeometryNode(pContext, pNodeIdx):
+            BakeNodeTransformToVertices(pContext, pNodeIdx)
+
+    lChildren = lGLTFNode.get('children', [])
+    if IsRemovableNode(pContext, pNodeIdx):
+        lMatrix = GetNodeMatrix(lGLTFNode)
+        lIsIdentity = M4Same(lMatrix, M4Identity(), EPSILON)
+        # Transform can only be baked into the static children.
+        if lIsIdentity or all(IsStaticNode(pContext, lChildIdx) for lChildIdx in lChildren):
+            lNewChildren = []
+            for lChildIdx in lChildren:
+                lNewChildren += FlattenSceneNode(pContext, lChildIdx, None if lIsIdentity else lMatrix)
+            return lNewChildren
+
+    lNewChildren = []
+    for lChildIdx in lChildren:
+        lNewChildren += FlattenSceneNode(pContext, lChildIdx, None)
+    if len(lNewChildren) > 0:
+        lGLTFNode['children'] = MergeSiblingMeshes(pContext, lNewChildren)
+    elif 'children' in lGLTFNode:
+        del lGLTFNode['children']
+    return [pNodeIdx]
+
+def CompactNodes(pGLTFScene):
+    lNodesMap = {}
+    lNewNodes = []
+    def CollectNode(pNodeIdx):
+        lNodesMap[pNodeIdx] = len(lNewNodes)
+        lNewNodes.append(lib_nodes[pNodeIdx])
+        for lChildIdx in lib_nodes[pNodeIdx].get('children', []) + GetLODNodes(lib_nodes[pNodeIdx]):
+            CollectNode(lChildIdx)
+    for lNodeIdx in pGLTFScene['nodes']:
+        CollectNode(lNodeIdx)
+
+    for lGLTFNode in lNewNodes:
+        if 'children' in lGLTFNode:
+            lGLTFNode['children'] = [lNodesMap[lChildIdx] for lChildIdx in lGLTFNode['children']]
+        if len(GetLODNodes(lGLTFNode)) > 0:
+            lGLTFNode['extensions']['MSFT_lod']['ids'] = [lNodesMap[lNodeIdx] for lNodeIdx in GetLODNodes(lGLTFNode)]
+    pGLTFScene['nodes'] = [lNodesMap[lNodeIdx] for lNodeIdx in pGLTFScene['nodes']]
+    for lGLTFSkin in lib_skins:
+        lGLTFSkin['joints'] = [lNodesMap[lNodeIdx] for lNodeIdx in lGLTFSkin['joints']]
+    for lGLTFAnimation in lib_animations:
+        for lChannel in lGLTFAnimation['channels']:
+            lChannel['target']['node'] = lNodesMap[lChannel['target']['node']]
+    for lId in list(_nodeIdxMap.keys()):
+        if _nodeIdxMap[lId] in lNodesMap:
+            _nodeIdxMap[lId] = lNodesMap[_nodeIdxMap[lId]]
+        else:
+            del _nodeIdxMap[lId]
+    lib_nodes[:] = lNewNodes
+
+    CompactMeshes()
+
+# Remove meshes which have no primitives or are not used.
+def CompactMeshes():
+    lMeshesMap = {}
+    lNewMeshes = []
+    for lGLTFNode in lib_nodes:
+        if 'mesh' in lGLTFNode:
+            if len(lib_meshes[lGLTFNode['mesh']]['primitives']) == 0:
+                del lGLTFNode['mesh']
+                continue
+            if not lGLTFNode['mesh'] in lMeshesMap:
+                lMeshesMap[lGLTFNode['mesh']] = len(lNewMeshes)
+                lNewMeshes.append(lib_meshes[lGLTFNode['mesh']])
+            lGLTFNode['mesh'] = lMeshesMap[lGLTFNode['mesh']]
+    lib_meshes[:] = lNewMeshes
+
+def FlattenScene(pSceneIdx, pMergeMeshes):
+    lGLTFScene = lib_scenes[pSceneIdx]
+    lNodeCount = len(lib_nodes)
+    lContext = {
+        'mergeMeshes': pMergeMeshes,
+        'animatedNodes': GetAnimatedNodes(),
+        'jointNodes': GetJointNodes(),
+        'transformedAccessors': set()
+    }
+    lNewNodes = []
+    for lNodeIdx in lGLTFScene['nodes']:
+        lNewNodes += FlattenSceneNode(lContext, lNodeIdx, None)
+    lGLTFScene['nodes'] = MergeSiblingMeshes(lContext, lNewNodes)
+
+    CompactNodes(lGLTFScene)
+    print('Flatten scene: removed %d of %d nodes, baked %d transforms into vertices, merged %d meshes.' % (
+        lNodeCount - len(lib_nodes), lNodeCount, _flattenStats['baked'], _flattenStats['merged']
+    ))
+
+
+# Remove accessors not referenced any more and rebuild the buffers.
+def CompactAccessors():
+    lUsedAccessors = set()
+    for lGLTFMesh in lib_meshes:
+        for lGLTFPrimitive in lGLTFMesh['primitives']:
+            lUsedAccessors.update(lGLTFPrimitive['attributes'].values())
+            if 'indices' in lGLTFPrimitive:
+                lUsedAccessors.add(lGLTFPrimitive['indices'])
+    for lGLTFSkin in lib_skins:
+        if 'inverseBindMatrices' in lGLTFSkin:
+            lUsedAccessors.add(lGLTFSkin['inverseBindMatrices'])
+    for lGLTFAnimation in lib_animations:
+        for lSampler in lGLTFAnimation['samplers']:
+            lUsedAccessors.add(lSampler['input'])
+            lUsedAccessors.add(lSampler['output'])
+
+    lAccessorsMap = {}
+    lNewAccessors = []
+    for i in range(len(lib_accessors)):
+        if i in lUsedAccessors:
+            lAccessorsMap[i] = len(lNewAccessors)
+            lNewAccessors.append(lib_accessors[i])
+    if len(lNewAccessors) == len(lib_accessors):
+        return
+
+    lUsedAccessorIds = set(id(lAccessor) for lAccessor in lNewAccessors)
+    for lBuffer, lAccessors in [
+        (attributeBuffer, lib_attributes_accessors),
+        (indicesBuffer, lib_indices_accessors),
+        (invBindMatricesBuffer, lib_ibm_accessors),
+        (animationBuffer, lib_animation_accessors)
+    ]:
+        lNewBuffer = bytearray()
+        lNewList = []
+        for lAccessor in lAccessors:
+            if not id(lAccessor) in lUsedAccessorIds:
+                continue
+            lType = _componentTypeFormat[lAccessor['componentType']]
+            lByteLength = struct.calcsize('<' + lType) * _accessorTypeStride[lAccessor['type']] * lAccessor['count']
+            lData = lBuffer[lAccessor['byteOffset']:lAccessor['byteOffset'] + lByteLength]
+            appendToBuffer(lType, lNewBuffer, lData, lAccessor)
+            lNewList.append(lAccessor)
+        lBuffer[:] = lNewBuffer
+        lAccessors[:] = lNewList
+
+    for lGLTFMesh in lib_meshes:
+        for lGLTFPrimitive in lGLTFMesh['primitives']:
+            for lSemantic in lGLTFPrimitive['attributes']:
+                lGLTFPrimitive['attributes'][lSemantic] = lAccessorsMap[lGLTFPrimitive['attributes'][lSemantic]]
+            if 'indices' in lGLTFPrimitive:
+                lGLTFPrimitive['indices'] = lAccessorsMap[lGLTFPrimitive['indices']]
+    for lGLTFSkin in lib_skins:
+        if 'inverseBindMatrices' in lGLTFSkin:
+            lGLTFSkin['inverseBindMatrices'] = lAccessorsMap[lGLTFSkin['inverseBindMatrices']]
+    for lGLTFAnimation in lib_animations:
+        for lSampler in lGLTFAnimation['samplers']:
+            lSampler['input'] = lAccessorsMap[lSampler['input']]
+            lSampler['output'] = lAccessorsMap[lSampler['output']]
+    for lKey in list(_timeSamplerHashMap.keys()):
+        if _timeSamplerHashMap[lKey] in lAccessorsMap:
+            _timeSamplerHashMap[lKey] = lAccessorsMap[_timeSamplerHashMap[lKey]]
+        else:
+            del _timeSamplerHashMap[lKey]
+    lib_accessors[:] = lNewAccessors
+
+# World matrix of the nodes that will never move.
+def GetStaticWorldMatrices(pGLTFScene):
+    lAnimatedNodes = GetAnimatedNodes()
+    lWorldMatrices = {}
+    def TraverseNode(pNodeIdx, pParentMatrix):
+        if pNodeIdx in lAnimatedNodes:
+            return
+        lGLTFNode = lib_nodes[pNodeIdx]
+        lWorldMatrices[pNodeIdx] = M4Mul(pParentMatrix, GetNodeMatrix(lGLTFNode))
+        for lChildIdx in lGLTFNode.get('children', []):
+            TraverseNode(lChildIdx, lWorldMatrices[pNodeIdx])
+    for lNodeIdx in pGLTFScene['nodes']:
+        TraverseNode(lNodeIdx, M4Identity())
+    return lWorldMatrices
+
+def GetPrimitiveLayoutKey(pGLTFPrimitive):
+    lKey = [pGLTFPrimitive.get('material', -1)]
+    for lSemantic in sorted(pGLTFPrimitive['attributes'].keys()):
+        lAccessor = lib_accessors[pGLTFPrimitive['attributes'][lSemantic]]
+        lKey.append((lSemantic, lAccessor['componentType'], lAccessor['type'], lAccessor.get('normalized', False)))
+    return tuple(lKey)
+
+def CanBatchPrimitive(pGLTFPrimitive):
+    if not 'indices' in pGLTFPrimitive or pGLTFPrimitive.get('mode', 4) != 4:
+        return False
+    if 'JOINTS_0' in pGLTFPrimitive['attributes']:
+        return False
+    for lAccessorIdx in pGLTFPrimitive['attributes'].values():
+        if 'extensions' in lib_accessors[lAccessorIdx]:
+            return False
+    return CanTransformPrimitiveVertices(pGLTFPrimitive)
+
+def CreateBatchPrimitive(pMaterial, pItems):
+    lAttributesData = {}
+    lIndices = []
+    lVertexOffset = 0
+    for lGLTFPrimitive, lMatrix in pItems:
+        lVertexCount = 0
+        for lSemantic, lAccessorIdx in lGLTFPrimitive['attributes'].items():
+            lList = ReadAccessorData(attributeBuffer, lAccessorIdx)
+            lVertexCount = len(lList)
+            if not lSemantic in lAttributesData:
+                lAttributesData[lSemantic] = []
+            lAttributesData[lSemantic] += TransformAttributeData(lSemantic, lList, lMatrix)
+        lPrimitiveIndices = ReadAccessorData(indicesBuffer, lGLTFPrimitive['indices'])
+        if M4Determinant3(lMatrix) < 0:
+            FlipTrianglesWinding(lPrimitiveIndices)
+        lIndices += [idx + lVertexOffset for idx in lPrimitiveIndices]
+        lVertexOffset += lVertexCount
+
+    lFirstPrimitive = pItems[0][0]
+    lGLTFPrimitive = {
+        'attributes': {},
+        'material': pMaterial
+    }
+    for lSemantic, lList in lAttributesData.items():
+        lAccessor = lib_accessors[lFirstPrimitive['attributes'][lSemantic]]
+        lGLTFPrimitive['attributes'][lSemantic] = CreateAttributeBuffer(
+            lList, _componentTypeFormat[lAccessor['componentType']],
+            _accessorTypeStride[lAccessor['type']], lAccessor.get('normalized', False)
+        )
+    lGLTFPrimitive['indices'] = CreateIndicesBuffer(lIndices, GetIndicesType(lVertexOffset))
+    return lGLTFPrimitive
+
+# Merge static primitives sharing the same material into one pre-transformed primitive to reduce draw calls.
+def BatchStaticMeshes(pSceneIdx):
+    lGLTFScene = lib_scenes[pSceneIdx]
+    lWorldMatrices = GetStaticWorldMatrices(lGLTFScene)
+    lJointNodes = GetJointNodes()
+
+    lGroups = {}
+    lGroupKeys = []
+    for lNodeIdx in sorted(lWorldMatrices.keys()):
+        lGLTFNode = lib_nodes[lNodeIdx]
+        if not 'mesh' in lGLTFNode or 'skin' in lGLTFNode or lNodeIdx in lJointNodes or len(GetLODNodes(lGLTFNode)) > 0:
+            continue
+        if M4NormalMatrix(lWorldMatrices[lNodeIdx]) is None:
+            continue
+        for lGLTFPrimitive in lib_meshes[lGLTFNode['mesh']]['primitives']:
+            if not CanBatchPrimitive(lGLTFPrimitive):
+                continue
+            lKey = GetPrimitiveLayoutKey(lGLTFPrimitive)
+            if not lKey in lGroups:
+                lGroups[lKey] = []
+                lGroupKeys.append(lKey)
+            lGroups[lKey].append((lGLTFNode, lGLTFPrimitive, lWorldMatrices[lNodeIdx]))
+
+    lPrimitiveCount = 0
+    lBatchCount = 0
+    for lKey in lGroupKeys:
+        lItems = lGroups[lKey]
+        if len(lItems) < 2:
+            continue
+        lPrimitiveCount += len(lItems)
+        # Split the batches to use 16 bit indices.
+        lBatches = [[]]
+        lBatchVertexCount = 0
+        for lGLTFNode, lGLTFPrimitive, lMatrix in lItems:
+            lVertexCount = lib_accessors[lGLTFPrimitive['attributes']['POSITION']]['count']
+            if lBatchVertexCount + lVertexCount >= 0xffff and len(lBatches[-1]) > 0:
+                lBatches.append([])
+                lBatchVertexCount = 0
+            lBatches[-1].append((lGLTFPrimitive, lMatrix))
+            lBatchVertexCount += lVertexCount
+            lib_meshes[lGLTFNode['mesh']]['primitives'].remove(lGLTFPrimitive)
+
+        lMaterial = lKey[0]
+        lMaterialName = lib_materials[lMaterial]['name'] if lMaterial >= 0 else ''
+        for lBatch in lBatches:
+            lMeshIdx = len(lib_meshes)
+            lib_meshes.append({
+                'name': 'Batch_' + lMaterialName,
+                'primitives': [CreateBatchPrimitive(lMaterial, lBatch)]
+            })
+            lGLTFScene['nodes'].append(len(lib_nodes))
+            lib_nodes.append({
+                'name': 'Batch_' + lMaterialName + '_' + str(lBatchCount),
+                'mesh': lMeshIdx
+            })
+            lBatchCount += 1
+
+    for lGLTFNode in lib_nodes:
+        if 'mesh' in lGLTFNode and len(lib_meshes[lGLTFNode['mesh']]['primitives']) == 0:
+            del lGLTFNode['mesh']
+    CompactMeshes()
+    CompactAccessors()
+    print('Batched %d static primitives into %d draw calls.' % (lPrimitiveCount, lBatchCount))
+
+
+# Split large primitives into spatially coherent clusters, so the runtime can cull them separately. Needs NumPy.
+# Bounding box, bounding sphere and normal cone of each cluster are written in the extras of primitive.
+def DecodeAccessorData(pAccessorIdx, pList):
+    lAccessor = lib_accessors[pAccessorIdx]
+    lQuantized = lAccessor.get('extensions', {}).get('WEB3D_quantized_attributes')
+    if lQuantized == None:
+        return pList
+    lStride = _accessorTypeStride[lAccessor['type']]
+    lDecodeMatrix = lQuantized['decodeMatrix']
+    # Decode matrix only has scale and translation.
+    lScale = [lDecodeMatrix[i * (lStride + 2)] for i in range(lStride)]
+    lOffset = lDecodeMatrix[lStride * (lStride + 1):lStride * (lStride + 2)]
+    lDecoded = np.array(pList, dtype = np.float64).reshape(-1, lStride) * lScale + lOffset
+    return lDecoded.ravel().tolist() if lStride == 1 else lDecoded.tolist()
+
+def IsQuantizedAccessor(pAccessorIdx):
+    return 'WEB3D_quantized_attributes' in lib_accessors[pAccessorIdx].get('extensions', {})
+
+# Bounds of skinned primitives are only valid in the bind pose, so they are not clustered.
+def CanClusterPrimitive(pGLTFPrimitive, pMaxTriangles):
+    return 'indices' in pGLTFPrimitive and pGLTFPrimitive.get('mode', 4) == 4 \
+        and 'POSITION' in pGLTFPrimitive['attributes'] and not 'JOINTS_0' in pGLTFPrimitive['attributes'] \
+        and lib_accessors[pGLTFPrimitive['indices']]['count'] > pMaxTriangles * 3
+
+# Split the triangles by the median of centroids along the longest axis, returns triangles of each cluster.
+def PartitionTriangles(pCentroids, pMaxTriangles):
+    lClusters = []
+    lStack = [np.arange(len(pCentroids))]
+    while len(lStack) > 0:
+        lTriangles = lStack.pop()
+        if len(lTriangles) <= pMaxTriangles:
+            lClusters.append(np.sort(lTriangles))
+            continue
+        lCentroids = pCentroids[lTriangles]
+        lAxis = np.argmax(lCentroids.max(axis = 0) - lCentroids.min(axis = 0))
+        # Left part is always full clusters.
+        lClusterCount = (len(lTriangles) + pMaxTriangles - 1) // pMaxTriangles
+        lSplit = lClusterCount // 2 * pMaxTriangles
+        lOrder = np.argpartition(lCentroids[:, lAxis], lSplit)
+        lStack.append(lTriangles[lOrder[lSplit:]])
+        lStack.append(lTriangles[lOrder[:lSplit]])
+    return lClusters
+
+# Normal cone contains the normals of all triangles, cutoff is the cosine of its half angle.
+# Cutoff is -1 if the normals can't be bounded by a cone.
+def GetClusterBounds(pPositions, pTriangles):
+    lP = pPositions[pTriangles]
+    lPoints = lP.reshape(-1, 3)
+    lMin = lPoints.min(axis = 0)
+    lMax = lPoints.max(axis = 0)
+    lCenter = (lMin + lMax) * 0.5
+    lRadius = np.linalg.norm(lPoints - lCenter, axis = 1).max()
+
+    lNormals = np.cross(lP[:, 1] - lP[:, 0], lP[:, 2] - lP[:, 0])
+    lLength = np.linalg.norm(lNormals, axis = 1)
+    lNormals = lNormals[lLength > 1e-20] / lLength[lLength > 1e-20, None]
+    lAxis = lNormals.sum(axis = 0)
+    lAxisLength = np.linalg.norm(lAxis)
+    if len(lNormals) == 0 or lAxisLength < 1e-12:
+        lAxis = np.array([0.0, 0.0, 1.0])
+        lCutoff = -1.0
+    else:
+        lAxis /= lAxisLength
+        lCutoff = float(np.dot(lNormals, lAxis).min())
+    return {
+        'min': lMin.tolist(),
+        'max': lMax.tolist(),
+        'center': lCenter.tolist(),
+        'radius': float(lRadius),
+        'coneAxis': lAxis.tolist(),
+        'coneCutoff': lCutoff
+    }
+
+def ReadPrimitiveData(pGLTFPrimitive):
+    lIndices = np.array(ReadAccessorData(indicesBuffer, pGLTFPrimitive['indices']), dtype = np.int64).reshape(-1, 3)
+    lAttributesData = {}
+    for lSemantic, lAccessorIdx in pGLTFPrimitive['attributes'].items():
+        lAttributesData[lSemantic] = DecodeAccessorData(lAccessorIdx, ReadAccessorData(attributeBuffer, lAccessorIdx))
+    return lIndices, lAttributesData
+
+# Create a primitive of the triangles, with the vertices used by them.
+def CreateSubPrimitive(pGLTFPrimitive, pAttributesData, pTriangles):
+    lVertices, lLocalIndices = np.unique(pTriangles, return_inverse = True)
+    lVertices = lVertices.tolist()
+    lGLTFPrimitive = {}
+    for lKey in pGLTFPrimitive:
+        if not lKey in ('attributes', 'indices'):
+            lGLTFPrimitive[lKey] = pGLTFPrimitive[lKey]
+    lGLTFPrimitive['attributes'] = {}
+    for lSemantic, lList in pAttributesData.items():
+        lAccessorIdx = pGLTFPrimitive['attributes'][lSemantic]
+        lAccessor = lib_accessors[lAccessorIdx]
+        # Quantized attributes are quantized again in the range of sub primitive.
+        lType = 'f' if IsQuantizedAccessor(lAccessorIdx) else _componentTypeFormat[lAccessor['componentType']]
+        lGLTFPrimitive['attributes'][lSemantic] = CreateAttributeBuffer(
+            [lList[v] for v in lVertices], lType, _accessorTypeStride[lAccessor['type']], lAccessor.get('normalized', False)
+        )
+    lGLTFPrimitive['indices'] = CreateIndicesBuffer(lLocalIndices.ravel().tolist(), GetIndicesType(len(lVertices)))
+    return lGLTFPrimitive
+
+def ClusterPrimitive(pGLTFPrimitive, pMaxTriangles):
+    lIndices, lAttributesData = ReadPrimitiveData(pGLTFPrimitive)
+    lPositions = np.array(lAttributesData['POSITION'], dtype = np.float64)
+
+    lGLTFPrimitives = []
+    for lTriangles in PartitionTriangles(lPositions[lIndices].mean(axis = 1), pMaxTriangles):
+        lClusterIndices = lIndices[lTriangles]
+        lGLTFPrimitive = CreateSubPrimitive(pGLTFPrimitive, lAttributesData, lClusterIndices)
+        lGLTFPrimitive['extras'] = {
+            'cluster': GetClusterBounds(lPositions, lClusterIndices)
+        }
+        lGLTFPrimitives.append(lGLTFPrimitive)
+    return lGLTFPrimitives
+
+def ClusterMeshes(pMaxTriangles):
+    lPrimitiveCount = 0
+    lClusterCount = 0
+    for lGLTFMesh in lib_meshes:
+        lPrimitives = []
+        for lGLTFPrimitive in lGLTFMesh['primitives']:
+            if CanClusterPrimitive(lGLTFPrimitive, pMaxTriangles):
+                lClusters = ClusterPrimitive(lGLTFPrimitive, pMaxTriangles)
+                lPrimitives += lClusters
+                lPrimitiveCount += 1
+                lClusterCount += len(lClusters)
+            else:
+                lPrimitives.append(lGLTFPrimitive)
+        lGLTFMesh['primitives'] = lPrimitives
+    CompactAccessors()
+    print('Split %d primitives into %d clusters.' % (lPrimitiveCount, lClusterCount))
+
+
+# World space bounds of nodes at the pose time, and a BVH over the mesh nodes of scene. Needs NumPy.
+# Bounds of a node include its descendants. Skinned meshes are bounded by the vertices skinned
+# by the joints at the pose time.
+_bvhLeafSize = 4
+
+def GetWorldMatrices(pGLTFScene):
+    lWorldMatrices = {}
+    def TraverseNode(pNodeIdx, pParentMatrix):
+        lWorldMatrices[pNodeIdx] = M4Mul(pParentMatrix, GetNodeMatrix(lib_nodes[pNodeIdx]))
+        for lChildIdx in lib_nodes[pNodeIdx].get('children', []):
+            TraverseNode(lChildIdx, lWorldMatrices[pNodeIdx])
+    for lNodeIdx in pGLTFScene['nodes']:
+        TraverseNode(lNodeIdx, M4Identity())
+    return lWorldMatrices
+
+def M4ToArray(m):
+    # Column major
+    return np.array(m, dtype = np.float64).reshape(4, 4).T
+
+def GetSkinMatrices(pGLTFSkin, pWorldMatrices):
+    lJoints = pGLTFSkin['joints']
+    if 'inverseBindMatrices' in pGLTFSkin:
+        lIBMs = ReadAccessorData(invBindMatricesBuffer, pGLTFSkin['inverseBindMatrices'])
+    else:
+        lIBMs = [M4Identity()] * len(lJoints)
+    return np.array([
+        M4ToArray(pWorldMatrices.get(lJoints[i], M4Identity())).dot(M4ToArray(lIBMs[i])) for i in range(len(lJoints))
+    ])
+
+def GetPrimitiveWorldPositions(pGLTFPrimitive, pMatrix, pSkinMatrices):
+    lAttributes = pGLTFPrimitive['attributes']
+    lPositions = np.array(DecodeAccessorData(lAttributes['POSITION'], ReadAccessorData(attributeBuffer, lAttributes['POSITION'])))
+    lPositions = np.concatenate([lPositions.reshape(-1, 3), np.ones((len(lPositions), 1))], axis = 1)
+    if pSkinMatrices is None or not 'JOINTS_0' in lAttributes or not 'WEIGHTS_0' in lAttributes:
+        return lPositions.dot(pMatrix.T)[:, :3]
+    lJoints = np.array(ReadAccessorData(attributeBuffer, lAttributes['JOINTS_0']), dtype = np.int64)
+    lWeights = np.array(DecodeAccessorData(lAttributes['WEIGHTS_0'], ReadAccessorData(attributeBuffer, lAttributes['WEIGHTS_0'])))
+    lWeights /= np.maximum(lWeights.sum(axis = 1, keepdims = True), 1e-12)
+    lSkinned = np.zeros_like(lPositions)
+    for k in range(4):
+        lSkinned += lWeights[:, k:k + 1] * np.einsum('nij,nj->ni', pSkinMatrices[lJoints[:, k]], lPositions)
+    return lSkinned[:, :3]
+
+def GetPointsBounds(pPoints):
+    lMin = pPoints.min(axis = 0)
+    lMax = pPoints.max(axis = 0)
+    lCenter = (lMin + lMax) * 0.5
+    return {
+        'min': lMin.tolist(),
+        'max': lMax.tolist(),
+        'center': lCenter.tolist(),
+        'radius': float(np.linalg.norm(pPoints - lCenter, axis = 1).max())
+    }
 
-def CreateBufferView(pBufferIdx, pBuffer, appendBufferData, lib, pByteOffset, target=GL_ARRAY_BUFFER):
-    if pByteOffset % 4 == 2:
-        pBuffer.extend(b'\x00\x00')
-        pByteOffset += 2
+def MergeBounds(pBoundsList):
+    lMin = np.min([lBounds['min'] for lBounds in pBoundsList], axis = 0)
+    lMax = np.max([lBounds['max'] for lBounds in pBoundsList], axis = 0)
+    lCenter = (lMin + lMax) * 0.5
+    return {
+        'min': lMin.tolist(),
+        'max': lMax.tolist(),
+        'center': lCenter.tolist(),
+        'radius': max(
+            float(np.linalg.norm(lCenter - lBounds['center'])) + lBounds['radius'] for lBounds in pBoundsList
+        )
+    }
+
+def GetMeshNodeBounds(pNodeIdx, pWorldMatrices):
+    lGLTFNode = lib_nodes[pNodeIdx]
+    lSkinMatrices = None
+    if 'skin' in lGLTFNode:
+        lSkinMatrices = GetSkinMatrices(lib_skins[lGLTFNode['skin']], pWorldMatrices)
+    lMatrix = M4ToArray(pWorldMatrices[pNodeIdx])
+    lPoints = [
+        GetPrimitiveWorldPositions(lGLTFPrimitive, lMatrix, lSkinMatrices)
+        for lGLTFPrimitive in lib_meshes[lGLTFNode['mesh']]['primitives']
+        if 'POSITION' in lGLTFPrimitive['attributes']
+    ]
+    lPoints = [lList for lList in lPoints if len(lList) > 0]
+    if len(lPoints) == 0:
+        return None
+    return GetPointsBounds(np.concatenate(lPoints))
+
+# BVH is flattened in depth first order. Left child of an inner entry is the next entry, and 'right' is
+# the index of right child. Leaf entries have the indices of nodes.
+def BuildNodesBVH(pNodes, pBounds):
+    lMins = np.array([lBounds['min'] for lBounds in pBounds])
+    lMaxs = np.array([lBounds['max'] for lBounds in pBounds])
+    lCentroids = (lMins + lMaxs) * 0.5
+    lEntries = []
+    def BuildEntry(pItems):
+        lEntry = {
+            'min': lMins[pItems].min(axis = 0).tolist(),
+            'max': lMaxs[pItems].max(axis = 0).tolist()
+        }
+        lEntries.append(lEntry)
+        if len(pItems) <= _bvhLeafSize:
+            lEntry['nodes'] = [pNodes[i] for i in pItems.tolist()]
+            return
+        lCentroidsOfItems = lCentroids[pItems]
+        lAxis = np.argmax(lCentroidsOfItems.max(axis = 0) - lCentroidsOfItems.min(axis = 0))
+        lHalf = len(pItems) // 2
+        lOrder = np.argpartition(lCentroidsOfItems[:, lAxis], lHalf)
+        BuildEntry(pItems[lOrder[:lHalf]])
+        lEntry['right'] = len(lEntries)
+        BuildEntry(pItems[lOrder[lHalf:]])
+    if len(pNodes) > 0:
+        BuildEntry(np.arange(len(pNodes)))
+    return lEntries
+
+def ComputeSceneBounds(pSceneIdx):
+    lGLTFScene = lib_scenes[pSceneIdx]
+    lWorldMatrices = GetWorldMatrices(lGLTFScene)
+    lMeshNodes = []
+    lMeshBounds = []
+    def TraverseNode(pNodeIdx):
+        lGLTFNode = lib_nodes[pNodeIdx]
+        lBoundsList = []
+        if 'mesh' in lGLTFNode:
+            lBounds = GetMeshNodeBounds(pNodeIdx, lWorldMatrices)
+            if not lBounds == None:
+                lMeshNodes.append(pNodeIdx)
+                lMeshBounds.append(lBounds)
+                lBoundsList.append(lBounds)
+        for lChildIdx in lGLTFNode.get('children', []):
+            lChildBounds = TraverseNode(lChildIdx)
+            if not lChildBounds == None:
+                lBoundsList.append(lChildBounds)
+        if len(lBoundsList) == 0:
+            return None
+        lBounds = lBoundsList[0] if len(lBoundsList) == 1 else MergeBounds(lBoundsList)
+        lGLTFNode.setdefault('extras', {})['bounds'] = lBounds
+        return lBounds
+    for lNodeIdx in lGLTFScene['nodes']:
+        TraverseNode(lNodeIdx)
+
+    lGLTFScene.setdefault('extras', {})['bvh'] = BuildNodesBVH(lMeshNodes, lMeshBounds)
+    print('Computed bounds of %d mesh nodes.' % len(lMeshNodes))
+
+
+# Triangle BVH of primitives for ray picking, built with binned SAH. Needs NumPy.
+# Nodes are flattened in depth first order, 32 bytes each:
+#   float32 min[3], float32 max[3], uint32 offset, uint32 count
+# Left child of an inner node (count 0) is the next node and offset is the index of right child.
+# Triangles of a leaf are [offset, offset + count) of the indices, which are reordered to follow the leaves.
+_triangleBVHBins = 16
+_triangleBVHLeafSize = 4
+_triangleBVHMaxLeafSize = 16
+_triangleBVHDtype = None if np == None else np.dtype([
+    ('min', '<f4', (3,)), ('max', '<f4', (3,)), ('offset', '<u4'), ('count', '<u4')
+])
+
+def GetBoxAreas(pMin, pMax):
+    lSize = np.maximum(pMax - pMin, 0)
+    return 2 * (lSize[..., 0] * lSize[..., 1] + lSize[..., 1] * lSize[..., 2] + lSize[..., 2] * lSize[..., 0])
+
+# Min and max of the values grouped by the keys, faster than ufunc.at.
+def ReduceMinMax(pKeys, pMins, pMaxs, pCount, pSorted = False):
+    if not pSorted:
+        lOrder = np.argsort(pKeys, kind = 'stable')
+        pKeys, pMins, pMaxs = pKeys[lOrder], pMins[lOrder], pMaxs[lOrder]
+    lStarts = np.flatnonzero(np.concatenate([[True], pKeys[1:] != pKeys[:-1]]))
+    lMin = np.full((pCount, 3), np.inf)
+    lMax = np.full((pCount, 3), -np.inf)
+    lMin[pKeys[lStarts]] = np.minimum.reduceat(pMins, lStarts)
+    lMax[pKeys[lStarts]] = np.maximum.reduceat(pMaxs, lStarts)
+    return lMin, lMax
+
+# Build all nodes of one depth at once. Triangles of each node are a segment of lOrder.
+def BuildTriangleBVH(pPositions, pTriangles):
+    lTriangleCount = len(pTriangles)
+    lP = pPositions[pTriangles]
+    lTriangleMin = lP.min(axis = 1)
+    lTriangleMax = lP.max(axis = 1)
+    lCentroids = (lTriangleMin + lTriangleMax) * 0.5
+    lOrder = np.arange(lTriangleCount)
+    B = _triangleBVHBins
+
+    # Per depth arrays of the nodes.
+    lLevelNodes = []
+    lLevelStarts = []
+    lLevelCounts = []
+    lLevelMin = []
+    lLevelMax = []
+    lLevelParents = []
+    lNodeTotal = 1
+    lActive = np.array([0], dtype = np.int64)
+    lStarts = np.array([0], dtype = np.int64)
+    lCounts = np.array([lTriangleCount], dtype = np.int64)
+    while len(lActive) > 0:
+        K = len(lActive)
+        # Node of each triangle in the active segments
+        lTriangleNodes = np.repeat(np.arange(K), lCounts)
+        lIndexInNode = np.arange(len(lTriangleNodes)) - np.repeat(np.cumsum(lCounts) - lCounts, lCounts)
+        lPositions = lStarts[lTriangleNodes] + lIndexInNode
+        lTriangles = lOrder[lPositions]
+        lMins = lTriangleMin[lTriangles]
+        lMaxs = lTriangleMax[lTriangles]
+        lTriangleCentroids = lCentroids[lTriangles]
+
+        lMin, lMax = ReduceMinMax(lTriangleNodes, lMins, lMaxs, K, True)
+        lCentroidMin, lCentroidMax = ReduceMinMax(lTriangleNodes, lTriangleCentroids, lTriangleCentroids, K, True)
+        lExtents = lCentroidMax - lCentroidMin
+
+        # Cost of splitting after each bin on each axis.
+        lBins = np.zeros((len(lTriangles), 3), dtype = np.int64)
+        lCosts = np.full((K, 3, B - 1), np.inf)
+        for lAxis in range(3):
+            lExtent = lExtents[lTriangleNodes, lAxis]
+            lBin = np.where(lExtent > 0, (lTriangleCentroids[:, lAxis] - lCentroidMin[lTriangleNodes, lAxis]) / np.where(lExtent > 0, lExtent, 1) * B, 0)
+            lBin = np.clip(lBin.astype(np.int64), 0, B - 1)
+            lBins[:, lAxis] = lBin
+            lKeys = lTriangleNodes * B + lBin
+            lBinCounts = np.bincount(lKeys, minlength = K * B).reshape(K, B)
+            lBinMin, lBinMax = ReduceMinMax(lKeys, lMins, lMaxs, K * B)
+            lBinMin = lBinMin.reshape(K, B, 3)
+            lBinMax = lBinMax.reshape(K, B, 3)
+            lLeftAreas = GetBoxAreas(np.minimum.accumulate(lBinMin, axis = 1), np.maximum.accumulate(lBinMax, axis = 1))
+            lRightAreas = GetBoxAreas(
+                np.minimum.accumulate(lBinMin[:, ::-1], axis = 1)[:, ::-1], np.maximum.accumulate(lBinMax[:, ::-1], axis = 1)[:, ::-1]
+            )
+            lLeftCounts = np.cumsum(lBinCounts, axis = 1)
+            lRightCounts = lCounts[:, None] - lLeftCounts
+            lAxisCosts = lLeftAreas[:, :-1] * lLeftCounts[:, :-1] + lRightAreas[:, 1:] * lRightCounts[:, :-1]
+            lAxisCosts[(lLeftCounts[:, :-1] == 0) | (lRightCounts[:, :-1] == 0)] = np.inf
+            lCosts[:, lAxis] = lAxisCosts
+
+        lBest = lCosts.reshape(K, -1).argmin(axis = 1)
+        lBestCosts = lCosts.reshape(K, -1)[np.arange(K), lBest]
+        lBestAxis = lBest // (B - 1)
+        lBestBin = lBest % (B - 1)
+        lAreas = np.maximum(GetBoxAreas(lMin, lMax), 1e-30)
+        # Traversal and intersection cost are both 1.
+        lSplitWorse = 1 + lBestCosts / lAreas >= lCounts
+        lLeaf = (lCounts <= _triangleBVHLeafSize) | (lSplitWorse & (lCounts <= _triangleBVHMaxLeafSize))
+        # Split in the middle if the centroids can't be separated by bins.
+        lMedian = ~lLeaf & np.isinf(lBestCosts)
+
+        lTriangleSplit = ~lLeaf[lTriangleNodes]
+        lRight = lBins[np.arange(len(lTriangles)), lBestAxis[lTriangleNodes]] > lBestBin[lTriangleNodes]
+        lRight = np.where(lMedian[lTriangleNodes], lIndexInNode >= lCounts[lTriangleNodes] // 2, lRight)
+        # Segments are in order of the nodes, so sorting by the node and side keeps the segments.
+        lSplitPositions = lPositions[lTriangleSplit]
+        lSides = lTriangleNodes[lTriangleSplit] * 2 + lRight[lTriangleSplit]
+        lOrder[lSplitPositions] = lOrder[lSplitPositions][np.argsort(lSides, kind = 'stable')]
+        lRightCounts = np.bincount(lTriangleNodes[lTriangleSplit & lRight], minlength = K)
+
+        lLevelNodes.append(lActive)
+        lLevelStarts.append(lStarts)
+        lLevelCounts.append(lCounts)
+        lLevelMin.append(lMin)
+        lLevelMax.append(lMax)
+        # Left and right children are created next to each other.
+        lSplit = np.flatnonzero(~lLeaf)
+        lLeftChildren = lNodeTotal + np.arange(len(lSplit)) * 2
+        lNodeTotal += len(lSplit) * 2
+        lLevelParents.append((lActive[lSplit], lLeftChildren))
+        lLeftCounts = lCounts[lSplit] - lRightCounts[lSplit]
+        lActive = np.stack([lLeftChildren, lLeftChildren + 1], axis = 1).ravel()
+        lStarts = np.stack([lStarts[lSplit], lStarts[lSplit] + lLeftCounts], axis = 1).ravel()
+        lCounts = np.stack([lLeftCounts, lRightCounts[lSplit]], axis = 1).ravel()
+
+    lNodeIds = np.concatenate(lLevelNodes)
+    lNodeStart = np.zeros(lNodeTotal, dtype = np.int64)
+    lNodeStart[lNodeIds] = np.concatenate(lLevelStarts)
+    lNodeCount = np.zeros(lNodeTotal, dtype = np.int64)
+    lNodeCount[lNodeIds] = np.concatenate(lLevelCounts)
+    lNodeMin = np.zeros((lNodeTotal, 3))
+    lNodeMin[lNodeIds] = np.concatenate(lLevelMin)
+    lNodeMax = np.zeros((lNodeTotal, 3))
+    lNodeMax[lNodeIds] = np.concatenate(lLevelMax)
+    lNodeLeft = np.full(lNodeTotal, -1, dtype = np.int64)
+    for lParents, lLeftChildren in lLevelParents:
+        lNodeLeft[lParents] = lLeftChildren
+
+    # Flatten in depth first order.
+    lNodeLeftList = lNodeLeft.tolist()
+    lDepthFirst = []
+    lStack = [0]
+    while len(lStack) > 0:
+        lNodeIdx = lStack.pop()
+        lDepthFirst.append(lNodeIdx)
+        lLeftIdx = lNodeLeftList[lNodeIdx]
+        if lLeftIdx >= 0:
+            lStack.append(lLeftIdx + 1)
+            lStack.append(lLeftIdx)
+    lDepthFirst = np.array(lDepthFirst, dtype = np.int64)
+    lFlatIndices = np.zeros(lNodeTotal, dtype = np.int64)
+    lFlatIndices[lDepthFirst] = np.arange(lNodeTotal)
+    lIsLeaf = lNodeLeft[lDepthFirst] < 0
+
+    lNodes = np.zeros(lNodeTotal, dtype = _triangleBVHDtype)
+    lNodes['min'] = lNodeMin[lDepthFirst]
+    lNodes['max'] = lNodeMax[lDepthFirst]
+    lNodes['offset'] = np.where(lIsLeaf, lNodeStart[lDepthFirst], lFlatIndices[lNodeLeft[lDepthFirst] + 1])
+    lNodes['count'] = np.where(lIsLeaf, lNodeCount[lDepthFirst], 0)
+    return lNodes, lOrder
+
+def CanBuildTriangleBVH(pGLTFPrimitive, pMinTriangles):
+    return 'indices' in pGLTFPrimitive and pGLTFPrimitive.get('mode', 4) == 4 \
+        and 'POSITION' in pGLTFPrimitive['attributes'] and not 'JOINTS_0' in pGLTFPrimitive['attributes'] \
+        and lib_accessors[pGLTFPrimitive['indices']]['count'] > pMinTriangles * 3
+
+def BuildTriangleBVHs(pMinTriangles):
+    # Primitives sharing the indices and positions share the BVH.
+    lBVHMap = {}
+    lReorderedIndices = set()
+    lNodeCount = 0
+    for lGLTFMesh in lib_meshes:
+        for lGLTFPrimitive in lGLTFMesh['primitives']:
+            if not CanBuildTriangleBVH(lGLTFPrimitive, pMinTriangles):
+                continue
+            lPositionIdx = lGLTFPrimitive['attributes']['POSITION']
+            lIndicesIdx = lGLTFPrimitive['indices']
+            lKey = (lPositionIdx, lIndicesIdx)
+            if not lKey in lBVHMap:
+                if lIndicesIdx in lReorderedIndices:
+                    continue
+                lPositions = np.array(DecodeAccessorData(lPositionIdx, ReadAccessorData(attributeBuffer, lPositionIdx)))
+                lTriangles = np.array(ReadAccessorData(indicesBuffer, lIndicesIdx), dtype = np.int64).reshape(-1, 3)
+                lNodes, lOrder = BuildTriangleBVH(lPositions.reshape(-1, 3), lTriangles)
+                WriteAccessorData(indicesBuffer, lIndicesIdx, lTriangles[lOrder].ravel().tolist())
+                lReorderedIndices.add(lIndicesIdx)
+                lBVHInfo = {
+                    'nodeCount': len(lNodes)
+                }
+                lib_triangle_bvhs.append((lBVHInfo, lNodes.tobytes()))
+                lBVHMap[lKey] = lBVHInfo
+                lNodeCount += len(lNodes)
+            lGLTFPrimitive.setdefault('extras', {})['triangleBVH'] = lBVHMap[lKey]
+    print('Built %d triangle BVHs with %d nodes.' % (len(lBVHMap), lNodeCount))
+
+
+# Split primitives with 32 bit indices into spatially coherent chunks which can use 16 bit indices. Needs NumPy.
+_maxShortIndicesVertices = 0xffff - 1
+
+# Split the triangles by centroids along the longest axis until vertices of each chunk are few enough.
+def PartitionTrianglesByVertices(pCentroids, pIndices, pMaxVertices):
+    lChunks = []
+    lStack = [np.arange(len(pIndices))]
+    while len(lStack) > 0:
+        lTriangles = lStack.pop()
+        lVertexCount = len(np.unique(pIndices[lTriangles]))
+        if lVertexCount <= pMaxVertices:
+            lChunks.append(np.sort(lTriangles))
+            continue
+        lCentroids = pCentroids[lTriangles]
+        lAxis = np.argmax(lCentroids.max(axis = 0) - lCentroids.min(axis = 0))
+        # Split by the count of chunks needed, so the chunks are as full as possible.
+        lChunkCount = (lVertexCount + pMaxVertices - 1) // pMaxVertices
+        lSplit = len(lTriangles) * (lChunkCount // 2) // lChunkCount
+        lOrder = np.argpartition(lCentroids[:, lAxis], lSplit)
+        lStack.append(lTriangles[lOrder[lSplit:]])
+        lStack.append(lTriangles[lOrder[:lSplit]])
+    return lChunks
+
+def CanSplitPrimitive(pGLTFPrimitive):
+    return 'indices' in pGLTFPrimitive and pGLTFPrimitive.get('mode', 4) == 4 \
+        and 'POSITION' in pGLTFPrimitive['attributes'] \
+        and lib_accessors[pGLTFPrimitive['attributes']['POSITION']]['count'] > _maxShortIndicesVertices
+
+def SplitLargePrimitives():
+    lPrimitiveCount = 0
+    lChunkCount = 0
+    lDuplicatedCount = 0
+    for lGLTFMesh in lib_meshes:
+        lPrimitives = []
+        for lGLTFPrimitive in lGLTFMesh['primitives']:
+            if not CanSplitPrimitive(lGLTFPrimitive):
+                lPrimitives.append(lGLTFPrimitive)
+                continue
+            lIndices, lAttributesData = ReadPrimitiveData(lGLTFPrimitive)
+            lPositions = np.array(lAttributesData['POSITION'], dtype = np.float64)
+            lChunks = PartitionTrianglesByVertices(lPositions[lIndices].mean(axis = 1), lIndices, _maxShortIndicesVertices)
+            for lTriangles in lChunks:
+                lPrimitives.append(CreateSubPrimitive(lGLTFPrimitive, lAttributesData, lIndices[lTriangles]))
+                lDuplicatedCount += lib_accessors[lPrimitives[-1]['attributes']['POSITION']]['count']
+            lDuplicatedCount -= len(np.unique(lIndices))
+            lPrimitiveCount += 1
+            lChunkCount += len(lChunks)
+        lGLTFMesh['primitives'] = lPrimitives
+    CompactAccessors()
+    print('Split %d primitives into %d chunks with 16 bit indices, duplicated %d vertices.' % (
+        lPrimitiveCount, lChunkCount, lDuplicatedCount
+    ))
+
+
+def CreateBufferView(pBufferIdx, pBuffer, appendBufferData, lib, target=GL_ARRAY_BUFFER):
+    # Buffer view should be 4-byte-aligned
+    if len(pBuffer) % 4 != 0:
+        pBuffer.extend(b'\x00' * (4 - len(pBuffer) % 4))
+    lByteOffset = len(pBuffer)
 
     pBuffer.extend(appendBufferData)
     lBufferViewIdx = len(lib_buffer_views)
     lBufferView = {
         "buffer": pBufferIdx,
         "byteLength": len(appendBufferData),
-        "byteOffset": pByteOffset,
+        "byteOffset": lByteOffset,
         # PENDING
         # "byteStride": 0,
-        "target": target
     }
+    if not target == None:
+        lBufferView['target'] = target
     lib_buffer_views.append(lBufferView)
     for lAttrib in lib:
         lAttrib['bufferView'] = lBufferViewIdx
@@ -1247,19 +3191,286 @@ def CreateBufferView(pBufferIdx, pBuffer, appendBufferData, lib, pByteOffset, ta
     return lBufferView
 
 
+# Copy data of the accessors into one buffer view, in the given order.
+def CreateAccessorsBufferView(pBufferIdx, pBin, pBuffer, pAccessors, target=GL_ARRAY_BUFFER):
+    lData = bytearray()
+    for lAccessor in pAccessors:
+        lType = _componentTypeFormat[lAccessor['componentType']]
+        lByteLength = struct.calcsize('<' + lType) * _accessorTypeStride[lAccessor['type']] * lAccessor['count']
+        lByteOffset = lAccessor['byteOffset']
+        appendToBuffer(lType, lData, pBuffer[lByteOffset:lByteOffset + lByteLength], lAccessor)
+    return CreateBufferView(pBufferIdx, pBin, lData, pAccessors, target)
+
+# Estimated screen importance of a mesh node, from its world bounds at the pose time.
+# Bigger and closer to the origin is more important.
+def GetMeshNodeImportance(pGLTFNode, pWorldMatrix):
+    lMin = [float('inf')] * 3
+    lMax = [-float('inf')] * 3
+    for lGLTFPrimitive in lib_meshes[pGLTFNode['mesh']]['primitives']:
+        if not 'POSITION' in lGLTFPrimitive['attributes']:
+            continue
+        lAccessor = lib_accessors[lGLTFPrimitive['attributes']['POSITION']]
+        lQuantized = lAccessor.get('extensions', {}).get('WEB3D_quantized_attributes')
+        lBounds = [lQuantized['decodedMin'], lQuantized['decodedMax']] if lQuantized else [lAccessor['min'], lAccessor['max']]
+        for lCorner in range(8):
+            lPoint = M4TransformPoint(pWorldMatrix, [lBounds[(lCorner >> i) & 1][i] for i in range(3)])
+            for i in range(3):
+                lMin[i] = min(lMin[i], lPoint[i])
+                lMax[i] = max(lMax[i], lPoint[i])
+    if lMin[0] > lMax[0]:
+        return 0
+    lCenter = [(lMin[i] + lMax[i]) * 0.5 for i in range(3)]
+    lRadius = math.sqrt(sum((lMax[i] - lMin[i]) ** 2 for i in range(3))) * 0.5
+    lDistance = math.sqrt(sum(lValue * lValue for lValue in lCenter))
+    return lRadius / max(lDistance + lRadius, 1e-10)
+
+# Meshes in the order of scene traversal, or by importance. LOD meshes of a node go before its base
+# mesh, from the coarsest, so something can be rendered as early as possible.
+def GetMeshesLoadOrder(pLayout):
+    lMeshesOrder = []
+    lImportance = {}
+    def AddMesh(pMeshIdx, pImportance):
+        if not pMeshIdx in lImportance:
+            lMeshesOrder.append(pMeshIdx)
+        lImportance[pMeshIdx] = max(lImportance.get(pMeshIdx, 0), pImportance)
+
+    for lGLTFScene in lib_scenes:
+        lWorldMatrices = GetWorldMatrices(lGLTFScene)
+        def TraverseNode(pNodeIdx):
+            lGLTFNode = lib_nodes[pNodeIdx]
+            if 'mesh' in lGLTFNode:
+                lImportanceOfNode = 0
+                if pLayout == 'importance':
+                    lImportanceOfNode = GetMeshNodeImportance(lGLTFNode, lWorldMatrices[pNodeIdx])
+                for lNodeIdx in list(reversed(GetLODNodes(lGLTFNode))) + [pNodeIdx]:
+                    AddMesh(lib_nodes[lNodeIdx]['mesh'], lImportanceOfNode)
+            for lChildIdx in lGLTFNode.get('children', []):
+                TraverseNode(lChildIdx)
+        for lNodeIdx in lGLTFScene['nodes']:
+            TraverseNode(lNodeIdx)
+
+    if pLayout == 'importance':
+        # Stable, LOD meshes of the same node keep their order.
+        lMeshesOrder.sort(key = lambda lMeshIdx: -lImportance[lMeshIdx])
+    return lMeshesOrder
+
+# Mesh owning each buffer view created by CreateProgressiveBufferViews.
+_bufferViewMeshes = {}
+
+# Each mesh has its own attributes and indices buffer views, in the load order. Inverse bind matrices
+# go first and animation goes last, so meshes can be rendered from a partially downloaded buffer.
+# Shared accessors, attributes and indices, are put in their own buffer views before the meshes.
+def CreateProgressiveBufferViews(pBufferIdx, pBin, pLayout, pSplitAnimations = False, pSharedAccessors = ([], [])):
+    _bufferViewMeshes.clear()
+    if len(lib_ibm_accessors) > 0:
+        CreateBufferView(pBufferIdx, pBin, invBindMatricesBuffer, lib_ibm_accessors)
+
+    lAddedAccessors = set()
+    def GetNewAccessors(pAccessorsIdx):
+        lAccessors = []
+        for lAccessorIdx in pAccessorsIdx:
+            if not lAccessorIdx in lAddedAccessors:
+                lAddedAccessors.add(lAccessorIdx)
+                lAccessors.append(lib_accessors[lAccessorIdx])
+        return lAccessors
+
+    lAttributes = GetNewAccessors(pSharedAccessors[0])
+    lIndices = GetNewAccessors(pSharedAccessors[1])
+    if len(lAttributes) > 0:
+        CreateAccessorsBufferView(pBufferIdx, pBin, attributeBuffer, lAttributes)
+    if len(lIndices) > 0:
+        CreateAccessorsBufferView(pBufferIdx, pBin, indicesBuffer, lIndices, GL_ELEMENT_ARRAY_BUFFER)
+
+    for lMeshIdx in GetMeshesLoadOrder(pLayout):
+        lPrimitives = lib_meshes[lMeshIdx]['primitives']
+        lAttributes = GetNewAccessors([
+            lAccessorIdx for lGLTFPrimitive in lPrimitives for lAccessorIdx in lGLTFPrimitive['attributes'].values()
+        ])
+        lIndices = GetNewAccessors([
+            lGLTFPrimitive['indices'] for lGLTFPrimitive in lPrimitives if 'indices' in lGLTFPrimitive
+        ])
+        if len(lAttributes) > 0:
+            _bufferViewMeshes[len(lib_buffer_views)] = lMeshIdx
+            CreateAccessorsBufferView(pBufferIdx, pBin, attributeBuffer, lAttributes)
+        if len(lIndices) > 0:
+            _bufferViewMeshes[len(lib_buffer_views)] = lMeshIdx
+            CreateAccessorsBufferView(pBufferIdx, pBin, indicesBuffer, lIndices, GL_ELEMENT_ARRAY_BUFFER)
+
+    # Meshes not in the scenes
+    lAddedIds = set(id(lib_accessors[lAccessorIdx]) for lAccessorIdx in lAddedAccessors)
+    lAttributes = [lAccessor for lAccessor in lib_attributes_accessors if not id(lAccessor) in lAddedIds]
+    lIndices = [lAccessor for lAccessor in lib_indices_accessors if not id(lAccessor) in lAddedIds]
+    if len(lAttributes) > 0:
+        CreateAccessorsBufferView(pBufferIdx, pBin, attributeBuffer, lAttributes)
+    if len(lIndices) > 0:
+        CreateAccessorsBufferView(pBufferIdx, pBin, indicesBuffer, lIndices, GL_ELEMENT_ARRAY_BUFFER)
+
+    for lBVHInfo, lData in lib_triangle_bvhs:
+        lBVHInfo['bufferView'] = len(lib_buffer_views)
+        CreateBufferView(pBufferIdx, pBin, lData, [], None)
+
+    if len(lib_animation_accessors) > 0 and pSplitAnimations:
+        for lGLTFAnimation in lib_animations:
+            lAccessors = GetNewAccessors([
+                lAccessorIdx for lSampler in lGLTFAnimation['samplers'] for lAccessorIdx in [lSampler['input'], lSampler['output']]
+            ])
+            if len(lAccessors) > 0:
+                CreateAccessorsBufferView(pBufferIdx, pBin, animationBuffer, lAccessors)
+        lAddedIds = set(id(lib_accessors[lAccessorIdx]) for lAccessorIdx in lAddedAccessors)
+        lAccessors = [lAccessor for lAccessor in lib_animation_accessors if not id(lAccessor) in lAddedIds]
+        if len(lAccessors) > 0:
+            CreateAccessorsBufferView(pBufferIdx, pBin, animationBuffer, lAccessors)
+    elif len(lib_animation_accessors) > 0:
+        CreateBufferView(pBufferIdx, pBin, animationBuffer, lib_animation_accessors)
+
 def CreateBufferViews(pBufferIdx, pBin):
+    if not ENV_BUFFER_LAYOUT == 'kind' or not ENV_SPLIT_BUFFERS == 'none':
+        # Splitting buffers needs buffer views of each mesh.
+        lLayout = 'traversal' if ENV_BUFFER_LAYOUT == 'kind' else ENV_BUFFER_LAYOUT
+        lSharedAccessors = GetTopNodesSharedAccessors() if ENV_SPLIT_BUFFERS == 'node' else ([], [])
+        CreateProgressiveBufferViews(pBufferIdx, pBin, lLayout, ENV_SPLIT_BUFFERS == 'animation', lSharedAccessors)
+        return
 
-    lByteOffset = CreateBufferView(pBufferIdx, pBin, attributeBuffer, lib_attributes_accessors, 0)['byteLength']
+    CreateBufferView(pBufferIdx, pBin, attributeBuffer, lib_attributes_accessors)
 
     if len(lib_ibm_accessors) > 0:
-        lByteOffset += CreateBufferView(pBufferIdx, pBin, invBindMatricesBuffer, lib_ibm_accessors, lByteOffset)['byteLength']
+        CreateBufferView(pBufferIdx, pBin, invBindMatricesBuffer, lib_ibm_accessors)
 
     if len(lib_animation_accessors) > 0:
-        lByteOffset += CreateBufferView(pBufferIdx, pBin, animationBuffer, lib_animation_accessors, lByteOffset)['byteLength']
+        CreateBufferView(pBufferIdx, pBin, animationBuffer, lib_animation_accessors)
 
     #When creating a Float32Array, which the offset must be multiple of 4
-    CreateBufferView(pBufferIdx, pBin, indicesBuffer, lib_indices_accessors, lByteOffset, GL_ELEMENT_ARRAY_BUFFER)
+    CreateBufferView(pBufferIdx, pBin, indicesBuffer, lib_indices_accessors, GL_ELEMENT_ARRAY_BUFFER)
+
+    for lBVHInfo, lData in lib_triangle_bvhs:
+        lBVHInfo['bufferView'] = len(lib_buffer_views)
+        CreateBufferView(pBufferIdx, pBin, lData, [], None)
+
+
+# Time accessors shared by animations are copied, so data of each animation can be in its own file.
+def UnshareAnimationAccessors():
+    lUsedAccessors = set()
+    for lGLTFAnimation in lib_animations:
+        lCopies = {}
+        for lSampler in lGLTFAnimation['samplers']:
+            for lKey in ['input', 'output']:
+                lAccessorIdx = lSampler[lKey]
+                if lAccessorIdx in lCopies:
+                    lSampler[lKey] = lCopies[lAccessorIdx]
+                elif lAccessorIdx in lUsedAccessors:
+                    lAccessor = dict(lib_accessors[lAccessorIdx])
+                    lCopies[lAccessorIdx] = lSampler[lKey] = len(lib_accessors)
+                    lib_animation_accessors.append(lAccessor)
+                    lib_accessors.append(lAccessor)
+        for lSampler in lGLTFAnimation['samplers']:
+            lUsedAccessors.add(lSampler['input'])
+            lUsedAccessors.add(lSampler['output'])
+
+# Index of top level node holding each mesh, in the scene traversal.
+def GetMeshesTopNode():
+    lMeshesTopNode = {}
+    for lGLTFScene in lib_scenes:
+        for lTopNodeIdx in lGLTFScene['nodes']:
+            def TraverseNode(pNodeIdx):
+                lGLTFNode = lib_nodes[pNodeIdx]
+                if 'mesh' in lGLTFNode:
+                    for lNodeIdx in [pNodeIdx] + GetLODNodes(lGLTFNode):
+                        lMeshesTopNode.setdefault(lib_nodes[lNodeIdx]['mesh'], lTopNodeIdx)
+                for lChildIdx in lGLTFNode.get('children', []):
+                    TraverseNode(lChildIdx)
+            TraverseNode(lTopNodeIdx)
+    return lMeshesTopNode
+
+# Attributes and indices used by meshes of several top level nodes, they go to the first buffer
+# when splitting buffers by node.
+def GetTopNodesSharedAccessors():
+    lAccessorTopNodes = {}
+    for lMeshIdx, lTopNodeIdx in GetMeshesTopNode().items():
+        for lGLTFPrimitive in lib_meshes[lMeshIdx]['primitives']:
+            for lAccessorIdx in list(lGLTFPrimitive['attributes'].values()) + [lGLTFPrimitive.get('indices')]:
+                if not lAccessorIdx == None:
+                    lAccessorTopNodes.setdefault(lAccessorIdx, set()).add(lTopNodeIdx)
+    lShared = sorted(lAccessorIdx for lAccessorIdx, lTopNodes in lAccessorTopNodes.items() if len(lTopNodes) > 1)
+    lIndicesIds = set(id(lAccessor) for lAccessor in lib_indices_accessors)
+    return (
+        [lAccessorIdx for lAccessorIdx in lShared if not id(lib_accessors[lAccessorIdx]) in lIndicesIds],
+        [lAccessorIdx for lAccessorIdx in lShared if id(lib_accessors[lAccessorIdx]) in lIndicesIds]
+    )
 
+# Move the buffer views into several buffers, one per animation, one per top level node, or chunks
+# up to the max byte length. Data not owned by an animation or a node stays in the first buffer.
+# Returns data of each buffer.
+def SplitBuffers(pBin, pSplit, pMaxByteLength):
+    lViewKeys = [0] * len(lib_buffer_views)
+    if pSplit == 'size':
+        lKey = 0
+        lByteLength = 0
+        for i in range(len(lib_buffer_views)):
+            lViewByteLength = (lib_buffer_views[i]['byteLength'] + 3) & ~3
+            if lByteLength > 0 and lByteLength + lViewByteLength > pMaxByteLength:
+                lKey += 1
+                lByteLength = 0
+            lByteLength += lViewByteLength
+            lViewKeys[i] = lKey
+    elif pSplit == 'animation':
+        lAccessorKeys = {}
+        for i in range(len(lib_animations)):
+            for lSampler in lib_animations[i]['samplers']:
+                lAccessorKeys.setdefault(lSampler['input'], i + 1)
+                lAccessorKeys.setdefault(lSampler['output'], i + 1)
+        for lAccessorIdx, lKey in lAccessorKeys.items():
+            lViewKeys[lib_accessors[lAccessorIdx]['bufferView']] = lKey
+    elif pSplit == 'node':
+        lTopNodes = [lNodeIdx for lGLTFScene in lib_scenes for lNodeIdx in lGLTFScene['nodes']]
+        lMeshKeys = dict(
+            (lMeshIdx, lTopNodes.index(lTopNodeIdx) + 1) for lMeshIdx, lTopNodeIdx in GetMeshesTopNode().items()
+        )
+        # Buffer views of each mesh go with the mesh, shared accessors are in their own views of the first buffer.
+        for lViewIdx, lMeshIdx in _bufferViewMeshes.items():
+            lViewKeys[lViewIdx] = lMeshKeys.get(lMeshIdx, 0)
+        for lMeshIdx, lKey in lMeshKeys.items():
+            for lGLTFPrimitive in lib_meshes[lMeshIdx]['primitives']:
+                lBVHInfo = lGLTFPrimitive.get('extras', {}).get('triangleBVH')
+                if not lBVHInfo == None:
+                    lViewKeys[lBVHInfo['bufferView']] = lKey
+
+    # Empty keys are skipped.
+    lBufferIndices = dict((lKey, i) for i, lKey in enumerate(sorted(set(lViewKeys))))
+    lBins = [bytearray() for lKey in lBufferIndices]
+    for i in range(len(lib_buffer_views)):
+        lBufferView = lib_buffer_views[i]
+        lBufferIdx = lBufferIndices[lViewKeys[i]]
+        lBin = lBins[lBufferIdx]
+        if len(lBin) % 4 != 0:
+            lBin.extend(b'\x00' * (4 - len(lBin) % 4))
+        lByteOffset = lBufferView['byteOffset']
+        lBufferView['buffer'] = lBufferIdx
+        lBufferView['byteOffset'] = len(lBin)
+        lBin.extend(pBin[lByteOffset:lByteOffset + lBufferView['byteLength']])
+    return lBins if len(lBins) > 0 else [bytearray()]
+
+# List meshes, skins and animations having data in each buffer, so they can be loaded lazily.
+def CreateBuffersManifest():
+    lManifests = [{'meshes': set(), 'skins': set(), 'animations': set()} for lGLTFBuffer in lib_buffers]
+    def AddToManifest(pKey, pIdx, pAccessorIdx):
+        lBufferView = lib_buffer_views[lib_accessors[pAccessorIdx]['bufferView']]
+        lManifests[lBufferView['buffer']][pKey].add(pIdx)
+    for i in range(len(lib_meshes)):
+        for lGLTFPrimitive in lib_meshes[i]['primitives']:
+            for lAccessorIdx in list(lGLTFPrimitive['attributes'].values()) + [lGLTFPrimitive.get('indices')]:
+                if not lAccessorIdx == None:
+                    AddToManifest('meshes', i, lAccessorIdx)
+    for i in range(len(lib_skins)):
+        if 'inverseBindMatrices' in lib_skins[i]:
+            AddToManifest('skins', i, lib_skins[i]['inverseBindMatrices'])
+    for i in range(len(lib_animations)):
+        for lSampler in lib_animations[i]['samplers']:
+            AddToManifest('animations', i, lSampler['input'])
+            AddToManifest('animations', i, lSampler['output'])
+    for i in range(len(lib_buffers)):
+        lManifest = dict((lKey, sorted(lValue)) for lKey, lValue in lManifests[i].items() if len(lValue) > 0)
+        if len(lManifest) > 0:
+            lib_buffers[i].setdefault('extras', {})['contents'] = lManifest
 
 # Start from -1 and ignore the root node
 _nodeCount = -1
@@ -1304,83 +3515,920 @@ def GetNodeIdx(pNode):
     return _nodeIdxMap[lId]
 
 
+# File paths in directory keyed by lower case basename.
+# Directory is only scanned once and the index is kept for the following conversions.
+_fileIndexCache = {}
+_fileIndexLock = threading.Lock()
+def GetFileIndex(pDir):
+    lDir = os.path.abspath(pDir)
+    # Images are resolved in multiple threads.
+    with _fileIndexLock:
+        if not lDir in _fileIndexCache:
+            lFileIndex = {}
+            for root, dirs, files in os.walk(lDir):
+                for file in files:
+                    lKey = file.lower()
+                    if not lKey in lFileIndex:
+                        lFileIndex[lKey] = []
+                    lFileIndex[lKey].append(os.path.join(root, file))
+            _fileIndexCache[lDir] = lFileIndex
+        return _fileIndexCache[lDir]
+
 def FindFileInDir(pFileName, pDir):
-    for root, dirs, files in os.walk(pDir):
-        for file in files:
-            if file == pFileName:
-                return os.path.join(root, file)
-
-
-def CorrectImagesPaths(pFilePath):
-    lFileFullPath = os.path.join(os.getcwd(), pFilePath)
-    lFileExtension = pFilePath.rsplit('.', 1)[1].lower()
-    for lGLTFImage in lib_images:
-        lUri = lGLTFImage['uri']
-        lUri = lUri.replace(r'[\\\/]+', os.path.sep)
-        # FBX SDK extracts zip input files to temp folder, so use lGLTFImage uri instead to find temp folder
-        if lFileExtension == 'zip':
-            lFileDir = os.path.dirname(lGLTFImage['uri'])
-        else:
-            lFileDir = os.path.dirname(lFileFullPath)
-        lUri = FindFileInDir(os.path.basename(lUri), lFileDir)
-        if lUri:
-            lRelUri = os.path.relpath(lUri, lFileDir)
-            # If an alternative output directory is specified, copy all textures to output directory
-            if lOutputDirSpecified:
-                lOutputDir = os.path.dirname(args.output)
-                # If textures are in a dir and that dir does not yet exist, create it
-                lRelTextureDir = os.path.dirname(lRelUri)
-                lFullTextureDir = os.path.join(lOutputDir, lRelTextureDir)
-                if not os.path.exists(lFullTextureDir):
-                    os.makedirs(lFullTextureDir)
-                shutil.copyfile(lUri, os.path.join(lOutputDir, lRelUri))
+    # Path may be written in windows.
+    lFileName = re.split(r'[\\/]+', pFileName)[-1]
+    lPaths = GetFileIndex(pDir).get(lFileName.lower())
+    if not lPaths:
+        return None
+    # Prefer the file with the same case.
+    for lPath in lPaths:
+        if os.path.basename(lPath) == lFileName:
+            return lPath
+    return lPaths[0]
+
+
+# Texture files are resolved, copied and hashed in threads along with the geometry conversion.
+_textureExecutor = None
+_textureTaskOptions = {}
+_imageTasks = {}
+
+def StartTextureTasks(pFilePath, pOutputFile, pBinary, pCopyTextures):
+    global _textureExecutor
+    _textureTaskOptions['filePath'] = pFilePath
+    _textureTaskOptions['outputDir'] = os.path.dirname(pOutputFile)
+    _textureTaskOptions['binary'] = pBinary
+    _textureTaskOptions['copyTextures'] = pCopyTextures
+    _textureTaskOptions['textureCacheDir'] = ENV_TEXTURE_CACHE_DIR or os.path.join(_textureTaskOptions['outputDir'], '.texturecache')
+    _textureExecutor = concurrent.futures.ThreadPoolExecutor()
+
+def StopTextureTasks():
+    global _textureExecutor
+    if not _textureExecutor == None:
+        _textureExecutor.shutdown()
+        _textureExecutor = None
+    _imageTasks.clear()
+
+def SubmitImageTask(pImageIdx):
+    if not _textureExecutor == None:
+        _imageTasks[pImageIdx] = _textureExecutor.submit(ProcessImageFile, lib_images[pImageIdx]['uri'])
+
+def GetImageFile(pImageIdx):
+    if pImageIdx in _imageTasks:
+        return _imageTasks[pImageIdx].result()
+    return ProcessImageFile(lib_images[pImageIdx]['uri'])
+
+def HashFile(pPath):
+    lHash = hashlib.sha1()
+    with open(pPath, 'rb') as f:
+        for lChunk in iter(lambda: f.read(1 << 20), b''):
+            lHash.update(lChunk)
+    return lHash.hexdigest()
+
+def GetImageMimeType(pPath):
+    lExt = os.path.splitext(pPath)[1].lower()
+    if lExt == '.png':
+        return 'image/png'
+    elif lExt == '.jpg' or lExt == '.jpeg':
+        return 'image/jpeg'
+    lMimeType = mimetypes.guess_type(pPath)[0]
+    return lMimeType or 'application/octet-stream'
+
+# Image uris resolved to the same file are copied in different tasks, one lock for each destination.
+_copyLocks = {}
+_copyLocksLock = threading.Lock()
+
+# Returns if file is copied.
+def CopyFileIfChanged(pSrc, pDst):
+    lKey = os.path.normcase(os.path.abspath(pDst))
+    with _copyLocksLock:
+        lLock = _copyLocks.setdefault(lKey, threading.Lock())
+    with lLock:
+        return CopyFile(pSrc, pDst)
+
+def CopyFile(pSrc, pDst):
+    if os.path.exists(pDst):
+        if os.path.samefile(pSrc, pDst):
+            return False
+        lSrcStat = os.stat(pSrc)
+        lDstStat = os.stat(pDst)
+        if lSrcStat.st_size == lDstStat.st_size:
+            if int(lSrcStat.st_mtime) == int(lDstStat.st_mtime) or HashFile(pSrc) == HashFile(pDst):
+                return False
+        os.remove(pDst)
+
+    lDstDir = os.path.dirname(pDst)
+    if lDstDir and not os.path.exists(lDstDir):
+        os.makedirs(lDstDir, exist_ok = True)
+    # Hard link if in the same volume.
+    try:
+        os.link(pSrc, pDst)
+        return True
+    except FileExistsError:
+        if os.path.samefile(pSrc, pDst):
+            return False
+    except (OSError, AttributeError):
+        pass
+    # copy2 keeps the mtime so the file can be skipped in the next conversion.
+    shutil.copy2(pSrc, pDst)
+    return True
+
+def ProcessImageFile(pUri):
+    lFilePath = _textureTaskOptions['filePath']
+    lFileFullPath = os.path.join(os.getcwd(), lFilePath)
+    if _textureTaskOptions['binary']:
+        lPath = pUri
+        if not os.path.isfile(lPath):
+            lPath = FindFileInDir(os.path.basename(pUri), os.path.dirname(lFileFullPath))
+        if not lPath:
+            return None
+        return {
+            'path': lPath,
+            'byteLength': os.path.getsize(lPath),
+            'hash': HashFile(lPath),
+            'mimeType': GetImageMimeType(lPath)
+        }
+
+    # FBX SDK extracts zip input files to temp folder, so use image uri instead to find temp folder
+    if lFilePath.rsplit('.', 1)[1].lower() == 'zip':
+        lFileDir = os.path.dirname(pUri)
+    else:
+        lFileDir = os.path.dirname(lFileFullPath)
+    lPath = FindFileInDir(os.path.basename(pUri), lFileDir)
+    if not lPath:
+        return None
+    lRelUri = os.path.relpath(lPath, lFileDir)
+    lCopied = False
+    # If an alternative output directory is specified, copy all textures to output directory
+    if _textureTaskOptions['copyTextures']:
+        lCopied = CopyFileIfChanged(lPath, os.path.join(_textureTaskOptions['outputDir'], lRelUri))
+    return {
+        'path': lPath,
+        'uri': lRelUri,
+        'copied': lCopied
+    }
+
+def CorrectImagesPaths():
+    lCopiedCount = 0
+    for i in range(len(lib_images)):
+        lGLTFImage = lib_images[i]
+        lImageFile = GetImageFile(i)
+        if lImageFile:
+            lRelUri = lImageFile['uri']
+            if lImageFile['copied']:
+                lCopiedCount += 1
             if not lRelUri == lGLTFImage['uri']:
                 print('Changed texture file path from "' + lGLTFImage['uri'] + '" to "' + lRelUri + '"')
             lGLTFImage['uri'] = lRelUri
+            lExtras = GetImageExtras(lImageFile)
+            if len(lExtras) > 0:
+                lGLTFImage['extras'] = lExtras
         else:
             print("Can\'t find texture file in the folder, path: " + lGLTFImage['uri'])
-
-
-def EmbedImagesToBinary(pBuffer, pFilePath):
-    lFileFullPath = os.path.join(os.getcwd(), pFilePath)
-    lFileDir = os.path.dirname(lFileFullPath)
-    for lGLTFImage in lib_images:
-        lUri = lGLTFImage['uri']
-        lImgBytes = None
-
-        if not os.path.isfile(lUri):
-            lUri = lUri.replace(r'[\\\/]+', os.path.sep)
-            lUri = FindFileInDir(os.path.basename(lUri), lFileDir)
-        try:
-            f = open(lUri, 'rb')
-            lImgBytes = f.read()
-        except:
+    if _textureTaskOptions['copyTextures']:
+        print('Copied %d textures, %d unchanged.' % (lCopiedCount, len(lib_images) - lCopiedCount))
+
+# Layout images after the binary data. Image content is streamed into the file when writing.
+# Returns the image chunks and the total byte length.
+def EmbedImagesToBinary(pBuffer):
+    lImageChunks = []
+    lByteLength = len(pBuffer)
+    lContentMap = {}
+    for i in range(len(lib_images)):
+        lGLTFImage = lib_images[i]
+        lImageFile = GetImageFile(i)
+        if not lImageFile:
             print("Can\'t find texture file in the folder, path: " + lGLTFImage['uri'])
-
-        if not lImgBytes:
             continue
 
-        lBufferViewIdx = len(lib_buffer_views)
+        # Images with the same content share one buffer view
+        lContentKey = (lImageFile['byteLength'], lImageFile['hash'])
+        if not lContentKey in lContentMap:
+            # 4-byte-aligned
+            lByteOffset = (lByteLength + 3) & ~3
+            lContentMap[lContentKey] = len(lib_buffer_views)
+            lib_buffer_views.append({
+                'buffer': 0,
+                'byteLength': lImageFile['byteLength'],
+                'byteOffset': lByteOffset
+            })
+            lImageChunks.append((lByteOffset, lImageFile['byteLength'], lImageFile['path']))
+            lByteLength = lByteOffset + lImageFile['byteLength']
 
-        lGLTFImage['bufferView'] = lBufferViewIdx
+        lGLTFImage['bufferView'] = lContentMap[lContentKey]
+        lGLTFImage['mimeType'] = lImageFile['mimeType']
         del lGLTFImage['uri']
+        lExtras = GetImageExtras(lImageFile)
+        if len(lExtras) > 0:
+            lGLTFImage['extras'] = lExtras
 
-        lBufferView = {
-            'buffer': 0,
-            'byteLength': len(lImgBytes),
-            'byteOffset': len(pBuffer)
-            # TODO Mime type
+    return lImageChunks, (lByteLength + 3) & ~3
+
+def WriteBinaryChunk(pOutFile, pBuffer, pImageChunks, pByteLength):
+    pOutFile.write(pBuffer)
+    lByteOffset = len(pBuffer)
+    for lImageOffset, lImageByteLength, lPath in pImageChunks:
+        pOutFile.write(b'\x00' * (lImageOffset - lByteOffset))
+        with open(lPath, 'rb') as f:
+            shutil.copyfileobj(f, pOutFile)
+        lByteOffset = lImageOffset + lImageByteLength
+    pOutFile.write(b'\x00' * (pByteLength - lByteOffset))
+
+# Shortest decimal which is the same float32, so accessor min and max are still exact.
+def ShortestFloat32(pValue):
+    lValue = struct.unpack('<f', struct.pack('<f', pValue))[0]
+    for lDigits in range(6, 10):
+        lShort = float('%.*g' % (lDigits, lValue))
+        if struct.unpack('<f', struct.pack('<f', lShort))[0] == lValue:
+            return lShort
+    return lValue
+
+def RoundList(pList, pDigits, pRound = round):
+    lScale = 10.0 ** pDigits
+    return [pRound(lValue * lScale) / lScale for lValue in pList]
+
+# Significant digits, so small values like the scale of unit conversion never become 0.
+def RoundListSignificant(pList, pDigits):
+    return [float('%.*g' % (max(pDigits, 1), lValue)) for lValue in pList]
+
+# Bounds stay conservative after rounding.
+def RoundBounds(pBounds, pDigits):
+    lScale = 10.0 ** pDigits
+    if 'min' in pBounds:
+        pBounds['min'] = RoundList(pBounds['min'], pDigits, math.floor)
+    if 'max' in pBounds:
+        pBounds['max'] = RoundList(pBounds['max'], pDigits, math.ceil)
+    for lKey in ['center', 'coneAxis']:
+        if lKey in pBounds:
+            pBounds[lKey] = RoundList(pBounds[lKey], pDigits)
+    if 'radius' in pBounds:
+        # Rounded center moves less than 1 / lScale
+        pBounds['radius'] = math.ceil(pBounds['radius'] * lScale + 1) / lScale
+    if 'coneCutoff' in pBounds:
+        pBounds['coneCutoff'] = math.floor(pBounds['coneCutoff'] * lScale) / lScale
+
+def RoundJSONFloats(pDigits):
+    for lGLTFAccessor in lib_accessors:
+        if lGLTFAccessor['componentType'] == GL_FLOAT:
+            for lKey in ['min', 'max']:
+                if lKey in lGLTFAccessor:
+                    lGLTFAccessor[lKey] = [ShortestFloat32(lValue) for lValue in lGLTFAccessor[lKey]]
+    if pDigits < 0:
+        return
+    for lGLTFNode in lib_nodes:
+        for lKey in ['translation', 'scale']:
+            if lKey in lGLTFNode:
+                lGLTFNode[lKey] = RoundListSignificant(lGLTFNode[lKey], pDigits)
+        if 'rotation' in lGLTFNode:
+            lRotation = RoundList(lGLTFNode['rotation'], pDigits)
+            lLength = math.sqrt(sum(lValue * lValue for lValue in lRotation))
+            if lLength > 0:
+                lGLTFNode['rotation'] = [ShortestFloat32(lValue / lLength) for lValue in lRotation]
+        # Only translation of the matrix, rounding the basis would skew it.
+        if 'matrix' in lGLTFNode:
+            lGLTFNode['matrix'] = lGLTFNode['matrix'][:12] + RoundListSignificant(lGLTFNode['matrix'][12:15], pDigits) + lGLTFNode['matrix'][15:]
+        if 'bounds' in lGLTFNode.get('extras', {}):
+            RoundBounds(lGLTFNode['extras']['bounds'], pDigits)
+    for lGLTFScene in lib_scenes:
+        for lEntry in lGLTFScene.get('extras', {}).get('bvh', []):
+            RoundBounds(lEntry, pDigits)
+    for lGLTFMesh in lib_meshes:
+        for lGLTFPrimitive in lGLTFMesh['primitives']:
+            if 'cluster' in lGLTFPrimitive.get('extras', {}):
+                RoundBounds(lGLTFPrimitive['extras']['cluster'], pDigits)
+
+def EncodeJSON(pValue, pBeautify):
+    if not orjson == None:
+        try:
+            return orjson.dumps(pValue, option = orjson.OPT_SORT_KEYS | orjson.OPT_SERIALIZE_NUMPY | (orjson.OPT_INDENT_2 if pBeautify else 0))
+        except TypeError:
+            pass
+    if pBeautify:
+        return json.dumps(pValue, indent = 2, sort_keys = True, separators = (',', ': ')).encode('utf-8')
+    return _jsonEncoder.encode(pValue).encode('utf-8')
+_jsonEncoder = json.JSONEncoder(sort_keys = True, separators = (',', ':'))
+
+# Write the json incrementally, items of top level arrays are encoded one by one.
+# Returns the byte length written.
+def WriteJSON(pOutFile, pJSON, pBeautify):
+    lByteLength = 0
+    def Write(pBytes):
+        nonlocal lByteLength
+        pOutFile.write(pBytes)
+        lByteLength += len(pBytes)
+
+    lIndent = b'\n  ' if pBeautify else b''
+    lKeys = sorted(pJSON.keys())
+    Write(b'{')
+    for i in range(len(lKeys)):
+        lKey = lKeys[i]
+        lValue = pJSON[lKey]
+        Write((b',' if i > 0 else b'') + lIndent + EncodeJSON(lKey, False) + (b': ' if pBeautify else b':'))
+        if isinstance(lValue, list) and len(lValue) > 0:
+            Write(b'[')
+            for j in range(len(lValue)):
+                lItem = EncodeJSON(lValue[j], pBeautify)
+                if pBeautify:
+                    lItem = b'\n    ' + lItem.replace(b'\n', b'\n    ')
+                Write(lItem if j == 0 else b',' + lItem)
+            Write(lIndent + b']')
+        else:
+            lValue = EncodeJSON(lValue, pBeautify)
+            Write(lValue.replace(b'\n', b'\n  ') if pBeautify else lValue)
+    Write((b'\n' if pBeautify else b'') + b'}')
+    return lByteLength
+
+_textureRoles = ['baseColor', 'normal', 'emissive']
+
+# Max size of each texture role, 0 is unlimited.
+def ParseTextureSize(pStr):
+    lSizes = {}
+    for lItem in pStr.split(','):
+        if not lItem:
+            continue
+        if ':' in lItem:
+            lRole, lSize = lItem.split(':')
+            lSizes[lRole] = int(lSize)
+        else:
+            for lRole in _textureRoles:
+                lSizes[lRole] = int(lItem)
+    return lSizes
+
+def GetImagesTextureUsage():
+    lImageRoles = {}
+    lImageRepeat = {}
+    def AddRole(pTextureInfo, pRole):
+        if pTextureInfo:
+            lImageIdx = lib_textures[pTextureInfo['index']]['source']
+            lImageRoles.setdefault(lImageIdx, set()).add(pRole)
+    for lGLTFMaterial in lib_materials:
+        AddRole(lGLTFMaterial.get('pbrMetallicRoughness', {}).get('baseColorTexture'), 'baseColor')
+        AddRole(lGLTFMaterial.get('normalTexture'), 'normal')
+        AddRole(lGLTFMaterial.get('emissiveTexture'), 'emissive')
+    for lGLTFTexture in lib_textures:
+        lSampler = lib_samplers[lGLTFTexture['sampler']]
+        if lSampler['wrapS'] == GL_REPEAT or lSampler['wrapT'] == GL_REPEAT:
+            lImageRepeat[lGLTFTexture['source']] = True
+    return lImageRoles, lImageRepeat
+
+def NearestPowerOfTwo(pValue):
+    # Same with the runtime conversion in clay.Texture2D
+    return int(math.pow(2, round(math.log(pValue) / math.log(2))))
+
+def GetTextureTargetSize(pWidth, pHeight, pMaxSize, pPowerOfTwo):
+    lScale = 1.0
+    if pMaxSize > 0 and max(pWidth, pHeight) > pMaxSize:
+        lScale = pMaxSize / float(max(pWidth, pHeight))
+    lWidth = max(int(round(pWidth * lScale)), 1)
+    lHeight = max(int(round(pHeight * lScale)), 1)
+    if pPowerOfTwo:
+        lWidth = NearestPowerOfTwo(lWidth)
+        lHeight = NearestPowerOfTwo(lHeight)
+        if pMaxSize > 0:
+            while lWidth > pMaxSize or lHeight > pMaxSize:
+                lWidth = max(lWidth >> 1, 1)
+                lHeight = max(lHeight >> 1, 1)
+    return lWidth, lHeight
+
+def SaveTextureImage(pImage, pPath, pFormat):
+    if pFormat == 'JPEG':
+        pImage.convert('RGB').save(pPath, 'JPEG', quality = ENV_TEXTURE_QUALITY)
+    else:
+        pImage.save(pPath, 'PNG', optimize = True)
+
+def GetImageSize(pPath):
+    with Image.open(pPath) as lImage:
+        return lImage.size
+
+# Resize and encode image to the cache directory. File name is the hash of content and settings,
+# so processed image can be reused in the next conversion.
+def ResizeImageFile(pPath, pMaxSize, pPowerOfTwo, pMipmaps):
+    with Image.open(pPath) as lImage:
+        lWidth, lHeight = GetTextureTargetSize(lImage.size[0], lImage.size[1], pMaxSize, pPowerOfTwo)
+        lHasAlpha = 'A' in lImage.getbands() or 'transparency' in lImage.info
+        lFormat = lImage.format
+        if ENV_TEXTURE_FORMAT == 'png' or (lFormat != 'JPEG' and lFormat != 'PNG'):
+            lFormat = 'PNG'
+        elif ENV_TEXTURE_FORMAT == 'jpeg' and not lHasAlpha:
+            lFormat = 'JPEG'
+
+        if (lWidth, lHeight) == lImage.size and lFormat == lImage.format and not pMipmaps:
+            return pPath, []
+
+        lSettings = '%d %d %s %d %d' % (lWidth, lHeight, lFormat, ENV_TEXTURE_QUALITY, int(pMipmaps))
+        lKey = hashlib.sha1((HashFile(pPath) + lSettings).encode('utf-8')).hexdigest()
+        lExt = '.jpg' if lFormat == 'JPEG' else '.png'
+        lCacheDir = _textureTaskOptions['textureCacheDir']
+        lOutPath = os.path.join(lCacheDir, lKey + lExt)
+        lMipPaths = []
+        if pMipmaps:
+            lMipWidth, lMipHeight = lWidth, lHeight
+            while lMipWidth > 1 or lMipHeight > 1:
+                lMipWidth = max(lMipWidth >> 1, 1)
+                lMipHeight = max(lMipHeight >> 1, 1)
+                lMipPaths.append((lMipWidth, lMipHeight, os.path.join(lCacheDir, '%s_mip%d%s' % (lKey, len(lMipPaths) + 1, lExt))))
+
+        if not os.path.exists(lOutPath) or not all(os.path.exists(lMip[2]) for lMip in lMipPaths):
+            os.makedirs(lCacheDir, exist_ok = True)
+            if lFormat == 'JPEG':
+                lImage = lImage.convert('RGB')
+            elif not lImage.mode in ('RGB', 'RGBA', 'L', 'LA'):
+                lImage = lImage.convert('RGBA')
+            lResized = lImage.resize((lWidth, lHeight), Image.LANCZOS) if (lWidth, lHeight) != lImage.size else lImage
+            SaveTextureImage(lResized, lOutPath, lFormat)
+            for lMipWidth, lMipHeight, lMipPath in lMipPaths:
+                SaveTextureImage(lResized.resize((lMipWidth, lMipHeight), Image.LANCZOS), lMipPath, lFormat)
+        return lOutPath, [lMip[2] for lMip in lMipPaths]
+
+def ProcessTextureImage(pImageFile, pMaxSize, pPowerOfTwo, pMipmaps):
+    lPath, lMipPaths = ResizeImageFile(pImageFile['path'], pMaxSize, pPowerOfTwo, pMipmaps)
+    if lPath == pImageFile['path']:
+        return pImageFile
+
+    if _textureTaskOptions['binary']:
+        return {
+            'path': lPath,
+            'byteLength': os.path.getsize(lPath),
+            'hash': HashFile(lPath),
+            'mimeType': GetImageMimeType(lPath)
         }
 
-        lib_buffer_views.append(lBufferView)
+    lOutputDir = _textureTaskOptions['outputDir']
+    lStem = os.path.splitext(pImageFile['uri'])[0]
+    lExt = os.path.splitext(lPath)[1]
+    lRelUri = lStem + '_processed' + lExt
+    lCopied = CopyFileIfChanged(lPath, os.path.join(lOutputDir, lRelUri))
+    lMipUris = []
+    for i in range(len(lMipPaths)):
+        lMipUri = '%s_processed_mip%d%s' % (lStem, i + 1, lExt)
+        CopyFileIfChanged(lMipPaths[i], os.path.join(lOutputDir, lMipUri))
+        lMipUris.append(lMipUri)
+    return {
+        'path': lPath,
+        'uri': lRelUri,
+        'copied': lCopied or pImageFile['copied'],
+        'mipmaps': lMipUris
+    }
 
-        pBuffer.extend(lImgBytes)
-        # 4-byte-aligned
-        lAlignedLen = (len(lImgBytes) + 3) & ~3
-        for i in range(lAlignedLen - len(lImgBytes)):
-            pBuffer.extend(b' ')
+# Downscale, power of two and mipmap generation of the textures. Needs Pillow.
+def ProcessTextures():
+    if Image == None:
+        print('Texture processing needs Pillow, skipped. Install it with "pip install Pillow".')
+        return
+    lImageRoles, lImageRepeat = GetImagesTextureUsage()
+    for i in range(len(lib_images)):
+        lImageFile = GetImageFile(i)
+        if not lImageFile:
+            continue
+        lMaxSize = 0
+        for lRole in lImageRoles.get(i, []):
+            lRoleSize = ENV_TEXTURE_MAX_SIZE.get(lRole, 0)
+            if lRoleSize > 0:
+                lMaxSize = lRoleSize if lMaxSize == 0 else min(lMaxSize, lRoleSize)
+        # GL_REPEAT needs power of two texture in WebGL1
+        lPowerOfTwo = ENV_TEXTURE_POT and lImageRepeat.get(i, False)
+        # Mipmaps are only written as separate files.
+        lMipmaps = ENV_TEXTURE_MIPMAPS and not _textureTaskOptions['binary']
+        _imageTasks[i] = _textureExecutor.submit(ProcessTextureImage, lImageFile, lMaxSize, lPowerOfTwo, lMipmaps)
+
+# Block compression of textures, written as DDS or KTX files next to the glTF.
+# Opaque textures use BC1(DXT1) and transparent textures use BC3(DXT5), which are uploaded
+# with WEBGL_compressed_texture_s3tc. Needs NumPy and Pillow.
+_compressBlockChunk = 16384
+
+# Split image pixels into 4x4 blocks, edge pixels are repeated to fill the incomplete blocks.
+def GetImageBlocks(pPixels):
+    lHeight, lWidth = pPixels.shape[:2]
+    lPadHeight = (4 - lHeight % 4) % 4
+    lPadWidth = (4 - lWidth % 4) % 4
+    if lPadHeight > 0 or lPadWidth > 0:
+        pPixels = np.pad(pPixels, ((0, lPadHeight), (0, lPadWidth), (0, 0)), mode = 'edge')
+    lHeight, lWidth, lChannels = pPixels.shape
+    lBlocks = pPixels.reshape(lHeight // 4, 4, lWidth // 4, 4, lChannels).transpose(0, 2, 1, 3, 4)
+    return lBlocks.reshape(-1, 16, lChannels).astype(np.float32)
+
+def QuantizeRGB565(pColors):
+    lR = np.clip(np.round(pColors[:, 0] * 31 / 255), 0, 31).astype(np.uint16)
+    lG = np.clip(np.round(pColors[:, 1] * 63 / 255), 0, 63).astype(np.uint16)
+    lB = np.clip(np.round(pColors[:, 2] * 31 / 255), 0, 31).astype(np.uint16)
+    return (lR << 11) | (lG << 5) | lB
+
+def DequantizeRGB565(pValues):
+    lR = (pValues >> 11) & 31
+    lG = (pValues >> 5) & 63
+    lB = pValues & 31
+    return np.stack([lR * 255 / 31.0, lG * 255 / 63.0, lB * 255 / 31.0], axis = 1).astype(np.float32)
+
+# BC1 color blocks. Endpoints are the extremes of the colors projected on the principal axis.
+def EncodeColorBlocks(pBlocks):
+    lCount = len(pBlocks)
+    lMean = pBlocks.mean(axis = 1)
+    lCentered = pBlocks - lMean[:, None, :]
+    lCovariance = np.einsum('nki,nkj->nij', lCentered, lCentered)
+    # Power iteration
+    lAxis = np.ones((lCount, 3), dtype = np.float32)
+    for i in range(8):
+        lAxis = np.einsum('nij,nj->ni', lCovariance, lAxis)
+        lAxis /= np.maximum(np.linalg.norm(lAxis, axis = 1, keepdims = True), 1e-8)
+    lProjection = np.einsum('nki,ni->nk', lCentered, lAxis)
+    lMax = lMean + lAxis * lProjection.max(axis = 1)[:, None]
+    lMin = lMean + lAxis * lProjection.min(axis = 1)[:, None]
+
+    lColor0 = QuantizeRGB565(np.clip(lMax, 0, 255))
+    lColor1 = QuantizeRGB565(np.clip(lMin, 0, 255))
+    # color0 > color1 is the four colors mode.
+    lSwap = lColor0 < lColor1
+    lColor0, lColor1 = np.where(lSwap, lColor1, lColor0), np.where(lSwap, lColor0, lColor1)
+    lEndpoint0 = DequantizeRGB565(lColor0)
+    lEndpoint1 = DequantizeRGB565(lColor1)
+    lPalette = np.stack([
+        lEndpoint0, lEndpoint1,
+        (lEndpoint0 * 2 + lEndpoint1) / 3, (lEndpoint0 + lEndpoint1 * 2) / 3
+    ], axis = 1)
+    lDistance = ((pBlocks[:, :, None, :] - lPalette[:, None, :, :]) ** 2).sum(axis = 3)
+    lIndices = lDistance.argmin(axis = 2).astype(np.uint32)
+    lIndices[lColor0 == lColor1] = 0
+    lBits = (lIndices << (np.arange(16, dtype = np.uint32) * 2)).sum(axis = 1, dtype = np.uint32)
+
+    lOut = np.empty((lCount, 8), dtype = np.uint8)
+    lOut[:, 0:2] = lColor0.astype('<u2').view(np.uint8).reshape(-1, 2)
+    lOut[:, 2:4] = lColor1.astype('<u2').view(np.uint8).reshape(-1, 2)
+    lOut[:, 4:8] = lBits.astype('<u4').view(np.uint8).reshape(-1, 4)
+    return lOut
+
+# BC3 alpha blocks in the eight alphas mode.
+def EncodeAlphaBlocks(pAlphas):
+    lAlpha0 = np.round(pAlphas.max(axis = 1))
+    lAlpha1 = np.round(pAlphas.min(axis = 1))
+    lPalette = np.stack([lAlpha0, lAlpha1] + [
+        ((7 - k) * lAlpha0 + k * lAlpha1) / 7 for k in range(1, 7)
+    ], axis = 1)
+    lIndices = np.abs(pAlphas[:, :, None] - lPalette[:, None, :]).argmin(axis = 2).astype(np.uint64)
+    lBits = (lIndices << (np.arange(16, dtype = np.uint64) * 3)).sum(axis = 1, dtype = np.uint64)
+
+    lOut = np.empty((len(pAlphas), 8), dtype = np.uint8)
+    lOut[:, 0] = lAlpha0
+    lOut[:, 1] = lAlpha1
+    lOut[:, 2:8] = lBits.astype('<u8').view(np.uint8).reshape(-1, 8)[:, 0:6]
+    return lOut
+
+def CompressImageLevel(pImage, pHasAlpha):
+    lBlocks = GetImageBlocks(np.asarray(pImage.convert('RGBA')))
+    lChunks = []
+    # Encode in chunks to limit the memory of the palette distances.
+    for i in range(0, len(lBlocks), _compressBlockChunk):
+        lChunk = lBlocks[i:i + _compressBlockChunk]
+        lColorBlocks = EncodeColorBlocks(lChunk[:, :, 0:3])
+        if pHasAlpha:
+            lChunks.append(np.concatenate([EncodeAlphaBlocks(lChunk[:, :, 3]), lColorBlocks], axis = 1))
+        else:
+            lChunks.append(lColorBlocks)
+    return np.concatenate(lChunks).tobytes()
+
+def WriteDDSFile(pPath, pWidth, pHeight, pHasAlpha, pLevels):
+    DDSD_CAPS, DDSD_HEIGHT, DDSD_WIDTH, DDSD_PIXELFORMAT, DDSD_MIPMAPCOUNT, DDSD_LINEARSIZE = 0x1, 0x2, 0x4, 0x1000, 0x20000, 0x80000
+    DDSCAPS_COMPLEX, DDSCAPS_TEXTURE, DDSCAPS_MIPMAP = 0x8, 0x1000, 0x400000
+    DDPF_FOURCC = 0x4
+    lHeader = struct.pack('<4s7I44x', b'DDS ',
+        124, DDSD_CAPS | DDSD_HEIGHT | DDSD_WIDTH | DDSD_PIXELFORMAT | DDSD_MIPMAPCOUNT | DDSD_LINEARSIZE,
+        pHeight, pWidth, len(pLevels[0]), 0, len(pLevels))
+    lHeader += struct.pack('<2I4s5I', 32, DDPF_FOURCC, b'DXT5' if pHasAlpha else b'DXT1', 0, 0, 0, 0, 0)
+    lHeader += struct.pack('<4I4x', DDSCAPS_COMPLEX | DDSCAPS_TEXTURE | DDSCAPS_MIPMAP, 0, 0, 0)
+    with open(pPath, 'wb') as f:
+        f.write(lHeader)
+        for lLevel in pLevels:
+            f.write(lLevel)
+
+def WriteKTXFile(pPath, pWidth, pHeight, pHasAlpha, pLevels):
+    lInternalFormat = GL_COMPRESSED_RGBA_S3TC_DXT5_EXT if pHasAlpha else GL_COMPRESSED_RGB_S3TC_DXT1_EXT
+    lHeader = b'\xabKTX 11\xbb\r\n\x1a\n' + struct.pack('<13I',
+        0x04030201, 0, 1, 0, lInternalFormat, GL_RGBA if pHasAlpha else GL_RGB,
+        pWidth, pHeight, 0, 0, 1, len(pLevels), 0)
+    with open(pPath, 'wb') as f:
+        f.write(lHeader)
+        # Block sizes are always 4-byte-aligned.
+        for lLevel in pLevels:
+            f.write(struct.pack('<I', len(lLevel)))
+            f.write(lLevel)
+
+# Compress image with full mipmap chain to the cache directory.
+def CompressImageFile(pPath, pContainer):
+    lKey = hashlib.sha1((HashFile(pPath) + ' ' + pContainer).encode('utf-8')).hexdigest()
+    lCacheDir = _textureTaskOptions['textureCacheDir']
+    lOutPath = os.path.join(lCacheDir, lKey + '.' + pContainer)
+    if os.path.exists(lOutPath):
+        return lOutPath
+
+    with Image.open(pPath) as lSourceImage:
+        lImage = lSourceImage.convert('RGBA')
+    lHasAlpha = lImage.getextrema()[3][0] < 255
+    # Mipmaps of compressed texture needs power of two size in WebGL1.
+    lWidth = max(NearestPowerOfTwo(lImage.size[0]), 4)
+    lHeight = max(NearestPowerOfTwo(lImage.size[1]), 4)
+    if (lWidth, lHeight) != lImage.size:
+        lImage = lImage.resize((lWidth, lHeight), Image.LANCZOS)
+    lLevels = [CompressImageLevel(lImage, lHasAlpha)]
+    while lImage.size[0] > 1 or lImage.size[1] > 1:
+        lImage = lImage.resize((max(lImage.size[0] >> 1, 1), max(lImage.size[1] >> 1, 1)), Image.BOX)
+        lLevels.append(CompressImageLevel(lImage, lHasAlpha))
+
+    os.makedirs(lCacheDir, exist_ok = True)
+    if pContainer == 'ktx':
+        WriteKTXFile(lOutPath, lWidth, lHeight, lHasAlpha, lLevels)
+    else:
+        WriteDDSFile(lOutPath, lWidth, lHeight, lHasAlpha, lLevels)
+    return lOutPath
+
+def CompressTextureImage(pImageFile, pStem, pContainers):
+    lCompressed = {}
+    for lContainer in pContainers:
+        lPath = CompressImageFile(pImageFile['path'], lContainer)
+        lUri = pStem + '.' + lContainer
+        CopyFileIfChanged(lPath, os.path.join(_textureTaskOptions['outputDir'], lUri))
+        lCompressed[lContainer] = lUri
+    lImageFile = dict(pImageFile)
+    lImageFile['compressed'] = lCompressed
+    return lImageFile
+
+# Compressed textures are always separate files and listed in the extras of image.
+# The original image is kept for the renderers without the compressed texture extension.
+def CompressTextures(pContainers):
+    if Image == None or np == None:
+        print('Texture compression needs Pillow and NumPy, skipped. Install them with "pip install Pillow numpy".')
+        return
+    for i in range(len(lib_images)):
+        lImageFile = GetImageFile(i)
+        if not lImageFile:
+            continue
+        if _textureTaskOptions['binary']:
+            lStem = os.path.splitext(re.split(r'[\\/]+', lib_images[i]['uri'])[-1])[0]
+        else:
+            lStem = os.path.splitext(lImageFile['uri'])[0]
+        _imageTasks[i] = _textureExecutor.submit(CompressTextureImage, lImageFile, lStem, pContainers)
+
+def GetImageExtras(pImageFile):
+    lExtras = {}
+    if pImageFile.get('mipmaps'):
+        lExtras['mipmaps'] = pImageFile['mipmaps']
+    if pImageFile.get('compressed'):
+        lExtras['compressed'] = pImageFile['compressed']
+    return lExtras
+
+# Texture atlas. Materials only different in the base color texture are merged into one material
+# with their textures packed in atlases, so the primitives can be batched. Needs Pillow.
+_atlasPadding = 2
+_atlasUVEpsilon = 1e-3
+
+def GetAtlasMaterialKey(pGLTFMaterial):
+    lValues = pGLTFMaterial['pbrMetallicRoughness']
+    lTextureInfo = lValues.get('baseColorTexture')
+    # Atlas is not compatible with KHR_texture_transform.
+    if not lTextureInfo or lTextureInfo.get('texCoord', 0) != 0 or 'extensions' in lTextureInfo:
+        return None
+    # Other textures would need to be packed in the same layout.
+    if 'normalTexture' in pGLTFMaterial or 'emissiveTexture' in pGLTFMaterial \
+        or 'occlusionTexture' in pGLTFMaterial or 'metallicRoughnessTexture' in lValues:
+        return None
+    lContent = dict((k, v) for k, v in pGLTFMaterial.items() if k != 'name' and k != 'pbrMetallicRoughness')
+    lContent['pbrMetallicRoughness'] = dict((k, v) for k, v in lValues.items() if k != 'baseColorTexture')
+    lSamplerIdx = lib_textures[lTextureInfo['index']]['sampler']
+    return json.dumps(lContent, sort_keys = True) + ' ' + str(lSamplerIdx)
+
+def GetMaterialPrimitives():
+    lMaterialPrimitives = {}
+    for lGLTFMesh in lib_meshes:
+        for lGLTFPrimitive in lGLTFMesh['primitives']:
+            if 'material' in lGLTFPrimitive:
+                lMaterialPrimitives.setdefault(lGLTFPrimitive['material'], []).append(lGLTFPrimitive)
+    return lMaterialPrimitives
+
+def IsUVInRange(pAccessorIdx):
+    for lUV in ReadAccessorData(attributeBuffer, pAccessorIdx):
+        if lUV[0] < -_atlasUVEpsilon or lUV[0] > 1 + _atlasUVEpsilon \
+            or lUV[1] < -_atlasUVEpsilon or lUV[1] > 1 + _atlasUVEpsilon:
+            return False
+    return True
+
+# Textures can be packed if all the primitives using them have texcoords of their own in [0, 1],
+# whatever the wrap mode. Texcoords out of range would sample the neighbour tiles.
+def CanPackTexture(pTextureIdx, pMaterials, pPrimitives, pAccessorMaterials, pTileSize):
+    lImageFile = GetImageFile(lib_textures[pTextureIdx]['source'])
+    if not lImageFile:
+        return False
+    lWidth, lHeight = GetImageSize(lImageFile['path'])
+    if lWidth > pTileSize or lHeight > pTileSize:
+        return False
+    for lGLTFPrimitive in pPrimitives:
+        lAccessorIdx = lGLTFPrimitive['attributes'].get('TEXCOORD_0')
+        if lAccessorIdx == None or not IsFloatAccessor(lAccessorIdx):
+            return False
+        # Texcoords shared with materials not packed with this texture can't be remapped.
+        if not pAccessorMaterials[lAccessorIdx] <= set(pMaterials):
+            return False
+        if not IsUVInRange(lAccessorIdx):
+            return False
+    return True
+
+# Shelf packing. Returns the atlas index and position of each tile, and the atlas sizes.
+def PackAtlasTiles(pSizes, pMaxSize):
+    lPlacements = [None] * len(pSizes)
+    lAtlasSizes = []
+    # Atlas index, x, y, height of current shelf
+    lShelf = None
+    for i in sorted(range(len(pSizes)), key = lambda i: -pSizes[i][1]):
+        lWidth = pSizes[i][0] + _atlasPadding * 2
+        lHeight = pSizes[i][1] + _atlasPadding * 2
+        if lShelf == None or lShelf[1] + lWidth > pMaxSize:
+            if lShelf == None or lShelf[2] + lShelf[3] + lHeight > pMaxSize:
+                lAtlasSizes.append([0, 0])
+                lShelf = [len(lAtlasSizes) - 1, 0, 0, lHeight]
+            else:
+                lShelf = [lShelf[0], 0, lShelf[2] + lShelf[3], lHeight]
+        lPlacements[i] = (lShelf[0], lShelf[1] + _atlasPadding, lShelf[2] + _atlasPadding)
+        lShelf[1] += lWidth
+        lAtlasSize = lAtlasSizes[lShelf[0]]
+        lAtlasSize[0] = max(lAtlasSize[0], lShelf[1])
+        lAtlasSize[1] = max(lAtlasSize[1], lShelf[2] + lShelf[3])
+    # Power of two for mipmaps.
+    return lPlacements, [(1 << (lWidth - 1).bit_length(), 1 << (lHeight - 1).bit_length()) for lWidth, lHeight in lAtlasSizes]
+
+# Edge pixels are extended into the padding to avoid bleeding of linear filtering.
+def PasteAtlasTile(pAtlas, pTile, x, y):
+    lWidth, lHeight = pTile.size
+    p = _atlasPadding
+    pAtlas.paste(pTile, (x, y))
+    pAtlas.paste(pTile.crop((0, 0, lWidth, 1)).resize((lWidth, p)), (x, y - p))
+    pAtlas.paste(pTile.crop((0, lHeight - 1, lWidth, lHeight)).resize((lWidth, p)), (x, y + lHeight))
+    pAtlas.paste(pTile.crop((0, 0, 1, lHeight)).resize((p, lHeight)), (x - p, y))
+    pAtlas.paste(pTile.crop((lWidth - 1, 0, lWidth, lHeight)).resize((p, lHeight)), (x + lWidth, y))
+    for lCornerX, lCornerY, lTargetX, lTargetY in [
+        (0, 0, x - p, y - p), (lWidth - 1, 0, x + lWidth, y - p),
+        (0, lHeight - 1, x - p, y + lHeight), (lWidth - 1, lHeight - 1, x + lWidth, y + lHeight)
+    ]:
+        pAtlas.paste(pTile.crop((lCornerX, lCornerY, lCornerX + 1, lCornerY + 1)).resize((p, p)), (lTargetX, lTargetY))
+
+def CreateAtlasImageFile(pTiles, pSize, pName):
+    lPaths = [lTile[0] for lTile in pTiles]
+    lFormat = 'JPEG' if all(GetImageMimeType(lPath) == 'image/jpeg' for lPath in lPaths) else 'PNG'
+    lExt = '.jpg' if lFormat == 'JPEG' else '.png'
+    lSettings = ' '.join('%s %d %d' % (HashFile(lPath), x, y) for lPath, x, y in pTiles)
+    lKey = hashlib.sha1(('%d %d %s %d ' % (pSize[0], pSize[1], lFormat, ENV_TEXTURE_QUALITY) + lSettings).encode('utf-8')).hexdigest()
+    lCacheDir = _textureTaskOptions['textureCacheDir']
+    lPath = os.path.join(lCacheDir, lKey + lExt)
+    if not os.path.exists(lPath):
+        lMode = 'RGB' if lFormat == 'JPEG' else 'RGBA'
+        lAtlas = Image.new(lMode, pSize)
+        for lTilePath, x, y in pTiles:
+            with Image.open(lTilePath) as lTile:
+                PasteAtlasTile(lAtlas, lTile.convert(lMode), x, y)
+        os.makedirs(lCacheDir, exist_ok = True)
+        SaveTextureImage(lAtlas, lPath, lFormat)
+
+    if _textureTaskOptions['binary']:
+        return {
+            'path': lPath,
+            'byteLength': os.path.getsize(lPath),
+            'hash': HashFile(lPath),
+            'mimeType': GetImageMimeType(lPath)
+        }
+    lUri = pName + lExt
+    return {
+        'path': lPath,
+        'uri': lUri,
+        'copied': CopyFileIfChanged(lPath, os.path.join(_textureTaskOptions['outputDir'], lUri))
+    }
 
-    return pBuffer
+# Tile rect is top down in the atlas image, so is v if it's flipped.
+def RemapAtlasUV(pAccessorIdx, pTileRect, pAtlasSize):
+    x, y, lWidth, lHeight = pTileRect
+    lList = []
+    for lUV in ReadAccessorData(attributeBuffer, pAccessorIdx):
+        if ENV_FLIP_V:
+            lV = (y + lUV[1] * lHeight) / pAtlasSize[1]
+        else:
+            lV = 1 - (y + (1 - lUV[1]) * lHeight) / pAtlasSize[1]
+        lList.append([(x + lUV[0] * lWidth) / pAtlasSize[0], lV])
+    WriteAccessorData(attributeBuffer, pAccessorIdx, lList)
+
+# Remove materials, textures and images which are not used anymore.
+def CompactMaterials():
+    lMaterialPrimitives = GetMaterialPrimitives()
+    lUsedMaterials = sorted(lMaterialPrimitives.keys())
+    for i in range(len(lUsedMaterials)):
+        for lGLTFPrimitive in lMaterialPrimitives[lUsedMaterials[i]]:
+            lGLTFPrimitive['material'] = i
+    lib_materials[:] = [lib_materials[lMaterialIdx] for lMaterialIdx in lUsedMaterials]
+
+    lTextureInfos = []
+    for lGLTFMaterial in lib_materials:
+        for lTextureInfo in [
+            lGLTFMaterial['pbrMetallicRoughness'].get('baseColorTexture'),
+            lGLTFMaterial['pbrMetallicRoughness'].get('metallicRoughnessTexture'),
+            lGLTFMaterial.get('normalTexture'),
+            lGLTFMaterial.get('occlusionTexture'),
+            lGLTFMaterial.get('emissiveTexture')
+        ]:
+            if lTextureInfo:
+                lTextureInfos.append(lTextureInfo)
+    lUsedTextures = sorted(set(lTextureInfo['index'] for lTextureInfo in lTextureInfos))
+    lTextureIdxMap = dict((lUsedTextures[i], i) for i in range(len(lUsedTextures)))
+    for lTextureInfo in lTextureInfos:
+        lTextureInfo['index'] = lTextureIdxMap[lTextureInfo['index']]
+    lib_textures[:] = [lib_textures[lTextureIdx] for lTextureIdx in lUsedTextures]
+
+    lUsedImages = sorted(set(lGLTFTexture['source'] for lGLTFTexture in lib_textures))
+    lImageIdxMap = dict((lUsedImages[i], i) for i in range(len(lUsedImages)))
+    for lGLTFTexture in lib_textures:
+        lGLTFTexture['source'] = lImageIdxMap[lGLTFTexture['source']]
+    lib_images[:] = [lib_images[lImageIdx] for lImageIdx in lUsedImages]
+    lImageTasks = dict(_imageTasks)
+    _imageTasks.clear()
+    for lImageIdx in lUsedImages:
+        if lImageIdx in lImageTasks:
+            _imageTasks[lImageIdxMap[lImageIdx]] = lImageTasks[lImageIdx]
+
+    # Indices in the maps are not valid anymore.
+    _materialIdMap.clear()
+    _materialContentMap.clear()
+    _textureHashMap.clear()
+    _imageHashMap.clear()
+
+def PackTextureAtlas(pAtlasSize, pTileSize):
+    if Image == None:
+        print('Texture atlas needs Pillow, skipped. Install it with "pip install Pillow".')
+        return
+    # Atlas size must be power of two.
+    pAtlasSize = 1 << (pAtlasSize.bit_length() - 1)
+    pTileSize = min(pTileSize, pAtlasSize - _atlasPadding * 2)
+
+    lMaterialPrimitives = GetMaterialPrimitives()
+    lAccessorMaterials = {}
+    for lGLTFMesh in lib_meshes:
+        for lGLTFPrimitive in lGLTFMesh['primitives']:
+            lAccessorIdx = lGLTFPrimitive['attributes'].get('TEXCOORD_0')
+            if not lAccessorIdx == None:
+                lAccessorMaterials.setdefault(lAccessorIdx, set()).add(lGLTFPrimitive.get('material', -1))
+
+    lGroups = {}
+    for lMaterialIdx in lMaterialPrimitives.keys():
+        lKey = GetAtlasMaterialKey(lib_materials[lMaterialIdx])
+        if not lKey == None:
+            lTextureIdx = lib_materials[lMaterialIdx]['pbrMetallicRoughness']['baseColorTexture']['index']
+            lGroups.setdefault(lKey, {}).setdefault(lTextureIdx, []).append(lMaterialIdx)
+
+    lPackedTextures = 0
+    lMergedMaterials = 0
+    lAtlasCount = 0
+    for lKey in sorted(lGroups.keys()):
+        lTextureMaterials = lGroups[lKey]
+        lTextures = []
+        for lTextureIdx in sorted(lTextureMaterials.keys()):
+            lPrimitives = sum([lMaterialPrimitives[lMaterialIdx] for lMaterialIdx in lTextureMaterials[lTextureIdx]], [])
+            if CanPackTexture(lTextureIdx, lTextureMaterials[lTextureIdx], lPrimitives, lAccessorMaterials, pTileSize):
+                lTextures.append(lTextureIdx)
+        if len(lTextures) < 2:
+            continue
+
+        lPaths = [GetImageFile(lib_textures[lTextureIdx]['source'])['path'] for lTextureIdx in lTextures]
+        lSizes = [GetImageSize(lPath) for lPath in lPaths]
+        lPlacements, lAtlasSizes = PackAtlasTiles(lSizes, pAtlasSize)
+        for lAtlasIdx in range(len(lAtlasSizes)):
+            lTiles = [i for i in range(len(lTextures)) if lPlacements[i][0] == lAtlasIdx]
+            if len(lTiles) < 2:
+                continue
+            lName = 'Atlas_%d' % lAtlasCount
+            lAtlasCount += 1
+
+            lImageIdx = len(lib_images)
+            lib_images.append({
+                'uri': lName
+            })
+            _imageTasks[lImageIdx] = _textureExecutor.submit(
+                CreateAtlasImageFile, [(lPaths[i], lPlacements[i][1], lPlacements[i][2]) for i in lTiles], lAtlasSizes[lAtlasIdx], lName
+            )
+            lGLTFTexture = dict(lib_textures[lTextures[lTiles[0]]])
+            lGLTFTexture['source'] = lImageIdx
+            lib_textures.append(lGLTFTexture)
+            lGLTFMaterial = json.loads(json.dumps(lib_materials[lTextureMaterials[lTextures[lTiles[0]]][0]]))
+            lGLTFMaterial['name'] = lName
+            lGLTFMaterial['pbrMetallicRoughness']['baseColorTexture']['index'] = len(lib_textures) - 1
+            lib_materials.append(lGLTFMaterial)
+
+            for i in lTiles:
+                lTileRect = (lPlacements[i][1], lPlacements[i][2], lSizes[i][0], lSizes[i][1])
+                lRemapped = set()
+                for lMaterialIdx in lTextureMaterials[lTextures[i]]:
+                    for lGLTFPrimitive in lMaterialPrimitives[lMaterialIdx]:
+                        lAccessorIdx = lGLTFPrimitive['attributes']['TEXCOORD_0']
+                        if not lAccessorIdx in lRemapped:
+                            lRemapped.add(lAccessorIdx)
+                            RemapAtlasUV(lAccessorIdx, lTileRect, lAtlasSizes[lAtlasIdx])
+                        lGLTFPrimitive['material'] = len(lib_materials) - 1
+                    lMergedMaterials += 1
+                lPackedTextures += 1
+
+    if lAtlasCount > 0:
+        CompactMaterials()
+    print('Packed %d textures into %d atlases, %d draw call groups are saved.' % (lPackedTextures, lAtlasCount, lMergedMaterials - lAtlasCount))
 
 # FIXME
 # http://help.autodesk.com/view/FBX/2017/ENU/?guid=__cpp_ref_fbxtime_8h_html
@@ -1395,7 +4443,12 @@ def Convert(
     duration = 1000,
     poseTime = TIME_INFINITY,
     beautify = False,
-    binary = False
+    binary = False,
+    flatten = False,
+    mergeMeshes = False,
+    batch = False,
+    atlas = False,
+    copyTextures = False
 ):
     ignoreScene = 'scene' in excluded
     ignoreAnimation = 'animation' in excluded
@@ -1418,7 +4471,9 @@ def Convert(
         lScene.GetRootNode().ConvertPivotAnimationRecursive(None, FbxNode.eDestinationPivot, 60)
 
         # PENDING Triangulate before SplitMeshesPerMaterial or it will not work.
-        fbxConverter.Triangulate(lScene, True)
+        # Polygons of the exported meshes are triangulated when converting if fast triangulation is used.
+        if not ENV_FAST_TRIANGULATE or np == None:
+            fbxConverter.Triangulate(lScene, True)
 
         # SplitMeshPerMaterial will fail if the mapped material is not per face (FbxLayerElement::eByPolygon) or if a material is multi-layered.
         # http://help.autodesk.com/view/FBX/2017/ENU/?guid=__cpp_ref_class_fbx_geometry_converter_html
@@ -1428,31 +4483,80 @@ def Convert(
 
         PrepareSceneNode(lScene.GetRootNode())
 
+        StartTextureTasks(filePath, ouptutFile, binary, copyTextures)
+
         if not ignoreScene:
             lSceneIdx = ConvertScene(lScene, poseTime)
         if not ignoreAnimation:
-            ConvertAnimation(lScene, animFrameRate, startTime, duration)
+            ConvertAnimation(lScene, animFrameRate, startTime, duration, poseTime)
+        # After animation so LOD nodes can follow the animation of base node.
+        if len(_meshLODs) > 0 and not ignoreScene:
+            CreateLODNodes()
+        # Atlas before batching so primitives of the merged materials can be batched.
+        if atlas and not ignoreScene:
+            PackTextureAtlas(ENV_ATLAS_SIZE, ENV_ATLAS_TILE_SIZE)
+        if batch and not ignoreScene:
+            BatchStaticMeshes(lSceneIdx)
+        if flatten and not ignoreScene:
+            FlattenScene(lSceneIdx, mergeMeshes)
+        # After flatten and batch, which transform the vertices.
+        if ENV_CLUSTER_TRIANGLES > 0 and not np == None:
+            ClusterMeshes(ENV_CLUSTER_TRIANGLES)
+        if ENV_SHORT_INDICES and not np == None:
+            SplitLargePrimitives()
+        # After all passes changing the nodes and vertices.
+        if ENV_BOUNDS and not np == None and not ignoreScene:
+            ComputeSceneBounds(lSceneIdx)
+        # Indices are reordered, so after all passes changing the indices.
+        if ENV_TRIANGLE_BVH > 0 and not np == None:
+            BuildTriangleBVHs(ENV_TRIANGLE_BVH)
+
+        if len(ENV_TEXTURE_MAX_SIZE) > 0 or ENV_TEXTURE_POT or ENV_TEXTURE_MIPMAPS or ENV_TEXTURE_FORMAT != 'keep':
+            ProcessTextures()
+        if len(ENV_TEXTURE_COMPRESS) > 0:
+            CompressTextures(ENV_TEXTURE_COMPRESS)
+
+        if ENV_SPLIT_BUFFERS == 'animation':
+            UnshareAnimationAccessors()
 
         #Merge binary data and write to a binary file
         lBin = bytearray()
 
         CreateBufferViews(0, lBin)
 
+        lBins = [lBin]
+        if not ENV_SPLIT_BUFFERS == 'none':
+            lBins = SplitBuffers(lBin, ENV_SPLIT_BUFFERS, ENV_BUFFER_MAX_SIZE)
+            lBin = lBins[0]
+
         if binary:
-            lBin = EmbedImagesToBinary(lBin, filePath)
+            lImageChunks, lBinByteLength = EmbedImagesToBinary(lBin)
         else:
-            CorrectImagesPaths(filePath)
+            CorrectImagesPaths()
+        StopTextureTasks()
 
         lBufferName = lBasename + '.bin'
         if binary:
             lib_buffers.append({
-                'byteLength' : len(lBin)
+                'byteLength' : lBinByteLength
             })
         else:
             lib_buffers.append({
                 'byteLength' : len(lBin),
                 'uri' : os.path.basename(lBufferName)
             })
+        for i in range(1, len(lBins)):
+            lSplitBufferName = lBasename + '_' + str(i) + '.bin'
+            lib_buffers.append({
+                'byteLength' : len(lBins[i]),
+                'uri' : os.path.basename(lSplitBufferName)
+            })
+            lBinFile = open(lSplitBufferName, 'wb')
+            lBinFile.write(lBins[i])
+            lBinFile.close()
+        if len(lBins) > 1:
+            CreateBuffersManifest()
+            print('Split binary data into %d buffers.' % len(lBins))
 
         #Output json
         lJSON = {
@@ -1481,47 +4585,45 @@ def Convert(
             lJSON['textures'] = lib_textures
         if len(lib_animations) > 0:
             lJSON['animations'] = lib_animations
+        if len(lib_extensions_used) > 0:
+            lJSON['extensionsUsed'] = lib_extensions_used
         #Default scene
         if not ignoreScene:
             lJSON['scene'] = lSceneIdx
 
+        RoundJSONFloats(ENV_JSON_PRECISION)
+
         if binary:
             lOutFile = open(ouptutFile, 'wb')
-            lJSONStr = json.dumps(lJSON, sort_keys = True, separators=(',', ':'))
-            lJSONBinary = bytearray(lJSONStr.encode(encoding='UTF-8'))
+            # Header and json chunk header are written after the json is streamed.
+            lOutFile.write(b'\x00' * 20)
+            lJSONByteLength = WriteJSON(lOutFile, lJSON, False)
             # 4-byte-aligned
-            lAlignedLen = (len(lJSONBinary) + 3) & ~3
-            for i in range(lAlignedLen - len(lJSONBinary)):
-                lJSONBinary.extend(b' ')
+            lPadding = ((lJSONByteLength + 3) & ~3) - lJSONByteLength
+            lOutFile.write(b' ' * lPadding)
+            lJSONByteLength += lPadding
 
-            lOut = bytearray()
-            lSize = 12 + 8 + len(lJSONBinary) + 8 + len(lBin)
+            lSize = 12 + 8 + lJSONByteLength + 8 + lBinByteLength
+            lOutFile.seek(0)
             # Magic number
-            lOut.extend(struct.pack('<I', 0x46546C67))
-            lOut.extend(struct.pack('<I', 2))
-            lOut.extend(struct.pack('<I', lSize))
-            lOut.extend(struct.pack('<I', len(lJSONBinary)))
-            lOut.extend(struct.pack('<I', 0x4E4F534A))
-            lOut += lJSONBinary
-            lOut.extend(struct.pack('<I', len(lBin)))
-            lOut.extend(struct.pack('<I', 0x004E4942))
-            lOut += lBin
-            lOutFile.write(lOut)
+            lOutFile.write(struct.pack('<I', 0x46546C67))
+            lOutFile.write(struct.pack('<I', 2))
+            lOutFile.write(struct.pack('<I', lSize))
+            lOutFile.write(struct.pack('<I', lJSONByteLength))
+            lOutFile.write(struct.pack('<I', 0x4E4F534A))
+            lOutFile.seek(20 + lJSONByteLength)
+            lOutFile.write(struct.pack('<I', lBinByteLength))
+            lOutFile.write(struct.pack('<I', 0x004E4942))
+            WriteBinaryChunk(lOutFile, lBin, lImageChunks, lBinByteLength)
             lOutFile.close()
 
         else:
-            lOutFile = open(ouptutFile, 'w')
+            lOutFile = open(ouptutFile, 'wb')
             lBinFile = open(lBasename + ".bin", 'wb')
             lBinFile.write(lBin)
             lBinFile.close()
 
-            indent = None
-            seperator = ':'
-
-            if beautify:
-                indent = 2
-                seperator = ': '
-            lOutFile.write(json.dumps(lJSON, indent = indent, sort_keys = True, separators=(',', seperator)))
+            WriteJSON(lOutFile, lJSON, beautify)
             lOutFile.close()
 
 if __name__ == "__main__":
@@ -1533,9 +4635,40 @@ if __name__ == "__main__":
     parser.add_argument('-f', '--framerate', default=20, type=float, help="Animation frame per second")
     parser.add_argument('-p', '--pose', default=0, type=float, help="Start pose time")
     parser.add_argument('-q', '--quantize', action='store_true', help="Quantize accessors with WEB3D_quantized_attributes extension")
+    parser.add_argument('--quantizeanimation', action='store_true', help="Quantize animation rotation to normalized short")
     parser.add_argument('-b', '--binary', action="store_true", help="Export glTF-binary")
     parser.add_argument('--beautify', action="store_true", help="Beautify json output.")
+    parser.add_argument('--flatten', action="store_true", help="Remove empty static nodes and bake their transforms into descendants.")
+    parser.add_argument('--mergemeshes', action="store_true", help="Merge static sibling meshes when flattening scene.")
+    parser.add_argument('--batch', action="store_true", help="Merge static primitives sharing the same material to reduce draw calls.")
+    parser.add_argument('--atlas', action="store_true", help="Pack small base color textures of similar materials into atlases. Needs Pillow")
+    parser.add_argument('--atlassize', default=2048, type=int, help="Max size of texture atlas")
+    parser.add_argument('--atlastilesize', default=512, type=int, help="Max size of texture packed in atlas")
+    parser.add_argument('--texturesize', default='', type=str, help="Max texture size. Can be one size for all or per role like 'baseColor:2048,normal:1024,emissive:1024'. Needs Pillow")
+    parser.add_argument('--texturepot', action="store_true", help="Resize textures with repeat wrap mode to power of two. Needs Pillow")
+    parser.add_argument('--textureformat', default='keep', choices=['keep', 'png', 'jpeg'], help="Re-encode textures. Needs Pillow")
+    parser.add_argument('--texturequality', default=90, type=int, help="Quality of re-encoded jpeg textures")
+    parser.add_argument('--texturemips', action="store_true", help="Pre-generate texture mipmaps, listed in the extras of image. Needs Pillow")
+    parser.add_argument('--texturecompress', default='', type=str, help="Also write block compressed textures, can be: dds,ktx. Listed in the extras of image. Needs Pillow and NumPy")
+    parser.add_argument('--texturecache', default='', type=str, help="Directory of processed textures cache")
     parser.add_argument('--noflipv', action="store_true", help="If not flip v in texcoord.")
+    parser.add_argument('--normals', action="store_true", help="Generate smooth normals for meshes without normals.")
+    parser.add_argument('--cleanup', action="store_true", help="Remove degenerate and duplicate triangles and unused vertices of meshes. Needs NumPy")
+    parser.add_argument('--fasttriangulate', action="store_true", help="Triangulate only the exported meshes with NumPy, instead of triangulating the whole scene with FBX SDK.")
+    parser.add_argument('--tangents', action="store_true", help="Compute tangents of normal mapped meshes. Needs NumPy")
+    parser.add_argument('--texturetransform', action="store_true", help="Keep texcoords untouched and write texture scale and offset with KHR_texture_transform extension.")
+    parser.add_argument('--lod', default='', type=str, help="Triangle ratio of each LOD level, like '0.5,0.25'. LOD levels are written with MSFT_lod extension. Needs NumPy")
+    parser.add_argument('--loderror', default=0.01, type=float, help="Max simplification error of LOD levels, relative to the mesh size")
+    parser.add_argument('--lodcoverage', default='', type=str, help="Screen coverage of the base mesh and each LOD level, like '0.25,0.125,0'. Written in the extras of node.")
+    parser.add_argument('--cluster', default=0, type=int, help="Split primitives with more triangles than this into spatially coherent clusters, with bounds in the extras of primitive. Needs NumPy")
+    parser.add_argument('--bounds', action="store_true", help="Write world space bounds of nodes at the pose time and a BVH of mesh nodes in the extras of node and scene. Needs NumPy")
+    parser.add_argument('--trianglebvh', default=0, type=int, help="Build triangle BVH of primitives with more triangles than this for ray picking, written in its own bufferView. Needs NumPy")
+    parser.add_argument('--shortindices', action="store_true", help="Split primitives with too many vertices to avoid 32 bit indices, and use 8 bit indices for tiny primitives. Needs NumPy")
+    parser.add_argument('--layout', default='kind', choices=['kind', 'traversal', 'importance'], help="Layout of binary data. 'kind' groups data of the same kind. 'traversal' and 'importance' give each mesh its own buffer views, ordered by scene traversal or by size and proximity to the origin, with animation last, so meshes can be rendered progressively.")
+    parser.add_argument('--splitbuffers', default='none', choices=['none', 'animation', 'node', 'size'], help="Split binary data into several .bin files, one per animation, one per top level node, or chunks up to the max size. Contents of each buffer are listed in its extras, so they can be loaded lazily.")
+    parser.add_argument('--buffersize', default=16, type=float, help="Max size of each .bin file in MB when splitting buffers by size.")
+    parser.add_argument('--precision', default=-1, type=int, help="Significant digits of node translation and scale, decimal digits of node rotation and bounds in the extras. Negative value will keep full precision.")
+    parser.add_argument('--animtolerance', default=1e-5, type=float, help="Tolerance to remove constant animation channels. Negative value will keep them.")
     parser.add_argument('file')
 
     args = parser.parse_args()
@@ -1565,7 +4698,54 @@ if __name__ == "__main__":
     excluded = args.exclude.split(',')
 
     ENV_QUANTIZE = args.quantize
+    ENV_QUANTIZE_ANIMATION = args.quantizeanimation
     ENV_FLIP_V = not args.noflipv
+    ENV_TEXTURE_TRANSFORM = args.texturetransform
+    ENV_TANGENTS = args.tangents
+    if ENV_TANGENTS and np == None:
+        print('Tangents of normal mapped meshes need NumPy, skipped. Install it with "pip install numpy".')
+    ENV_GENERATE_NORMALS = args.normals
+    if ENV_GENERATE_NORMALS and np == None:
+        print('Generating normals needs NumPy, skipped. Install it with "pip install numpy".')
+    ENV_LOD_RATIOS = [float(lRatio) for lRatio in args.lod.split(',') if lRatio]
+    ENV_LOD_ERROR = args.loderror
+    ENV_LOD_COVERAGE = [float(lCoverage) for lCoverage in args.lodcoverage.split(',') if lCoverage]
+    if len(ENV_LOD_RATIOS) > 0 and np == None:
+        print('LOD levels need NumPy, skipped. Install it with "pip install numpy".')
+    if len(ENV_LOD_COVERAGE) > 0 and not len(ENV_LOD_COVERAGE) == len(ENV_LOD_RATIOS) + 1:
+        print('LOD coverage needs %d values, use default values.' % (len(ENV_LOD_RATIOS) + 1))
+    ENV_CLUSTER_TRIANGLES = args.cluster
+    if ENV_CLUSTER_TRIANGLES > 0 and np == None:
+        print('Splitting clusters needs NumPy, skipped. Install it with "pip install numpy".')
+    ENV_BOUNDS = args.bounds
+    if ENV_BOUNDS and np == None:
+        print('Computing bounds needs NumPy, skipped. Install it with "pip install numpy".')
+    ENV_TRIANGLE_BVH = args.trianglebvh
+    if ENV_TRIANGLE_BVH > 0 and np == None:
+        print('Building triangle BVH needs NumPy, skipped. Install it with "pip install numpy".')
+    ENV_SHORT_INDICES = args.shortindices
+    if ENV_SHORT_INDICES and np == None:
+        print('Splitting primitives needs NumPy, skipped. Install it with "pip install numpy".')
+    ENV_CLEANUP = args.cleanup
+    if ENV_CLEANUP and np == None:
+        print('Cleanup of meshes needs NumPy, skipped. Install it with "pip install numpy".')
+    ENV_FAST_TRIANGULATE = args.fasttriangulate
+    if ENV_FAST_TRIANGULATE and np == None:
+        print('Fast triangulation needs NumPy, use FBX SDK instead. Install it with "pip install numpy".')
+    ENV_JSON_PRECISION = args.precision
+    ENV_BUFFER_LAYOUT = args.layout
+    ENV_SPLIT_BUFFERS = args.splitbuffers
+    ENV_BUFFER_MAX_SIZE = int(args.buffersize * 1024 * 1024)
+    ENV_ANIMATION_TOLERANCE = args.animtolerance
+    ENV_TEXTURE_MAX_SIZE = ParseTextureSize(args.texturesize)
+    ENV_TEXTURE_POT = args.texturepot
+    ENV_TEXTURE_FORMAT = args.textureformat
+    ENV_TEXTURE_QUALITY = args.texturequality
+    ENV_TEXTURE_MIPMAPS = args.texturemips
+    ENV_TEXTURE_CACHE_DIR = args.texturecache
+    ENV_TEXTURE_COMPRESS = [lContainer for lContainer in args.texturecompress.split(',') if lContainer in ('dds', 'ktx')]
+    ENV_ATLAS_SIZE = args.atlassize
+    ENV_ATLAS_TILE_SIZE = args.atlastilesize
 
     Convert(
         args.file,
@@ -1576,5 +4756,10 @@ if __name__ == "__main__":
         lDuration,
         lPoseTime,
         args.beautify,
-        args.binary
+        args.binary,
+        args.flatten,
+        args.mergemeshes,
+        args.batch,
+        args.atlas,
+        lOutputDirSpecified
     )